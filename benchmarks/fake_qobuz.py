@@ -0,0 +1,757 @@
+"""Local stand-in for the Qobuz API, web player and CDN.
+
+Serves a synthetic catalogue so `qopy.Client`, `bundle.Bundle` and
+`downloader.Download` can run offline, for tests and benchmarks:
+
+- `user/login`, `album/get`, `track/get`, `track/getFileUrl` (signatures
+  and auth tokens are checked), paginated `artist/get`, `label/get` and
+  `playlist/get`, the searches and `favorite/getUserFavorites`
+- the login page and a `bundle.js` with the app ID and secret, served with
+  an ETag
+- signed file URLs with synthetic FLAC and MP3 payloads and Range support
+
+Latency, bandwidth, error rate and 429 rate are configurable. Logins, the
+web player and covers are never failed on purpose.
+
+    python benchmarks/fake_qobuz.py --albums 20 --latency 0.05 --bandwidth 50
+
+From Python:
+
+    catalog = Catalog()
+    album_id = catalog.add_album(tracks=20)
+    with FakeQobuz(catalog, latency=0.02) as server:
+        client = qopy.Client(EMAIL, PASSWORD, server.app_id, [server.secret],
+                             api_url=server.api_url)
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import secrets as _secrets
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+EMAIL = "bench@example.com"
+PASSWORD = "password"
+APP_ID = "950096963"
+BUNDLE_VERSION = "7.1.0-b001"
+USER_LABEL = "Studio"
+# bumped when a change to the server alters the timings clients see, so
+# benchmark results recorded against an older one aren't compared
+VERSION = 2
+
+FLAC_SIZE = 1024 * 1024
+MP3_SIZE = 256 * 1024
+# track signed by qopy.Client.test_secret to probe the secrets
+PROBE_TRACK_ID = "5966783"
+# seconds a signed file URL stays valid
+URL_LIFETIME = 30 * 60
+
+# bit depth and sampling rate served for each format ID
+FORMATS = {5: (None, 44.1), 6: (16, 44.1), 7: (24, 96), 27: (24, 192)}
+
+_JPEG = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00\xff\xd9"
+
+
+class Catalog:
+    """Synthetic albums, tracks, artists, labels and playlists.
+
+    IDs are short alphanumeric strings, so URLs like
+    `https://play.qobuz.com/album/<id>` work with `utils.get_url_info`.
+    """
+
+    def __init__(self):
+        self.albums = {}
+        self.tracks = {}
+        self.artists = {}
+        self.labels = {}
+        self.playlists = {}
+        self._ids = Counter()
+
+    def _new_id(self, prefix):
+        self._ids[prefix] += 1
+        return f"{prefix}{self._ids[prefix]:06d}"
+
+    def add_artist(self, name=None, albums=0, tracks=10, **album_kwargs):
+        artist_id = self._new_id("ar")
+        self.artists[artist_id] = {
+            "id": artist_id,
+            "name": name or f"Artist {artist_id}",
+            "albums": [],
+        }
+        for _ in range(albums):
+            self.add_album(tracks=tracks, artist=artist_id, **album_kwargs)
+        return artist_id
+
+    def add_label(self, name=None, albums=0, tracks=10, **album_kwargs):
+        label_id = self._new_id("lb")
+        self.labels[label_id] = {
+            "id": label_id,
+            "name": name or f"Label {label_id}",
+            "albums": [],
+        }
+        for _ in range(albums):
+            self.add_album(tracks=tracks, label=label_id, **album_kwargs)
+        return label_id
+
+    def add_album(
+        self,
+        tracks=10,
+        discs=1,
+        bit_depth=24,
+        sampling_rate=96,
+        artist=None,
+        label=None,
+        title=None,
+        version=None,
+        release_type="album",
+    ):
+        if artist is None:
+            artist = self.add_artist()
+        if label is None:
+            # albums without a label go to the first one
+            label = next(iter(self.labels)) if self.labels else self.add_label()
+        album_id = self._new_id("al")
+        index = len(self.albums)
+        album = {
+            "id": album_id,
+            "title": title or f"Album {album_id}",
+            "version": version,
+            "artist": self.artists[artist],
+            "label": self.labels[label],
+            "release_date_original": f"{2000 + index % 25}-01-01",
+            "maximum_bit_depth": bit_depth,
+            "maximum_sampling_rate": sampling_rate,
+            "release_type": release_type,
+            "tracks": [],
+        }
+        per_disc = max(1, -(-tracks // discs))
+        for number in range(tracks):
+            track_id = self._new_id("tr")
+            self.tracks[track_id] = {
+                "id": track_id,
+                "album": album,
+                "title": f"Track {number + 1}",
+                "track_number": number % per_disc + 1,
+                "media_number": number // per_disc + 1,
+                "duration": 180 + number,
+            }
+            album["tracks"].append(track_id)
+        self.albums[album_id] = album
+        self.artists[artist]["albums"].append(album_id)
+        self.labels[label]["albums"].append(album_id)
+        return album_id
+
+    def add_playlist(self, tracks=None, name=None):
+        "Playlist of `tracks` IDs, or of every track in the catalogue"
+        playlist_id = self._new_id("pl")
+        self.playlists[playlist_id] = {
+            "id": playlist_id,
+            "name": name or f"Playlist {playlist_id}",
+            "tracks": list(self.tracks) if tracks is None else list(tracks),
+        }
+        return playlist_id
+
+
+class FakeQobuz:
+    """Threaded HTTP server for a Catalog, on 127.0.0.1.
+
+    :param float latency: seconds added to every API and file request
+    :param float bandwidth: bytes per second per file transfer, None for
+    unlimited
+    :param float error_rate: share of API and file requests answered with 500
+    :param float rate_limit_rate: share answered with 429 and `Retry-After`
+    :param int api_concurrency: API calls served at the same time; the ones
+    over it are answered with 429
+    :param int flac_size: bytes of each FLAC payload
+    :param int mp3_size: bytes of each MP3 payload
+    """
+
+    def __init__(
+        self,
+        catalog,
+        latency=0,
+        bandwidth=None,
+        error_rate=0,
+        rate_limit_rate=0,
+        retry_after=1,
+        api_concurrency=None,
+        flac_size=FLAC_SIZE,
+        mp3_size=MP3_SIZE,
+        email=EMAIL,
+        password=PASSWORD,
+        app_id=APP_ID,
+        port=0,
+        seed=None,
+    ):
+        self.catalog = catalog
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.api_concurrency = api_concurrency
+        self._api_in_flight = 0
+        self.email = email
+        self.password = password
+        self.app_id = app_id
+        self.bundle_version = BUNDLE_VERSION
+        self.secret = _new_secret()
+        self.calls = Counter()
+        self.bytes_sent = 0
+        self._tokens = set()
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._payloads = {
+            "flac": _flac_payload(flac_size),
+            "mp3": _mp3_payload(mp3_size),
+        }
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    @property
+    def api_url(self):
+        return f"{self.url}/api.json/0.2/"
+
+    @property
+    def player_url(self):
+        return self.url
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls.clear()
+            self.bytes_sent = 0
+
+    def api_calls(self):
+        "Number of API calls served, logins and secret probes included"
+        with self._lock:
+            return sum(n for key, n in self.calls.items() if not key.startswith("/"))
+
+    def expire_tokens(self):
+        "Invalidate every user auth token, as if the sessions expired"
+        with self._lock:
+            self._tokens.clear()
+
+    def rotate_secret(self):
+        "Publish a new bundle version with a new app secret"
+        with self._lock:
+            major, build = self.bundle_version.split("-")
+            self.bundle_version = f"{major}-b{int(build[1:]) + 1:03d}"
+            self.secret = _new_secret()
+
+    def _count(self, key, sent=0):
+        with self._lock:
+            self.calls[key] += 1
+            self.bytes_sent += sent
+
+    def _enter_api(self):
+        with self._lock:
+            if self.api_concurrency and self._api_in_flight >= self.api_concurrency:
+                return False
+            self._api_in_flight += 1
+            return True
+
+    def _leave_api(self):
+        with self._lock:
+            self._api_in_flight -= 1
+
+    def _fault(self):
+        "None, or the status and headers of a failure to inject"
+        with self._lock:
+            roll = self._random.random()
+        if roll < self.rate_limit_rate:
+            return 429, {"Retry-After": str(self.retry_after)}
+        if roll < self.rate_limit_rate + self.error_rate:
+            return 500, {}
+        return None
+
+    # API
+
+    def api(self, endpoint, query, token):
+        "Return the status and JSON body of an API call"
+        handler = getattr(self, "_api_" + endpoint.replace("/", "_"), None)
+        if handler is None:
+            return 404, {"status": "error", "code": 404, "message": "Not found"}
+        return handler(query, token)
+
+    def _authorized(self, token):
+        with self._lock:
+            return token in self._tokens
+
+    def _api_user_login(self, query, token):
+        if query.get("app_id") != self.app_id:
+            return 400, {"status": "error", "code": 400, "message": "Invalid app_id"}
+        hashed = hashlib.md5(self.password.encode("utf-8")).hexdigest()
+        if query.get("email") != self.email or query.get("password") not in (
+            self.password,
+            hashed,
+        ):
+            return 401, {"status": "error", "code": 401, "message": "Invalid login"}
+        new_token = _secrets.token_hex(16)
+        with self._lock:
+            self._tokens.add(new_token)
+        return 200, {
+            "user_auth_token": new_token,
+            "user": {
+                "id": 1,
+                "email": self.email,
+                "credential": {"parameters": {"short_label": USER_LABEL}},
+            },
+        }
+
+    def _api_album_get(self, query, token):
+        album = self.catalog.albums.get(query.get("album_id"))
+        if album is None:
+            return 404, {"status": "error", "code": 404, "message": "No album"}
+        meta = self._album(album)
+        meta["tracks"] = {
+            "offset": 0,
+            "limit": len(album["tracks"]),
+            "total": len(album["tracks"]),
+            "items": [self._track(i, with_album=False) for i in album["tracks"]],
+        }
+        return 200, meta
+
+    def _api_track_get(self, query, token):
+        if query.get("track_id") not in self.catalog.tracks:
+            return 404, {"status": "error", "code": 404, "message": "No track"}
+        return 200, self._track(query["track_id"])
+
+    def _api_track_getFileUrl(self, query, token):
+        if not self._authorized(token):
+            return 401, {"status": "error", "code": 401, "message": "Auth required"}
+        track_id, fmt_id = query.get("track_id"), query.get("format_id")
+        expected = hashlib.md5(
+            f"trackgetFileUrlformat_id{fmt_id}intentstreamtrack_id{track_id}"
+            f"{query.get('request_ts')}{self.secret}".encode("utf-8")
+        ).hexdigest()
+        if query.get("request_sig") != expected:
+            return 400, {
+                "status": "error",
+                "code": 400,
+                "message": "Invalid Request Signature parameter (request_sig)",
+            }
+        if track_id == PROBE_TRACK_ID:
+            return 200, {"track_id": track_id, "sample": True}
+        track = self.catalog.tracks.get(track_id)
+        if track is None:
+            return 404, {"status": "error", "code": 404, "message": "No track"}
+
+        album = track["album"]
+        bit_depth, sampling_rate = FORMATS[int(fmt_id)]
+        restrictions = []
+        if bit_depth and (
+            bit_depth > album["maximum_bit_depth"]
+            or sampling_rate > album["maximum_sampling_rate"]
+        ):
+            bit_depth = album["maximum_bit_depth"]
+            sampling_rate = album["maximum_sampling_rate"]
+            restrictions.append({"code": "FormatRestrictedByFormatAvailability"})
+        ext = "mp3" if int(fmt_id) == 5 else "flac"
+        expiry = int(time.time()) + URL_LIFETIME
+        response = {
+            "track_id": track_id,
+            "duration": track["duration"],
+            "url": f"{self.url}/file/{track_id}.{ext}?fmt={fmt_id}&etsp={expiry}",
+            "format_id": int(fmt_id),
+            "mime_type": "audio/mpeg" if ext == "mp3" else "audio/flac",
+            "sampling_rate": sampling_rate,
+            "bit_depth": bit_depth,
+        }
+        if restrictions:
+            response["restrictions"] = restrictions
+        return 200, response
+
+    def _api_artist_get(self, query, token):
+        return self._paginated(self.catalog.artists, "artist_id", "albums", query)
+
+    def _api_label_get(self, query, token):
+        return self._paginated(self.catalog.labels, "label_id", "albums", query)
+
+    def _api_playlist_get(self, query, token):
+        return self._paginated(self.catalog.playlists, "playlist_id", "tracks", query)
+
+    def _paginated(self, items, id_key, key, query):
+        item = items.get(query.get(id_key))
+        if item is None:
+            return 404, {"status": "error", "code": 404, "message": "Not found"}
+        offset = int(query.get("offset", 0))
+        limit = int(query.get("limit", 25))
+        ids = item[key][offset : offset + limit]
+        if key == "albums":
+            page = [self._album(self.catalog.albums[i]) for i in ids]
+        else:
+            page = [self._track(i) for i in ids]
+        return 200, {
+            "id": item["id"],
+            "name": item["name"],
+            f"{key}_count": len(item[key]),
+            key: {
+                "offset": offset,
+                "limit": limit,
+                "total": len(item[key]),
+                "items": page,
+            },
+        }
+
+    def _search(self, query, key, items, serialize):
+        text = query.get("query", "").lower()
+        limit = int(query.get("limit", 10))
+        found = [i for i in items.values() if text in _search_name(i).lower()]
+        return 200, {
+            key: {
+                "offset": 0,
+                "limit": limit,
+                "total": len(found),
+                "items": [serialize(i) for i in found[:limit]],
+            }
+        }
+
+    def _api_album_search(self, query, token):
+        return self._search(query, "albums", self.catalog.albums, self._album)
+
+    def _api_track_search(self, query, token):
+        return self._search(
+            query, "tracks", self.catalog.tracks, lambda i: self._track(i["id"])
+        )
+
+    def _api_artist_search(self, query, token):
+        return self._search(
+            query,
+            "artists",
+            self.catalog.artists,
+            lambda i: {
+                "id": i["id"],
+                "name": i["name"],
+                "albums_count": len(i["albums"]),
+            },
+        )
+
+    def _api_playlist_search(self, query, token):
+        return self._search(
+            query,
+            "playlists",
+            self.catalog.playlists,
+            lambda i: {
+                "id": i["id"],
+                "name": i["name"],
+                "tracks_count": len(i["tracks"]),
+            },
+        )
+
+    def _api_favorite_getUserFavorites(self, query, token):
+        if not self._authorized(token or query.get("user_auth_token")):
+            return 401, {"status": "error", "code": 401, "message": "Auth required"}
+        expected = hashlib.md5(
+            f"favoritegetUserFavorites{query.get('request_ts')}{self.secret}".encode(
+                "utf-8"
+            )
+        ).hexdigest()
+        if query.get("request_sig") != expected:
+            return 400, {"status": "error", "code": 400, "message": "Invalid signature"}
+        return 200, {"albums": {"offset": 0, "limit": 0, "total": 0, "items": []}}
+
+    def _album(self, album):
+        return {
+            "id": album["id"],
+            "title": album["title"],
+            "version": album["version"],
+            "artist": {"id": album["artist"]["id"], "name": album["artist"]["name"]},
+            "label": {"id": album["label"]["id"], "name": album["label"]["name"]},
+            "release_date_original": album["release_date_original"],
+            "release_type": album["release_type"],
+            "maximum_bit_depth": album["maximum_bit_depth"],
+            "maximum_sampling_rate": album["maximum_sampling_rate"],
+            "hires_streamable": album["maximum_bit_depth"] > 16,
+            "streamable": True,
+            "tracks_count": len(album["tracks"]),
+            "duration": 180 * len(album["tracks"]),
+            "genres_list": ["Pop/Rock", "Pop/Rock→Rock"],
+            "copyright": f"(P) {album['label']['name']}",
+            "image": {
+                "small": f"{self.url}/covers/{album['id']}_230.jpg",
+                "large": f"{self.url}/covers/{album['id']}_600.jpg",
+            },
+        }
+
+    def _track(self, track_id, with_album=True):
+        track = self.catalog.tracks[track_id]
+        album = track["album"]
+        meta = {
+            "id": track_id,
+            "title": track["title"],
+            "version": None,
+            "track_number": track["track_number"],
+            "media_number": track["media_number"],
+            "duration": track["duration"],
+            "performer": {"name": album["artist"]["name"]},
+            "composer": {"name": album["artist"]["name"]},
+            "copyright": f"(P) {album['label']['name']}",
+            "isrc": f"QZ{track_id.upper()}",
+            "maximum_bit_depth": album["maximum_bit_depth"],
+            "maximum_sampling_rate": album["maximum_sampling_rate"],
+            "hires_streamable": album["maximum_bit_depth"] > 16,
+            "streamable": True,
+        }
+        if with_album:
+            meta["album"] = self._album(album)
+        return meta
+
+    # web player
+
+    def login_page(self):
+        return (
+            "<html><head>"
+            f'<script src="/resources/{self.bundle_version}/bundle.js"></script>'
+            "</head></html>"
+        )
+
+    def bundle(self):
+        "bundle.js with the app ID and secret, in the web player's layout"
+        text = (
+            f'production:{{api:{{appId:"{self.app_id}",'
+            f'appSecret:"{_secrets.token_hex(16)}"}}}};'
+        )
+        # Bundle() expects at least two timezones and puts the second first
+        for timezone, secret in (("london", _new_secret()), ("berlin", self.secret)):
+            encoded = base64.standard_b64encode(secret.encode()).decode() + "A" * 44
+            seed, info, extras = encoded[:16], encoded[16:40], encoded[40:]
+            text += (
+                f'a.initialSeed("{seed}",window.utimezone.{timezone});'
+                f'{{name:"Europe/{timezone.capitalize()}",'
+                f'info:"{info}",extras:"{extras}"}};'
+            )
+        return text
+
+    def payload(self, ext):
+        return self._payloads[ext]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are separate writes: without TCP_NODELAY each
+    # keep-alive response waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def do_HEAD(self):
+        self._send(200, b"", "text/plain", head=True)
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        path = parts.path
+
+        if path.startswith("/api.json/0.2/"):
+            endpoint = path[len("/api.json/0.2/") :]
+            if endpoint != "user/login" and self._inject_fault(endpoint):
+                return
+            if not self.fake._enter_api():
+                self.fake._count(f"{endpoint} 429")
+                return self._send(429, b"{}", "application/json")
+            try:
+                time.sleep(self.fake.latency)
+                status, body = self.fake.api(
+                    endpoint, query, self.headers.get("X-User-Auth-Token")
+                )
+            finally:
+                self.fake._leave_api()
+            data = json.dumps(body).encode()
+            self.fake._count(endpoint, len(data))
+            self._send(status, data, "application/json")
+        elif path == "/login":
+            self.fake._count("/login")
+            self._send(200, self.fake.login_page().encode(), "text/html")
+        elif re.fullmatch(r"/resources/[\w.-]+/bundle\.js", path):
+            self._send_bundle(path)
+        elif path.startswith("/covers/"):
+            self.fake._count("/covers")
+            self._send(200, _JPEG, "image/jpeg")
+        elif path.startswith("/file/"):
+            self._send_file(path, query)
+        else:
+            self._send(404, b"", "text/plain")
+
+    def _inject_fault(self, key):
+        fault = self.fake._fault()
+        if fault is None:
+            return False
+        status, headers = fault
+        self.fake._count(f"{key} {status}")
+        self._send(status, b"{}", "application/json", headers)
+        return True
+
+    def _send(self, status, data, content_type, headers=None, head=False):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if not head:
+            self.wfile.write(data)
+
+    def _send_bundle(self, path):
+        self.fake._count("/bundle.js")
+        if path != f"/resources/{self.fake.bundle_version}/bundle.js":
+            return self._send(404, b"", "text/plain")
+        etag = f'"{self.fake.bundle_version}"'
+        if self.headers.get("If-None-Match") == etag:
+            return self._send(304, b"", "application/javascript", {"ETag": etag})
+        self._send(
+            200, self.fake.bundle().encode(), "application/javascript", {"ETag": etag}
+        )
+
+    def _send_file(self, path, query):
+        name = path[len("/file/") :]
+        track_id, _, ext = name.partition(".")
+        if track_id not in self.fake.catalog.tracks or ext not in ("flac", "mp3"):
+            return self._send(404, b"", "text/plain")
+        if int(query.get("etsp", 0)) < time.time():
+            return self._send(403, b"", "text/plain")
+        if self._inject_fault("/file"):
+            return
+        time.sleep(self.fake.latency)
+
+        payload = self.fake.payload(ext)
+        start, end = 0, len(payload) - 1
+        status, headers = 200, {"Accept-Ranges": "bytes"}
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+            if start > end:
+                return self._send(
+                    416, b"", "text/plain", {"Content-Range": f"bytes */{len(payload)}"}
+                )
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(payload)}"
+
+        self.send_response(status)
+        self.send_header("Content-Type", f"audio/{'mpeg' if ext == 'mp3' else 'flac'}")
+        self.send_header("Content-Length", str(end - start + 1))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self._write_throttled(memoryview(payload)[start : end + 1])
+        self.fake._count("/file", end - start + 1)
+
+    def _write_throttled(self, data, chunk_size=64 * 1024):
+        bandwidth = self.fake.bandwidth
+        started = time.monotonic()
+        for offset in range(0, len(data), chunk_size):
+            self.wfile.write(data[offset : offset + chunk_size])
+            if bandwidth:
+                ahead = (offset + chunk_size) / bandwidth - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+def _search_name(item):
+    return item.get("title") or item.get("name", "")
+
+
+def _new_secret():
+    # the web player's secrets are 32 hex characters
+    return _secrets.token_hex(16)
+
+
+def _filler(size):
+    block = random.Random(size).randbytes(64 * 1024)
+    return (block * (size // len(block) + 1))[:size]
+
+
+def _flac_payload(size):
+    "fLaC marker, a STREAMINFO block (24 bit, 96 kHz, stereo) and filler"
+    # block sizes, sample rate, channels - 1 and bits per sample - 1,
+    # shifted to their offsets in the 272 bit block
+    streaminfo = (
+        (4096 << 256) | (4096 << 240) | (96000 << 172) | (1 << 169) | (23 << 164)
+    ).to_bytes(34, "big")
+    header = b"fLaC" + bytes([0x80, 0, 0, 34]) + streaminfo
+    return header + _filler(max(0, size - len(header)))
+
+
+def _mp3_payload(size):
+    "MPEG-1 Layer III frames, 320 kbps at 44.1 kHz"
+    frame = b"\xff\xfb\xe0\x64" + bytes(1040)
+    return (frame * (size // len(frame) + 1))[:size]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--albums", type=int, default=10)
+    parser.add_argument("--tracks", type=int, default=10, help="tracks per album")
+    parser.add_argument("--latency", type=float, default=0, help="seconds")
+    parser.add_argument("--bandwidth", type=float, help="MB/s per transfer")
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0)
+    parser.add_argument("--api-concurrency", type=int)
+    parser.add_argument("--flac-size", type=int, default=FLAC_SIZE // 1024, help="KB")
+    args = parser.parse_args()
+
+    catalog = Catalog()
+    label = catalog.add_label(albums=args.albums, tracks=args.tracks)
+    playlist = catalog.add_playlist()
+    server = FakeQobuz(
+        catalog,
+        latency=args.latency,
+        bandwidth=args.bandwidth * 1024 * 1024 if args.bandwidth else None,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        api_concurrency=args.api_concurrency,
+        flac_size=args.flac_size * 1024,
+        port=args.port,
+    )
+    print(
+        f"API: {server.api_url}\nWeb player: {server.player_url}\n"
+        f"Email: {server.email}\nPassword: {server.password}\n"
+        f"App ID: {server.app_id}\nSecret: {server.secret}\n"
+        f"Label: https://play.qobuz.com/label/{label}\n"
+        f"Playlist: https://play.qobuz.com/playlist/{playlist}\n"
+        f"First album: https://play.qobuz.com/album/{next(iter(catalog.albums))}"
+    )
+    with server:
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""End-to-end throughput of `QobuzDL.download_list_of_urls`.
+
+Each scenario runs against a local fake_qobuz server, in a child process,
+so the peak RSS and the CPU time are the client's only:
+
+- album: a 20-track hi-res (24/192) album
+- playlist: a 500-track playlist
+- label: a 2,000-album label
+- discography: an artist's discography in MP3
+
+Reports wall time, MB/s, API calls per release, peak RSS and CPU seconds,
+and saves them as JSON. With `--compare`, exits with status 1 when a metric
+is worse than in a previous JSON by more than `--threshold` percent; runs
+with other settings or against another fake_qobuz version aren't compared.
+
+    python benchmarks/pipeline.py --output before.json
+    python benchmarks/pipeline.py --compare before.json --threshold 10
+    python benchmarks/pipeline.py album label --scale 0.1 --max-inflight-releases 4
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, ".."))
+sys.path.insert(0, BENCHMARKS)
+
+from fake_qobuz import EMAIL, PASSWORD, VERSION, Catalog, FakeQobuz  # noqa: E402
+
+KB = 1024
+MB = 1024 * KB
+
+# True when a higher value is better
+METRICS = {
+    "wall_s": False,
+    "mb_s": True,
+    "api_calls_per_release": False,
+    "peak_rss_mb": False,
+    "cpu_s": False,
+}
+
+
+def _album(catalog, scale):
+    album_id = catalog.add_album(tracks=20, bit_depth=24, sampling_rate=192)
+    return [f"https://play.qobuz.com/album/{album_id}"], 1
+
+
+def _playlist(catalog, scale):
+    tracks = max(1, int(500 * scale))
+    for _ in range(-(-tracks // 10)):
+        catalog.add_album(tracks=10)
+    playlist_id = catalog.add_playlist(list(catalog.tracks)[:tracks])
+    return [f"https://play.qobuz.com/playlist/{playlist_id}"], tracks
+
+
+def _label(catalog, scale):
+    albums = max(1, int(2000 * scale))
+    label_id = catalog.add_label(albums=albums, tracks=1)
+    return [f"https://play.qobuz.com/label/{label_id}"], albums
+
+
+def _discography(catalog, scale):
+    albums = max(1, int(30 * scale))
+    artist_id = catalog.add_artist(albums=albums, tracks=12)
+    return [f"https://play.qobuz.com/artist/{artist_id}"], albums
+
+
+# builder, quality and size of each file
+SCENARIOS = {
+    "album": (_album, 27, 4 * MB),
+    "playlist": (_playlist, 6, 512 * KB),
+    "label": (_label, 6, 128 * KB),
+    "discography": (_discography, 5, 256 * KB),
+}
+
+
+def _download(server, urls, quality, directory, options, verbose):
+    "Child process: download `urls` and return the client's resource usage"
+    if not verbose:
+        # progress bars of thousands of files would dominate the run
+        sys.stderr = open(os.devnull, "w")
+    logging.basicConfig(level=logging.INFO if verbose else logging.WARNING)
+
+    from qobuz_dl.core import QobuzDL
+
+    qobuz = QobuzDL(
+        directory,
+        quality,
+        api_url=server["api_url"],
+        player_url=server["player_url"],
+        **options,
+    )
+    qobuz.initialize_client(EMAIL, PASSWORD, server["app_id"], [server["secret"]])
+    started = time.perf_counter()
+    qobuz.download_list_of_urls(urls)
+    wall = time.perf_counter() - started
+
+    usage = {"wall_s": wall, "peak_rss_mb": None, "cpu_s": None}
+    if resource is not None:
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+        # kilobytes on Linux, bytes on macOS
+        divisor = MB if sys.platform == "darwin" else KB
+        usage["peak_rss_mb"] = rusage.ru_maxrss / divisor
+        usage["cpu_s"] = rusage.ru_utime + rusage.ru_stime
+    return usage
+
+
+def _size(directory):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(directory)
+        for name in names
+        if name.endswith((".flac", ".mp3"))
+    )
+
+
+def run_scenario(name, args, options):
+    build, quality, file_size = SCENARIOS[name]
+    catalog = Catalog()
+    urls, releases = build(catalog, args.scale)
+    server = FakeQobuz(
+        catalog,
+        latency=args.latency,
+        bandwidth=args.bandwidth * MB if args.bandwidth else None,
+        flac_size=file_size,
+        mp3_size=file_size,
+        seed=0,
+    )
+    directory = tempfile.mkdtemp(prefix=f"qobuz-dl-bench-{name}-")
+    try:
+        with server:
+            with ProcessPoolExecutor(
+                1, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                usage = executor.submit(
+                    _download,
+                    *(
+                        {
+                            "api_url": server.api_url,
+                            "player_url": server.player_url,
+                            "app_id": server.app_id,
+                            "secret": server.secret,
+                        },
+                        urls,
+                        quality,
+                        directory,
+                        options,
+                        args.verbose,
+                    ),
+                ).result()
+            api_calls = server.api_calls()
+        size = _size(directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        **usage,
+        "mb_s": size / MB / usage["wall_s"],
+        "bytes": size,
+        "releases": releases,
+        "api_calls": api_calls,
+        "api_calls_per_release": api_calls / releases,
+    }
+
+
+def compare(results, baseline, threshold):
+    "Print the changes against `baseline` and return the regressed metrics"
+    regressions = []
+    print(f"\n{'':36}{'before':>12}{'after':>12}{'change':>10}")
+    for name, metrics in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            before, after = previous.get(metric), metrics.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before * 100
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > threshold:
+                regressions.append(f"{name} {metric}")
+                flag = "  REGRESSION"
+            print(
+                f"{name + ' ' + metric:36}{before:>12.2f}{after:>12.2f}"
+                f"{change:>+9.1f}%{flag}"
+            )
+    return regressions
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BENCHMARKS,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "scenarios", nargs="*", help=f"{', '.join(SCENARIOS)} (default: all)"
+    )
+    parser.add_argument("--scale", type=float, default=1, help="catalogue size factor")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds")
+    parser.add_argument("--bandwidth", type=float, help="MB/s per transfer")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", metavar="JSON", help="results of a previous run")
+    parser.add_argument(
+        "--threshold", type=float, default=10, help="allowed regression, in percent"
+    )
+    parser.add_argument("--track-workers", type=int, default=1)
+    parser.add_argument("--max-inflight-releases", type=int, default=1)
+    parser.add_argument("--max-inflight-tracks", type=int)
+    parser.add_argument("--segments", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario: {name}")
+
+    options = {
+        "track_workers": args.track_workers,
+        "max_inflight_releases": args.max_inflight_releases,
+        "max_inflight_tracks": args.max_inflight_tracks,
+        "segments": args.segments,
+    }
+    results = {
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "fake_qobuz": VERSION,
+        "settings": {
+            "scale": args.scale,
+            "latency": args.latency,
+            "bandwidth": args.bandwidth,
+            **options,
+        },
+        "scenarios": {},
+    }
+    print(f"{'':14}{'wall s':>9}{'MB/s':>9}{'calls/rel':>11}{'RSS MB':>9}{'CPU s':>8}")
+    for name in args.scenarios or SCENARIOS:
+        metrics = run_scenario(name, args, options)
+        results["scenarios"][name] = metrics
+        print(
+            f"{name:14}{metrics['wall_s']:>9.2f}{metrics['mb_s']:>9.1f}"
+            f"{metrics['api_calls_per_release']:>11.2f}"
+            f"{metrics['peak_rss_mb'] or 0:>9.1f}{metrics['cpu_s'] or 0:>8.2f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("fake_qobuz") != VERSION:
+            sys.exit(f"\n{args.compare} was recorded against another fake_qobuz")
+        if baseline.get("settings") != results["settings"]:
+            sys.exit(f"\n{args.compare} was recorded with other settings")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            sys.exit(f"\nRegressions over {args.threshold}%: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""CPU cost of the download write path, in CPU seconds per GB.
+
+Compares the old `iter_content(chunk_size=1024)` loop (one write and one
+progress bar update per KiB) with `downloader.tqdm_download`. The payload
+is served by `python -m http.server` in a separate process, so only the
+client side is measured.
+
+    python benchmarks/write_path.py --size 512 --runs 3
+"""
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from qobuz_dl.downloader import tqdm_download  # noqa: E402
+
+GB = 1024**3
+
+
+def legacy_download(url, fname, desc):
+    "The write path of tqdm_download before the buffer rework"
+    r = requests.get(url, allow_redirects=True, stream=True)
+    total = int(r.headers.get("content-length", 0))
+    with open(fname, "wb") as file, tqdm(
+        total=total,
+        unit="iB",
+        unit_scale=True,
+        unit_divisor=1024,
+        desc=desc,
+    ) as bar:
+        for data in r.iter_content(chunk_size=1024):
+            size = file.write(data)
+            bar.update(size)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _measure(func, url, fname, size):
+    cpu, wall = time.process_time(), time.perf_counter()
+    func(url, fname, "bench")
+    cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+    assert os.path.getsize(fname) == size
+    os.remove(fname)
+    return cpu, wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=256, help="payload size in MB")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "payload.bin"), "wb") as f:
+            for _ in range(args.size):
+                f.write(os.urandom(1024 * 1024))
+
+        port = _free_port()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "http.server", str(port), "-b", "127.0.0.1"],
+            cwd=tmp,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            url = f"http://127.0.0.1:{port}/payload.bin"
+            for _ in range(50):
+                try:
+                    requests.head(url)
+                    break
+                except requests.exceptions.ConnectionError:
+                    time.sleep(0.1)
+
+            fname = os.path.join(tmp, "out.tmp")
+            results = {}
+            for name, func in (("before", legacy_download), ("after", tqdm_download)):
+                runs = [_measure(func, url, fname, size) for _ in range(args.runs)]
+                results[name] = min(runs)
+        finally:
+            server.terminate()
+
+    print(f"\n{'':8}{'CPU s/GB':>10}{'MB/s':>10}")
+    for name, (cpu, wall) in results.items():
+        print(f"{name:8}{cpu * GB / size:>10.2f}{size / wall / 1024**2:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
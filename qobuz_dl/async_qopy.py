@@ -0,0 +1,289 @@
+import asyncio
+import logging
+from collections import deque
+from itertools import islice
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from qobuz_dl.color import GREEN, YELLOW
+from qobuz_dl.exceptions import IneligibleError, InvalidAppSecretError
+from qobuz_dl.qopy import (
+    API_URL,
+    PAGE_RETRIES,
+    PAGE_SIZE,
+    PAGE_WORKERS,
+    RESET,
+    USER_AGENT,
+    check_status,
+    request_params,
+)
+from qobuz_dl.records import loads
+
+# connections of the shared pool, i.e. requests in flight at the same time
+DEFAULT_CONNECTIONS = 100
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncClient:
+    """asyncio counterpart of qopy.Client, for crawls that keep hundreds of
+    metadata requests in flight from a single thread.
+
+    Requests are signed like qopy.Client's and share one aiohttp connection
+    pool. Paginated endpoints (`get_artist_meta`, `get_plist_meta` and
+    `get_label_meta`) are async iterators. Entering the client logs in (or
+    restores the session of `session_store`) and finds a working secret:
+
+        async with AsyncClient(email, pwd, app_id, secrets) as client:
+            album = await client.get_album_meta(album_id)
+            async for page in client.get_label_meta(label_id):
+                ...
+
+    Needs aiohttp: pip install qobuz-dl[async]
+    """
+
+    def __init__(
+        self,
+        email,
+        pwd,
+        app_id,
+        secrets,
+        connections=DEFAULT_CONNECTIONS,
+        cache=None,
+        session_store=None,
+        api_url=API_URL,
+    ):
+        if aiohttp is None:
+            raise ImportError("AsyncClient needs aiohttp: pip install qobuz-dl[async]")
+        self.secrets = secrets
+        self.id = str(app_id)
+        self.connections = connections
+        self.base = api_url
+        self.uat = None
+        self.sec = None
+        self.label = None
+        # optional cache.MetadataCache and credentials.SessionStore
+        self.cache = cache
+        self.session_store = session_store
+        self.page_workers = PAGE_WORKERS
+        self._email = email
+        self._pwd = pwd
+        self._session = None
+        self._renew_lock = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def start(self):
+        logger.info(f"{YELLOW}Logging...")
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.connections),
+            headers={
+                "User-Agent": USER_AGENT,
+                "X-App-Id": self.id,
+                "Content-Type": "application/json;charset=UTF-8",
+            },
+        )
+        self._renew_lock = asyncio.Lock()
+        if not self._restore_session():
+            await self.auth(self._email, self._pwd)
+            await self.cfg_setup()
+            self._save_session()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def api_call(self, epoint, **kwargs):
+        # logins and secret probes are never retried
+        if epoint == "user/login" or "sec" in kwargs:
+            return await self._request(epoint, **kwargs)
+
+        # an expired token and a rejected secret are renewed once each
+        renewed = set()
+        while True:
+            uat, sec = self.uat, self.sec
+            try:
+                return await self._request(epoint, **kwargs)
+            except aiohttp.ClientResponseError as e:
+                if e.status != 401 or "login" in renewed:
+                    raise
+                renewed.add("login")
+                await self._renew_login(uat)
+            except InvalidAppSecretError:
+                if sec is None or "secret" in renewed:
+                    raise
+                renewed.add("secret")
+                await self._renew_secret(sec)
+
+    async def _request(self, epoint, **kwargs):
+        params = request_params(epoint, self.id, self.uat, self.sec, **kwargs)
+        if self.cache is not None:
+            cached = self.cache.get(epoint, params)
+            if cached is not None:
+                return cached
+        headers = {"X-User-Auth-Token": self.uat} if self.uat else None
+        async with self._session.get(
+            self.base + epoint,
+            params={key: str(value) for key, value in params.items()},
+            headers=headers,
+        ) as r:
+            body = await r.read()
+            check_status(epoint, r.status, lambda: loads(body))
+            r.raise_for_status()
+        response = loads(body)
+        if self.cache is not None:
+            self.cache.set(epoint, params, response)
+        return response
+
+    async def auth(self, email, pwd):
+        usr_info = await self.api_call("user/login", email=email, pwd=pwd)
+        if not usr_info["user"]["credential"]["parameters"]:
+            raise IneligibleError("Free accounts are not eligible to download tracks.")
+        self.uat = usr_info["user_auth_token"]
+        self.label = usr_info["user"]["credential"]["parameters"]["short_label"]
+        logger.info(f"{GREEN}Membership: {self.label}")
+
+    def _restore_session(self):
+        if self.session_store is None:
+            return False
+        session = self.session_store.load(self._email, self._pwd, self.id)
+        if session is None:
+            return False
+        self.uat = session["user_auth_token"]
+        self.sec = session["secret"]
+        self.label = session.get("label")
+        logger.info(f"{GREEN}Logged: OK (saved session)")
+        return True
+
+    def _save_session(self):
+        if self.session_store is not None:
+            self.session_store.save(
+                self._email, self._pwd, self.id, self.uat, self.sec, self.label
+            )
+
+    async def _renew_login(self, stale_uat):
+        async with self._renew_lock:
+            if self.uat != stale_uat:
+                return
+            logger.info(f"{YELLOW}Session expired, logging in again...")
+            await self.auth(self._email, self._pwd)
+            self._save_session()
+
+    async def _renew_secret(self, stale_sec):
+        async with self._renew_lock:
+            if self.sec != stale_sec:
+                return
+            logger.info(f"{YELLOW}App secret rejected, probing secrets again...")
+            await self.cfg_setup()
+            self._save_session()
+
+    async def multi_meta(self, epoint, key, id, type):
+        """Yield every page of a paginated endpoint, in offset order, with up
+        to `page_workers` pages in flight after the first one."""
+        first = await self._get_page(epoint, id, 0, type)
+        yield first
+        offsets = iter(range(PAGE_SIZE, first[key], PAGE_SIZE))
+        window = deque(
+            asyncio.ensure_future(self._get_page(epoint, id, offset, type))
+            for offset in islice(offsets, max(1, self.page_workers))
+        )
+        try:
+            while window:
+                page = await window.popleft()
+                offset = next(offsets, None)
+                if offset is not None:
+                    window.append(
+                        asyncio.ensure_future(self._get_page(epoint, id, offset, type))
+                    )
+                yield page
+        finally:
+            for task in window:
+                task.cancel()
+
+    async def _get_page(self, epoint, id, offset, type):
+        "Get one page, retrying it on its own if it fails"
+        for attempt in range(PAGE_RETRIES + 1):
+            try:
+                j = await self.api_call(epoint, id=id, offset=offset, type=type)
+                return j[type] if type in ["tracks", "albums"] else j
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status = getattr(e, "status", None)
+                retry = status is None or status == 429 or status >= 500
+                if not retry or attempt == PAGE_RETRIES:
+                    raise
+                logger.debug(f"Retrying {epoint} at offset {offset}: {e}")
+                await asyncio.sleep(2**attempt)
+
+    async def get_album_meta(self, id):
+        return await self.api_call("album/get", id=id)
+
+    async def get_track_meta(self, id):
+        return await self.api_call("track/get", id=id)
+
+    async def get_track_url(self, id, fmt_id):
+        return await self.api_call("track/getFileUrl", id=id, fmt_id=fmt_id)
+
+    def get_artist_meta(self, id):
+        return self.multi_meta("artist/get", "albums_count", id, None)
+
+    def get_plist_meta(self, id):
+        return self.multi_meta("playlist/get", "tracks_count", id, None)
+
+    def get_label_meta(self, id):
+        return self.multi_meta("label/get", "albums_count", id, None)
+
+    async def search_albums(self, query, limit):
+        return await self.api_call("album/search", query=query, limit=limit)
+
+    async def search_artists(self, query, limit):
+        return await self.api_call("artist/search", query=query, limit=limit)
+
+    async def search_playlists(self, query, limit):
+        return await self.api_call("playlist/search", query=query, limit=limit)
+
+    async def search_tracks(self, query, limit):
+        return await self.api_call("track/search", query=query, limit=limit)
+
+    async def get_favorite_albums(self, offset, limit):
+        return await self.api_call(
+            "favorite/getUserFavorites", type="albums", offset=offset, limit=limit
+        )
+
+    async def get_favorite_tracks(self, offset, limit):
+        return await self.api_call(
+            "favorite/getUserFavorites", type="tracks", offset=offset, limit=limit
+        )
+
+    async def get_favorite_artists(self, offset, limit):
+        return await self.api_call(
+            "favorite/getUserFavorites", type="artists", offset=offset, limit=limit
+        )
+
+    async def get_user_playlists(self, limit):
+        return await self.api_call("playlist/getUserPlaylists", limit=limit)
+
+    async def test_secret(self, sec):
+        try:
+            await self.api_call("track/getFileUrl", id=5966783, fmt_id=5, sec=sec)
+            return True
+        except InvalidAppSecretError:
+            return False
+
+    async def cfg_setup(self):
+        # Falsy secrets
+        secrets = [secret for secret in self.secrets if secret]
+        # probed at the same time; the first valid one, in order, wins
+        valid = await asyncio.gather(*(self.test_secret(secret) for secret in secrets))
+        self.sec = next((secret for secret, ok in zip(secrets, valid) if ok), None)
+
+        if self.sec is None:
+            raise InvalidAppSecretError("Can't find any valid app secret.\n" + RESET)
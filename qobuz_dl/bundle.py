@@ -1,5 +1,7 @@
 import base64
+import json
 import logging
+import os
 import re
 from collections import OrderedDict
 
@@ -28,11 +30,27 @@ _BUNDLE_URL_REGEX = re.compile(
 
 
 class Bundle:
-    def __init__(self):
+    """App ID and secrets of the web player, read from its bundle.js.
+
+    With `cache_path`, the bundle URL, its validators and the extracted
+    tokens are kept in a JSON file. The bundle URL is versioned, so while it
+    doesn't change the multi-megabyte bundle is only revalidated with a
+    conditional GET, and the tokens are read from the cache.
+
+    :param str cache_path: JSON file for the cached tokens
+    :param str base_url: web player URL, e.g. of a local stand-in
+    """
+
+    def __init__(self, cache_path=None, base_url=None):
         self._session = Session()
+        self._base_url = base_url or _BASE_URL
+        self._cache_path = cache_path
+        self._bundle = None
+        self._app_id = None
+        self._secrets = None
 
         logger.debug("Getting logging page")
-        response = self._session.get(f"{_BASE_URL}/login")
+        response = self._session.get(f"{self._base_url}/login")
         response.raise_for_status()
 
         bundle_url_match = _BUNDLE_URL_REGEX.search(response.text)
@@ -40,21 +58,73 @@ class Bundle:
             raise NotImplementedError("Bundle URL found")
 
         bundle_url = bundle_url_match.group(1)
+        cached = self._load_cache(bundle_url)
+        headers = {}
+        if cached is not None:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
 
         logger.debug("Getting bundle")
-        response = self._session.get(_BASE_URL + bundle_url)
+        response = self._session.get(self._base_url + bundle_url, headers=headers)
+        if cached is not None and response.status_code == 304:
+            logger.debug("Bundle not modified, using the cached tokens")
+            self._app_id = cached["app_id"]
+            self._secrets = OrderedDict(cached["secrets"])
+            return
         response.raise_for_status()
 
         self._bundle = response.text
+        if cache_path is not None:
+            self._save_cache(
+                {
+                    "url": bundle_url,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "app_id": self.get_app_id(),
+                    "secrets": list(self.get_secrets().items()),
+                }
+            )
+
+    def _load_cache(self, bundle_url):
+        if self._cache_path is None:
+            return None
+        try:
+            with open(self._cache_path, "r") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(cached, dict) or cached.get("url") != bundle_url:
+            return None
+        if not cached.get("app_id") or not cached.get("secrets"):
+            return None
+        return cached
+
+    def _save_cache(self, cached):
+        tmp = f"{self._cache_path}.new"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(cached, f)
+            os.replace(tmp, self._cache_path)
+        except OSError as e:
+            logger.debug(f"Couldn't cache the bundle tokens: {e}")
 
     def get_app_id(self):
+        if self._app_id is not None:
+            return self._app_id
+
         match = _APP_ID_REGEX.search(self._bundle)
         if not match:
             raise NotImplementedError("Failed to match APP ID")
 
-        return match.group("app_id")
+        self._app_id = match.group("app_id")
+        return self._app_id
 
     def get_secrets(self):
+        if self._secrets is not None:
+            return OrderedDict(self._secrets)
+
         logger.debug("Getting secrets")
         seed_matches = _SEED_TIMEZONE_REGEX.finditer(self._bundle)
         secrets = OrderedDict()
@@ -76,4 +146,5 @@ class Bundle:
             secrets[secret_pair] = base64.standard_b64decode(
                 "".join(secrets[secret_pair])[:-44]
             ).decode("utf-8")
-        return secrets
+        self._secrets = secrets
+        return OrderedDict(secrets)
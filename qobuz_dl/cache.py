@@ -0,0 +1,166 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from urllib.parse import urlencode
+
+from qobuz_dl.color import YELLOW
+from qobuz_dl.records import loads
+
+logger = logging.getLogger(__name__)
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+# seconds an API response stays valid, per endpoint. Endpoints that
+# aren't listed here are never cached
+DEFAULT_TTLS = {
+    "album/get": 7 * DAY,
+    "track/get": 7 * DAY,
+    "artist/get": DAY,
+    "label/get": DAY,
+    "playlist/get": HOUR,
+}
+# signed or user-specific endpoints are never cached, whatever the TTLs say
+NEVER_CACHED = ("track/getFileUrl", "favorite/", "user/", "playlist/getUser")
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+# access times are only refreshed when older than this, to avoid a write
+# for every cache hit
+ACCESS_GRANULARITY = HOUR
+
+
+class MetadataCache:
+    """On-disk cache of API responses, keyed by endpoint and parameters.
+
+    Entries are zlib-compressed JSON in a SQLite file. Each endpoint has its
+    own TTL and the least recently used entries are evicted once the file
+    holds more than `max_size` bytes of data. The file contains nothing but
+    JSON, so it can be shared between hosts: open it with `read_only` on
+    every host but the one that fills it. It uses a rollback journal rather
+    than WAL, which needs shared memory and doesn't work on network
+    filesystems or for read-only connections.
+
+    :param str path: SQLite file
+    :param dict ttls: TTLs per endpoint, overriding DEFAULT_TTLS
+    :param int max_size: bytes of compressed data kept
+    :param bool refresh: don't read cached responses, only store new ones
+    :param bool read_only: don't store or evict anything
+    """
+
+    def __init__(
+        self,
+        path,
+        ttls=None,
+        max_size=DEFAULT_MAX_SIZE,
+        refresh=False,
+        read_only=False,
+    ):
+        self.path = path
+        self.ttls = {**DEFAULT_TTLS, **(ttls or {})}
+        self.max_size = max_size
+        self.refresh = refresh
+        self.read_only = read_only
+        self._lock = threading.Lock()
+        if read_only:
+            self._conn = sqlite3.connect(
+                f"file:{path}?mode=ro", uri=True, check_same_thread=False
+            )
+            self._size = 0
+            return
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            # also converts caches created in WAL mode
+            self._conn.execute("PRAGMA journal_mode=DELETE")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, "
+                "endpoint TEXT NOT NULL, created REAL NOT NULL, "
+                "accessed REAL NOT NULL, size INTEGER NOT NULL, data BLOB NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)"
+            )
+        self._size = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+        logger.debug(f"{YELLOW}Metadata cache: {path} ({self._size} bytes)")
+
+    def cacheable(self, epoint):
+        return epoint in self.ttls and not epoint.startswith(NEVER_CACHED)
+
+    @staticmethod
+    def key(epoint, params):
+        return f"{epoint}?{urlencode(sorted(params.items()))}"
+
+    def get(self, epoint, params):
+        "Return the cached response, or None if it's missing or expired"
+        if self.refresh or not self.cacheable(epoint):
+            return None
+
+        key = self.key(epoint, params)
+        now = time.time()
+        with self._lock:
+            try:
+                row = self._conn.execute(
+                    "SELECT created, accessed, data FROM responses WHERE key=?",
+                    (key,),
+                ).fetchone()
+            except sqlite3.Error as e:
+                logger.debug(f"Metadata cache error: {e}")
+                return None
+            if row is None:
+                return None
+            created, accessed, data = row
+            if now - created > self.ttls[epoint]:
+                return None
+            if not self.read_only and now - accessed > ACCESS_GRANULARITY:
+                with self._conn:
+                    self._conn.execute(
+                        "UPDATE responses SET accessed=? WHERE key=?", (now, key)
+                    )
+        return loads(zlib.decompress(data))
+
+    def set(self, epoint, params, response):
+        if self.read_only or not self.cacheable(epoint):
+            return
+
+        data = zlib.compress(json.dumps(response, separators=(",", ":")).encode())
+        now = time.time()
+        with self._lock:
+            try:
+                with self._conn:
+                    old = self._conn.execute(
+                        "SELECT size FROM responses WHERE key=?",
+                        (self.key(epoint, params),),
+                    ).fetchone()
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                        (self.key(epoint, params), epoint, now, now, len(data), data),
+                    )
+                self._size += len(data) - (old[0] if old else 0)
+                if self._size > self.max_size:
+                    self._evict()
+            except sqlite3.Error as e:
+                logger.debug(f"Metadata cache error: {e}")
+
+    def _evict(self):
+        "Drop least recently used entries until 90% of `max_size` is left"
+        target = self.max_size * 0.9
+        with self._conn:
+            rows = self._conn.execute(
+                "SELECT key, size FROM responses ORDER BY accessed"
+            )
+            evicted = []
+            for key, size in rows:
+                if self._size <= target:
+                    break
+                evicted.append((key,))
+                self._size -= size
+            self._conn.executemany("DELETE FROM responses WHERE key=?", evicted)
+        logger.debug(f"Evicted {len(evicted)} entries from the metadata cache")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
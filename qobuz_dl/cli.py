@@ -2,14 +2,23 @@ import configparser
 import hashlib
 import logging
 import glob
+import json
 import os
+import sqlite3
 import sys
 
+import requests
+
 from qobuz_dl.bundle import Bundle
+from qobuz_dl.cache import MetadataCache
 from qobuz_dl.color import GREEN, RED, YELLOW
 from qobuz_dl.commands import qobuz_dl_args
 from qobuz_dl.core import QobuzDL
-from qobuz_dl.downloader import DEFAULT_FOLDER, DEFAULT_TRACK
+from qobuz_dl.credentials import SessionStore
+from qobuz_dl.downloader import DEFAULT_FOLDER, DEFAULT_TRACK, RESUME_SUFFIX
+from qobuz_dl.jobs import FAILED, JobQueue
+from qobuz_dl.library import LibraryIndex, index_library
+from qobuz_dl.server import DONE, DownloadServer, ServerClient
 
 logging.basicConfig(
     level=logging.INFO,
@@ -24,6 +33,11 @@ else:
 CONFIG_PATH = os.path.join(OS_CONFIG, "qobuz-dl")
 CONFIG_FILE = os.path.join(CONFIG_PATH, "config.ini")
 QOBUZ_DB = os.path.join(CONFIG_PATH, "qobuz_dl.db")
+METADATA_CACHE = os.path.join(CONFIG_PATH, "metadata_cache.db")
+SESSION_FILE = os.path.join(CONFIG_PATH, "session.json")
+BUNDLE_CACHE = os.path.join(CONFIG_PATH, "bundle.json")
+JOBS_DB = os.path.join(CONFIG_PATH, "jobs.db")
+LIBRARY_INDEX = os.path.join(CONFIG_PATH, "library.db")
 
 
 def _reset_config(config_file):
@@ -53,7 +67,7 @@ def _reset_config(config_file):
     config["DEFAULT"]["no_cover"] = "false"
     config["DEFAULT"]["no_database"] = "false"
     logging.info(f"{YELLOW}Getting tokens. Please wait...")
-    bundle = Bundle()
+    bundle = Bundle(BUNDLE_CACHE)
     config["DEFAULT"]["app_id"] = str(bundle.get_app_id())
     config["DEFAULT"]["secrets"] = ",".join(bundle.get_secrets().values())
     config["DEFAULT"]["folder_format"] = DEFAULT_FOLDER
@@ -61,6 +75,7 @@ def _reset_config(config_file):
     config["DEFAULT"]["smart_discography"] = "false"
     with open(config_file, "w") as configfile:
         config.write(configfile)
+    SessionStore(SESSION_FILE).clear()
     logging.info(
         f"{GREEN}Config file updated. Edit more options in {config_file}"
         "\nso you don't have to call custom flags every time you run "
@@ -69,18 +84,184 @@ def _reset_config(config_file):
 
 
 def _remove_leftovers(directory):
-    directory = os.path.join(directory, "**", ".*.tmp")
-    for i in glob.glob(directory, recursive=True):
+    # partial downloads with a resume sidecar are kept for the next run
+    pattern = os.path.join(directory, "**", ".*.tmp")
+    for i in glob.glob(pattern, recursive=True):
+        if os.path.isfile(i + RESUME_SUFFIX):
+            continue
         try:
             os.remove(i)
         except:  # noqa
             pass
 
 
+def _parse_host_pool_sizes(host_pool_sizes):
+    try:
+        return {
+            host.strip(): int(size)
+            for host, size in (i.rsplit("=", 1) for i in host_pool_sizes)
+        }
+    except ValueError:
+        sys.exit(f"{RED}Invalid --host-pool-size: use HOST=int")
+
+
+def _get_metadata_cache(arguments):
+    if not arguments.metadata_cache:
+        return None
+    path = (
+        METADATA_CACHE if arguments.metadata_cache is True else arguments.metadata_cache
+    )
+    try:
+        return MetadataCache(
+            path,
+            max_size=arguments.metadata_cache_size * 1024 * 1024,
+            refresh=arguments.refresh_metadata,
+            read_only=arguments.metadata_cache_read_only,
+        )
+    except sqlite3.Error as e:
+        logging.error(f"{RED}Can't open the metadata cache {path}: {e}")
+
+
+def _update_tokens(config, client, app_id, secrets):
+    # the client refreshes the tokens when the ones in the config are outdated
+    if client.id == app_id and client.secrets == secrets:
+        return
+    config["DEFAULT"]["app_id"] = client.id
+    config["DEFAULT"]["secrets"] = ",".join(client.secrets)
+    with open(CONFIG_FILE, "w") as configfile:
+        config.write(configfile)
+    logging.info(f"{GREEN}App tokens updated in {CONFIG_FILE}")
+
+
+def _get_job_queue(arguments):
+    if arguments.command != "dl":
+        return None
+    try:
+        return JobQueue(JOBS_DB)
+    except sqlite3.Error as e:
+        logging.error(f"{RED}Can't open the job queue {JOBS_DB}: {e}")
+
+
+def _check_sources(arguments):
+    "A new run needs a SOURCE; --resume and --retry-failed run the last one"
+    if arguments.resume or arguments.retry_failed:
+        if arguments.SOURCE:
+            sys.exit(
+                f"{RED}--resume and --retry-failed continue the last run: "
+                "don't give a SOURCE"
+            )
+    elif not arguments.SOURCE:
+        sys.exit(f"{RED}Nothing to download: give a SOURCE or use --resume")
+
+
+def _report_jobs(job_queue):
+    counts = job_queue.counts()
+    failed = counts.get(FAILED, 0)
+    if failed:
+        logging.info(
+            f"{RED}{failed} downloads failed. Run 'qobuz-dl dl --retry-failed' "
+            "to try them again."
+        )
+
+
+def _get_library_index(no_database):
+    # only once 'qobuz-dl index' created it
+    if no_database or not os.path.isfile(LIBRARY_INDEX):
+        return None
+    try:
+        return LibraryIndex(LIBRARY_INDEX)
+    except sqlite3.Error as e:
+        logging.error(f"{RED}Can't open the library index {LIBRARY_INDEX}: {e}")
+
+
+def _index(arguments):
+    for directory in arguments.DIRECTORY:
+        if not os.path.isdir(directory):
+            sys.exit(f"{RED}Not a directory: {directory}")
+    try:
+        index = LibraryIndex(LIBRARY_INDEX)
+    except sqlite3.Error as e:
+        sys.exit(f"{RED}Can't open the library index {LIBRARY_INDEX}: {e}")
+    try:
+        for directory in arguments.DIRECTORY:
+            index_library(index, directory, arguments.workers)
+    except KeyboardInterrupt:
+        logging.info(f"{RED}Interrupted by user")
+    finally:
+        index.close()
+
+
+def _read_sources(sources):
+    urls = []
+    for source in sources:
+        if "last.fm" not in source and os.path.isfile(source):
+            with open(source, "r") as txt:
+                urls += [
+                    line.strip()
+                    for line in txt
+                    if line.strip() and not line.strip().startswith("#")
+                ]
+        else:
+            urls.append(source)
+    return urls
+
+
+def _submit(arguments):
+    client = ServerClient(arguments.server)
+    try:
+        if arguments.stats:
+            print(json.dumps(client.stats(), indent=2))
+        elif arguments.cancel:
+            client.cancel(int(arguments.cancel))
+            logging.info(f"{GREEN}Job {arguments.cancel} cancelled")
+        elif arguments.status:
+            jobs = (
+                client.status()
+                if arguments.status == "all"
+                else [client.status(int(arguments.status))]
+            )
+            for job in jobs:
+                logging.info(f"{job['id']}: {job['state']} - {' '.join(job['urls'])}")
+        else:
+            urls = _read_sources(arguments.SOURCE)
+            if not urls:
+                sys.exit(f"{RED}Nothing to submit")
+            job = client.enqueue(urls)
+            logging.info(f"{YELLOW}Job {job['id']} queued ({len(urls)} URLs)")
+            if arguments.no_wait:
+                return
+            job = client.follow(job["id"], echo=logging.info)
+            if job["state"] != DONE:
+                sys.exit(f"{RED}Job {job['id']} {job['state']}: {job['error']}")
+    except ValueError:
+        sys.exit(f"{RED}Invalid job ID")
+    except requests.exceptions.ConnectionError:
+        sys.exit(f"{RED}Can't reach 'qobuz-dl serve' at {arguments.server}")
+    except requests.exceptions.HTTPError as e:
+        sys.exit(f"{RED}{e}")
+    except KeyboardInterrupt:
+        logging.info(f"{YELLOW}Stopped following; the job keeps running")
+
+
 def _handle_commands(qobuz, arguments):
     try:
         if arguments.command == "dl":
-            qobuz.download_list_of_urls(arguments.SOURCE)
+            if arguments.resume or arguments.retry_failed:
+                if qobuz.job_queue is None:
+                    sys.exit(f"{RED}The job queue isn't available: nothing to resume")
+                qobuz.resume_jobs(retry_failed=arguments.retry_failed)
+            elif qobuz.job_queue is None:
+                qobuz.download_list_of_urls(arguments.SOURCE)
+            else:
+                # a new run replaces the recorded one
+                qobuz.job_queue.clear()
+                qobuz.download_list_of_urls(arguments.SOURCE)
+            if qobuz.job_queue is not None:
+                _report_jobs(qobuz.job_queue)
+        elif arguments.command == "serve":
+            DownloadServer(
+                qobuz, arguments.host, arguments.port, arguments.workers
+            ).serve_forever()
         elif arguments.command == "lucky":
             query = " ".join(arguments.QUERY)
             qobuz.lucky_type = arguments.type
@@ -91,12 +272,19 @@ def _handle_commands(qobuz, arguments):
             qobuz.interactive()
 
     except KeyboardInterrupt:
+        qobuz.scheduler.cancel()
         logging.info(
             f"{RED}Interrupted by user\n{YELLOW}Already downloaded items will "
             "be skipped if you try to download the same releases again."
         )
+        if qobuz.job_queue is not None:
+            logging.info(f"{YELLOW}Run 'qobuz-dl dl --resume' to continue.")
 
     finally:
+        if qobuz.downloads_db is not None:
+            qobuz.downloads_db.close()
+        if qobuz.library_index is not None:
+            qobuz.library_index.close()
         _remove_leftovers(qobuz.directory)
 
 
@@ -151,18 +339,34 @@ def main():
         sys.exit(_reset_config(CONFIG_FILE))
 
     if arguments.show_config:
-        print(f"Configuation: {CONFIG_FILE}\nDatabase: {QOBUZ_DB}\n---")
+        print(
+            f"Configuation: {CONFIG_FILE}\nDatabase: {QOBUZ_DB}\n"
+            f"Library index: {LIBRARY_INDEX}\n---"
+        )
         with open(CONFIG_FILE, "r") as f:
             print(f.read())
         sys.exit()
 
     if arguments.purge:
-        try:
-            os.remove(QOBUZ_DB)
-        except FileNotFoundError:
-            pass
+        # with the write-ahead log of the database
+        for path in (QOBUZ_DB, QOBUZ_DB + "-wal", QOBUZ_DB + "-shm"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
         sys.exit(f"{GREEN}The database was deleted.")
 
+    if arguments.command == "submit":
+        # the server is logged in already
+        sys.exit(_submit(arguments))
+
+    if arguments.command == "index":
+        # reads local files only: no login
+        sys.exit(_index(arguments))
+
+    if arguments.command == "dl":
+        _check_sources(arguments)
+
     qobuz = QobuzDL(
         arguments.directory,
         arguments.quality,
@@ -176,10 +380,26 @@ def main():
         folder_format=arguments.folder_format or folder_format,
         track_format=arguments.track_format or track_format,
         smart_discography=arguments.smart_discography or smart_discography,
+        track_workers=arguments.track_workers,
+        max_inflight_releases=arguments.max_inflight_releases,
+        max_inflight_tracks=arguments.max_inflight_tracks,
+        segments=arguments.segments,
+        segment_threshold=arguments.segment_threshold * 1024 * 1024,
+        pool_size=arguments.pool_size,
+        host_pool_sizes=_parse_host_pool_sizes(arguments.host_pool_size),
+        metadata_cache=_get_metadata_cache(arguments),
+        prefetch_urls=arguments.prefetch_urls,
+        url_expiry_margin=arguments.url_expiry_margin,
+        page_workers=arguments.page_workers,
+        session_store=SessionStore(SESSION_FILE),
+        bundle_cache=BUNDLE_CACHE,
+        job_queue=_get_job_queue(arguments),
+        library_index=_get_library_index(no_database or arguments.no_db),
     )
     qobuz.initialize_client(email, password, app_id, secrets)
 
     _handle_commands(qobuz, arguments)
+    _update_tokens(config, qobuz.client, app_id, secrets)
 
 
 if __name__ == "__main__":
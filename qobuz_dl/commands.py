@@ -49,12 +49,103 @@ def dl_args(subparsers):
     download.add_argument(
         "SOURCE",
         metavar="SOURCE",
-        nargs="+",
+        nargs="*",
         help=("one or more URLs (space separated) or a text file"),
     )
+    download.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue the last interrupted run instead of starting a new one",
+    )
+    download.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="download the releases that failed in the last run again",
+    )
     return download
 
 
+def serve_args(subparsers):
+    serve = subparsers.add_parser(
+        "serve",
+        description="Stay logged in and download the jobs sent with "
+        "'qobuz-dl submit' (or to the local HTTP API).",
+        help="daemon mode",
+    )
+    serve.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="address to listen on; the API has no authentication (default: "
+        "127.0.0.1)",
+    )
+    serve.add_argument(
+        "--port", metavar="int", type=int, default=8765, help="(default: 8765)"
+    )
+    serve.add_argument(
+        "--workers",
+        metavar="int",
+        type=int,
+        default=2,
+        help="jobs downloaded at the same time (default: 2)",
+    )
+    return serve
+
+
+def submit_args(subparsers):
+    submit = subparsers.add_parser(
+        "submit",
+        description="Send URLs to a running 'qobuz-dl serve' and follow their "
+        "download.",
+        help="client of the daemon mode",
+    )
+    submit.add_argument(
+        "SOURCE",
+        nargs="*",
+        help="one or more URLs (space separated) or a text file",
+    )
+    submit.add_argument(
+        "--server",
+        metavar="URL",
+        default="http://127.0.0.1:8765",
+        help="(default: http://127.0.0.1:8765)",
+    )
+    submit.add_argument(
+        "--no-wait",
+        action="store_true",
+        help="return once the job is queued instead of following its progress",
+    )
+    submit.add_argument(
+        "--status",
+        metavar="ID",
+        nargs="?",
+        const="all",
+        help="show a job (or every job) instead of submitting one",
+    )
+    submit.add_argument("--cancel", metavar="ID", help="cancel a queued job")
+    submit.add_argument("--stats", action="store_true", help="show server stats")
+    return submit
+
+
+def index_args(subparsers):
+    index = subparsers.add_parser(
+        "index",
+        description="Index the FLAC and MP3 files of an existing library, so "
+        "the releases and tracks already in it aren't downloaded again. Only "
+        "new and changed files are read on later runs.",
+        help="library indexing mode",
+    )
+    index.add_argument(
+        "DIRECTORY", nargs="+", help="one or more library directories to index"
+    )
+    index.add_argument(
+        "--workers",
+        metavar="int",
+        type=int,
+        help="files read at the same time (default: number of CPUs)",
+    )
+    return index
+
+
 def add_common_arg(custom_parser, default_folder, default_quality):
     custom_parser.add_argument(
         "-d",
@@ -100,7 +191,9 @@ def add_common_arg(custom_parser, default_folder, default_quality):
         "--no-cover", action="store_true", help="don't download cover art"
     )
     custom_parser.add_argument(
-        "--no-db", action="store_true", help="don't call the database"
+        "--no-db",
+        action="store_true",
+        help="don't call the database (or the library index)",
     )
     custom_parser.add_argument(
         "-ff",
@@ -117,6 +210,104 @@ def add_common_arg(custom_parser, default_folder, default_quality):
         metavar="PATTERN",
         help="pattern for formatting track names. see `folder-format`.",
     )
+    custom_parser.add_argument(
+        "--track-workers",
+        metavar="int",
+        type=int,
+        default=1,
+        help="number of tracks of a release downloaded in parallel (default: 1)",
+    )
+    custom_parser.add_argument(
+        "--max-inflight-releases",
+        metavar="int",
+        type=int,
+        default=1,
+        help="number of releases downloaded at the same time across the whole "
+        "queue (default: 1)",
+    )
+    custom_parser.add_argument(
+        "--max-inflight-tracks",
+        metavar="int",
+        type=int,
+        help="number of tracks downloaded at the same time across the whole "
+        "queue (default: --track-workers per release)",
+    )
+    custom_parser.add_argument(
+        "--segments",
+        metavar="int",
+        type=int,
+        default=1,
+        help="download large files over this many ranged connections (default: 1)",
+    )
+    custom_parser.add_argument(
+        "--segment-threshold",
+        metavar="MB",
+        type=int,
+        default=64,
+        help="minimum size of a file downloaded in segments (default: 64)",
+    )
+    custom_parser.add_argument(
+        "--pool-size",
+        metavar="int",
+        type=int,
+        help="connections kept alive per host (default: enough for every "
+        "download in flight, at least 10)",
+    )
+    custom_parser.add_argument(
+        "--host-pool-size",
+        metavar="HOST=int",
+        action="append",
+        default=[],
+        help="connections kept alive for a specific file host; can be repeated",
+    )
+    custom_parser.add_argument(
+        "--prefetch-urls",
+        metavar="int",
+        type=int,
+        default=2,
+        help="track URLs signed ahead of the track being downloaded (default: 2)",
+    )
+    custom_parser.add_argument(
+        "--url-expiry-margin",
+        metavar="SECONDS",
+        type=int,
+        default=30,
+        help="sign prefetched URLs again when they are this close to their "
+        "expiry (default: 30)",
+    )
+    custom_parser.add_argument(
+        "--page-workers",
+        metavar="int",
+        type=int,
+        default=4,
+        help="pages of artists, labels and playlists fetched at the same time "
+        "(default: 4)",
+    )
+    custom_parser.add_argument(
+        "--metadata-cache",
+        metavar="PATH",
+        nargs="?",
+        const=True,
+        help="cache album, track, artist, label and playlist metadata on disk "
+        "(default path: next to the config file)",
+    )
+    custom_parser.add_argument(
+        "--metadata-cache-size",
+        metavar="MB",
+        type=int,
+        default=512,
+        help="maximum size of the metadata cache (default: 512)",
+    )
+    custom_parser.add_argument(
+        "--metadata-cache-read-only",
+        action="store_true",
+        help="use the metadata cache without writing to it (e.g. when shared)",
+    )
+    custom_parser.add_argument(
+        "--refresh-metadata",
+        action="store_true",
+        help="ignore cached metadata and fetch it again",
+    )
     # TODO: add customization options
     custom_parser.add_argument(
         "-s",
@@ -165,9 +356,12 @@ def qobuz_dl_args(
     interactive = fun_args(subparsers, default_limit)
     download = dl_args(subparsers)
     lucky = lucky_args(subparsers)
+    serve = serve_args(subparsers)
+    submit_args(subparsers)
+    index_args(subparsers)
     [
         add_common_arg(i, default_folder, default_quality)
-        for i in (interactive, download, lucky)
+        for i in (interactive, download, lucky, serve)
     ]
 
     return parser
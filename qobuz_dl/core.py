@@ -1,16 +1,20 @@
 import logging
 import os
 import sys
+from concurrent.futures import wait
+from itertools import chain
 
 import requests
 from bs4 import BeautifulSoup as bso
 from pathvalidate import sanitize_filename
 
 from qobuz_dl.bundle import Bundle
-from qobuz_dl import downloader, qopy
+from qobuz_dl import downloader, qopy, sessions
 from qobuz_dl.color import CYAN, OFF, RED, YELLOW, DF, RESET
-from qobuz_dl.exceptions import NonStreamable
-from qobuz_dl.db import create_db, handle_download_id
+from qobuz_dl.exceptions import Cancelled, NonStreamable
+from qobuz_dl.db import DownloadsDB
+from qobuz_dl.jobs import DONE, FAILED, UNFINISHED
+from qobuz_dl.scheduler import Registry, Scheduler
 from qobuz_dl.utils import (
     get_url_info,
     make_m3u,
@@ -52,6 +56,23 @@ class QobuzDL:
         "{sampling_rate}kHz]",
         track_format="{tracknumber}. {tracktitle}",
         smart_discography=False,
+        track_workers=1,
+        max_inflight_releases=1,
+        max_inflight_tracks=None,
+        segments=1,
+        segment_threshold=downloader.SEGMENT_THRESHOLD,
+        pool_size=None,
+        host_pool_sizes=None,
+        metadata_cache=None,
+        prefetch_urls=2,
+        url_expiry_margin=qopy.URL_EXPIRY_MARGIN,
+        page_workers=qopy.PAGE_WORKERS,
+        session_store=None,
+        bundle_cache=None,
+        api_url=qopy.API_URL,
+        player_url=None,
+        job_queue=None,
+        library_index=None,
     ):
         self.directory = create_and_return_dir(directory)
         self.quality = quality
@@ -64,30 +85,139 @@ class QobuzDL:
         self.quality_fallback = quality_fallback
         self.cover_og_quality = cover_og_quality
         self.no_cover = no_cover
-        self.downloads_db = create_db(downloads_db) if downloads_db else None
+        self.downloads_db = DownloadsDB(downloads_db) if downloads_db else None
         self.folder_format = folder_format
         self.track_format = track_format
         self.smart_discography = smart_discography
+        self.track_workers = track_workers
+        self.scheduler = Scheduler(max_inflight_releases, max_inflight_tracks)
+        # releases and tracks scheduled in the current run
+        self.registry = Registry()
+        self.segments = segments
+        self.segment_threshold = segment_threshold
+        # keep a connection alive for every download that can be in flight
+        self.pool_size = pool_size or max(
+            sessions.DEFAULT_POOL_SIZE,
+            (max_inflight_tracks or max(1, max_inflight_releases) * track_workers)
+            * segments,
+        )
+        sessions.configure(self.pool_size, host_pool_sizes)
+        # optional cache.MetadataCache for API responses
+        self.metadata_cache = metadata_cache
+        self.prefetch_urls = prefetch_urls
+        self.url_expiry_margin = url_expiry_margin
+        self.page_workers = page_workers
+        # optional credentials.SessionStore to reuse the login between runs
+        self.session_store = session_store
+        # JSON file with the tokens of the last web player bundle
+        self.bundle_cache = bundle_cache
+        # API and web player to use instead of Qobuz's, e.g. a local stand-in
+        self.api_url = api_url
+        self.player_url = player_url
+        # optional jobs.JobQueue recording the run, so it can be resumed
+        self.job_queue = job_queue
+        self._job_states = UNFINISHED
+        # optional library.LibraryIndex of the files already in the library
+        self.library_index = library_index
 
     def initialize_client(self, email, pwd, app_id, secrets):
-        self.client = qopy.Client(email, pwd, app_id, secrets)
+        self.client = qopy.Client(
+            email,
+            pwd,
+            app_id,
+            secrets,
+            self.pool_size,
+            self.metadata_cache,
+            self.session_store,
+            self.bundle_cache,
+            self.api_url,
+            self.player_url,
+        )
+        self.client.url_expiry_margin = self.url_expiry_margin
+        self.client.page_workers = self.page_workers
         logger.info(f"{YELLOW}Set max quality: {QUALITIES[int(self.quality)]}\n")
 
     def get_tokens(self):
-        bundle = Bundle()
+        bundle = Bundle(self.bundle_cache, self.player_url)
         self.app_id = bundle.get_app_id()
         self.secrets = [
             secret for secret in bundle.get_secrets().values() if secret
         ]  # avoid empty fields
 
-    def download_from_id(self, item_id, album=True, alt_path=None):
-        if handle_download_id(self.downloads_db, item_id, add_id=False):
+    def download_from_id(
+        self, item_id, album=True, alt_path=None, job=None, release_id=None
+    ):
+        """Schedule the download of a release (or track) ID. The download runs
+        inline unless `max_inflight_releases` is greater than 1; in that
+        case, call `self.scheduler.join()` to wait for it.
+
+        IDs already scheduled in the same run are skipped, and so are
+        tracks saved by the download of their album in the same run.
+
+        :param int job: ID of the item in `job_queue` to update
+        :param str release_id: album of the track
+        :returns: a Future for the download (or for the download it
+        duplicates), None if it was skipped
+        """
+        duplicate = self.registry.claim(item_id, album)
+        if duplicate is not None:
+            if job is not None:
+                self.job_queue.finish(job)
+            return duplicate
+        release = None if album else self.registry.release(release_id)
+        future = None
+        try:
+            future = self._schedule(item_id, album, alt_path, job, release)
+        finally:
+            self.registry.scheduled(item_id, album, future)
+        return future
+
+    def _schedule(self, item_id, album, alt_path, job, release=None):
+        if self.downloads_db is not None and item_id in self.downloads_db:
             logger.info(
                 f"{OFF}This release ID ({item_id}) was already downloaded "
                 "according to the local database.\nUse the '--no-db' flag "
                 "to bypass this."
             )
+            if job is not None:
+                self.job_queue.finish(job)
             return
+        if self._in_library(item_id, album):
+            logger.info(
+                f"{OFF}This {'release' if album else 'track'} ID ({item_id}) "
+                "is already in the library index.\nUse the '--no-db' flag to "
+                "bypass this."
+            )
+            if job is not None:
+                self.job_queue.finish(job)
+            return
+        if release is not None:
+            return self.scheduler.submit(
+                self._download_after_release, release, item_id, alt_path, job
+            )
+        return self.scheduler.submit(self._download_id, item_id, album, alt_path, job)
+
+    def _download_after_release(self, release, item_id, alt_path, job=None):
+        """Download a track once the download of its album is done, unless
+        that one saved it (the album may have been skipped, or failed)"""
+        release.result()
+        if self.registry.downloaded_with(item_id):
+            if job is not None:
+                self.job_queue.finish(job)
+            return
+        self._download_id(item_id, False, alt_path, job)
+
+    def _in_library(self, item_id, album):
+        if self.library_index is None:
+            return False
+        lossless = int(self.quality) != 5
+        if album:
+            return self.library_index.has_release(item_id, lossless)
+        return self.library_index.has_track(item_id, lossless)
+
+    def _download_id(self, item_id, album, alt_path, job=None):
+        if job is not None:
+            self.job_queue.start(job)
         try:
             dloader = downloader.Download(
                 self.client,
@@ -101,25 +231,70 @@ class QobuzDL:
                 self.no_cover,
                 self.folder_format,
                 self.track_format,
+                track_workers=self.track_workers,
+                track_pool=self.scheduler.track_pool,
+                segments=self.segments,
+                segment_threshold=self.segment_threshold,
+                prefetch_urls=self.prefetch_urls,
+                downloads_db=self.downloads_db,
+                library_index=self.library_index,
+                registry=self.registry,
+                cancelled=self.scheduler.cancelled,
             )
-            dloader.download_id_by_type(not album)
-            handle_download_id(self.downloads_db, item_id, add_id=True)
+            complete = dloader.download_id_by_type(not album) is not False
+        except Cancelled as e:
+            # reported once by whoever cancelled; the job stays unfinished
+            logger.debug(f"{e}")
+            return
         except (requests.exceptions.RequestException, NonStreamable) as e:
             logger.error(f"{RED}Error getting release: {e}. Skipping...")
+            if job is not None:
+                self.job_queue.fail(job, e)
+            return
+        if not complete:
+            # the release is only recorded once every track is in the ledger
+            if job is not None:
+                self.job_queue.fail(job, "Some tracks couldn't be downloaded")
+            return
+        if self.downloads_db is not None:
+            self.downloads_db.add(item_id)
+        if job is not None:
+            self.job_queue.finish(job)
+
+    def _download_item(self, parent, item_id, album, alt_path, release_id=None):
+        """`download_from_id`, recording the item under the URL job `parent`
+        (if any). Items already run in a previous attempt are skipped unless
+        they are in the states being resumed."""
+        if parent is None:
+            return self.download_from_id(
+                item_id, album, alt_path, release_id=release_id
+            )
+        job = self.job_queue.add_item(parent, item_id, album, alt_path)
+        # items recorded by a previous attempt only run in the resumed states
+        if job["attempts"] and job["state"] not in self._job_states:
+            return
+        return self.download_from_id(item_id, album, alt_path, job["id"], release_id)
 
-    def handle_url(self, url):
+    def handle_url(self, url, job=None):
+        with self.registry.run():
+            self._handle_url(url, job)
+
+    def _handle_url(self, url, job=None):
         possibles = {
             "playlist": {
                 "func": self.client.get_plist_meta,
                 "iterable_key": "tracks",
+                "count_key": "tracks_count",
             },
             "artist": {
                 "func": self.client.get_artist_meta,
                 "iterable_key": "albums",
+                "count_key": "albums_count",
             },
             "label": {
                 "func": self.client.get_label_meta,
                 "iterable_key": "albums",
+                "count_key": "albums_count",
             },
             "album": {"album": True, "func": None, "iterable_key": None},
             "track": {"album": False, "func": None, "iterable_key": None},
@@ -131,10 +306,15 @@ class QobuzDL:
             logger.info(
                 f'{RED}Invalid url: "{url}". Use urls from ' "https://play.qobuz.com!"
             )
+            if job is not None:
+                self.job_queue.fail(job, "Invalid URL")
             return
         if type_dict["func"]:
-            content = [item for item in type_dict["func"](item_id)]
-            content_name = content[0]["name"]
+            # pages are streamed: downloads start with the first one, and
+            # only the pages being fetched are held in memory
+            pages = type_dict["func"](item_id)
+            first_page = next(pages)
+            content_name = first_page["name"]
             logger.info(
                 f"{YELLOW}Downloading all the music from {content_name} "
                 f"({url_type})!"
@@ -142,44 +322,134 @@ class QobuzDL:
             new_path = create_and_return_dir(
                 os.path.join(self.directory, sanitize_filename(content_name))
             )
+            if job is not None:
+                self.job_queue.expanding(job, new_path, url_type == "playlist")
+            pages = chain([first_page], pages)
+            iterable_key = type_dict["iterable_key"]
 
             if self.smart_discography and url_type == "artist":
                 # change `save_space` and `skip_extras` for customization
-                items = smart_discography_filter(
-                    content,
+                albums = smart_discography_filter(
+                    pages,
                     save_space=True,
                     skip_extras=True,
                 )
+                queued = len(albums)
+                items = ((album.id, None) for album in albums)
             else:
-                items = [item[type_dict["iterable_key"]]["items"] for item in content][
-                    0
-                ]
-
-            logger.info(f"{YELLOW}{len(items)} downloads in queue")
-            for item in items:
-                self.download_from_id(
-                    item["id"],
-                    True if type_dict["iterable_key"] == "albums" else False,
+                # (ID, album ID): playlist tracks whose album is queued are
+                # downloaded with it
+                items = (
+                    (item["id"], (item.get("album") or {}).get("id"))
+                    for page in pages
+                    for item in page[iterable_key]["items"]
+                )
+                queued = first_page.get(type_dict["count_key"], "n/a")
+            del first_page
+
+            logger.info(f"{YELLOW}{queued} downloads in queue")
+            downloads = []
+            track_ids = []
+            for item_id, release_id in items:
+                future = self._download_item(
+                    job,
+                    item_id,
+                    True if iterable_key == "albums" else False,
                     new_path,
+                    release_id,
                 )
+                if url_type == "playlist":
+                    track_ids.append(item_id)
+                    if future:
+                        downloads.append(future)
+            if job is not None:
+                self.job_queue.finish(job)
             if url_type == "playlist" and not self.no_m3u_for_playlists:
-                make_m3u(new_path)
+                wait(downloads)
+                make_m3u(new_path, self.registry.paths(track_ids, outside=new_path))
         else:
-            self.download_from_id(item_id, type_dict["album"])
+            if job is not None:
+                self.job_queue.expanding(job, None)
+            self._download_item(job, item_id, type_dict["album"], None)
+            if job is not None:
+                self.job_queue.finish(job)
 
     def download_list_of_urls(self, urls):
         if not urls or not isinstance(urls, list):
             logger.info(f"{OFF}Nothing to download")
             return
-        for url in urls:
+        with self.registry.run():
+            self._download_list_of_urls(urls)
+
+    def _download_list_of_urls(self, urls):
+        if self.job_queue is not None:
+            # every URL is recorded before any is expanded, so a run
+            # interrupted at any point can be resumed
+            self._add_url_jobs(urls)
+            self._run_jobs(UNFINISHED)
+            return
+        for url in _playlists_last(urls):
             if "last.fm" in url:
                 self.download_lastfm_pl(url)
             elif os.path.isfile(url):
                 self.download_from_txt_file(url)
             else:
                 self.handle_url(url)
+        self.scheduler.join()
+        if self.downloads_db is not None:
+            self.downloads_db.flush()
+
+    def _add_url_jobs(self, urls):
+        for url in _playlists_last(urls):
+            if "last.fm" not in url and os.path.isfile(url):
+                self._add_url_jobs(self._read_txt_file(url) or [])
+            else:
+                self.job_queue.add_url(url)
+
+    def resume_jobs(self, retry_failed=False):
+        """Continue the run recorded in `job_queue`: URLs that weren't fully
+        expanded are expanded again, skipping the items already done, and
+        the unfinished items of the others are downloaded. With
+        `retry_failed`, only the failed items (and URLs) are run again."""
+        if not self.job_queue.urls():
+            logger.info(f"{OFF}Nothing to resume")
+            return
+        with self.registry.run():
+            self._run_jobs((FAILED,) if retry_failed else UNFINISHED)
+
+    def _run_jobs(self, states):
+        "Run the URL and item jobs in `states`, in the order of the run"
+        self._job_states = states
+        for job in self.job_queue.urls():
+            if job["state"] in states:
+                if "last.fm" in job["source"]:
+                    self.download_lastfm_pl(job["source"], job["id"])
+                else:
+                    self.handle_url(job["source"], job["id"])
+                continue
+            if job["state"] != DONE:
+                continue
+            items = self.job_queue.items(job["id"], states)
+            if not items:
+                continue
+            logger.info(f"{YELLOW}Resuming {len(items)} downloads of {job['source']}")
+            downloads = [
+                self.download_from_id(
+                    item["source"], item["kind"] == "album", item["path"], item["id"]
+                )
+                for item in items
+            ]
+            if job["m3u"] and not self.no_m3u_for_playlists:
+                wait([future for future in downloads if future])
+                track_ids = [item["source"] for item in items]
+                make_m3u(
+                    job["path"], self.registry.paths(track_ids, outside=job["path"])
+                )
+        self.scheduler.join()
+        if self.downloads_db is not None:
+            self.downloads_db.flush()
 
-    def download_from_txt_file(self, txt_file):
+    def _read_txt_file(self, txt_file):
         with open(txt_file, "r") as txt:
             try:
                 urls = [
@@ -194,6 +464,11 @@ class QobuzDL:
                 f"{YELLOW}qobuz-dl will download {len(urls)}"
                 f" urls from file: {txt_file}"
             )
+            return urls
+
+    def download_from_txt_file(self, txt_file):
+        urls = self._read_txt_file(txt_file)
+        if urls is not None:
             self.download_list_of_urls(urls)
 
     def lucky_mode(self, query, download=True):
@@ -360,13 +635,15 @@ class QobuzDL:
             logger.info(f"{YELLOW}Bye")
             return
 
-    def download_lastfm_pl(self, playlist_url):
+    def download_lastfm_pl(self, playlist_url, job=None):
         # Apparently, last fm API doesn't have a playlist endpoint. If you
         # find out that it has, please fix this!
         try:
             r = requests.get(playlist_url, timeout=10)
         except requests.exceptions.RequestException as e:
             logger.error(f"{RED}Playlist download failed: {e}")
+            if job is not None:
+                self.job_queue.fail(job, e)
             return
         soup = bso(r.content, "html.parser")
         artists = [artist.text for artist in soup.select(ARTISTS_SELECTOR)]
@@ -380,6 +657,8 @@ class QobuzDL:
 
         if not track_list:
             logger.info(f"{OFF}Nothing found")
+            if job is not None:
+                self.job_queue.finish(job)
             return
 
         pl_title = sanitize_filename(soup.select_one("h1").text)
@@ -388,12 +667,27 @@ class QobuzDL:
             f"{YELLOW}Downloading playlist: {pl_title} " f"({len(track_list)} tracks)"
         )
 
+        if job is not None:
+            self.job_queue.expanding(job, pl_directory, True)
+        downloads = []
+        track_ids = []
         for i in track_list:
             track_id = get_url_info(self.search_by_type(i, "track", 1, lucky=True)[0])[
                 1
             ]
             if track_id:
-                self.download_from_id(track_id, False, pl_directory)
+                track_ids.append(track_id)
+                downloads.append(
+                    self._download_item(job, track_id, False, pl_directory)
+                )
+        if job is not None:
+            self.job_queue.finish(job)
 
         if not self.no_m3u_for_playlists:
-            make_m3u(pl_directory)
+            wait([future for future in downloads if future])
+            make_m3u(pl_directory, self.registry.paths(track_ids, outside=pl_directory))
+
+
+def _playlists_last(urls):
+    "Playlists after the other URLs, so their tracks can come from the albums"
+    return sorted(urls, key=lambda url: "last.fm" in url or "/playlist/" in url)
@@ -0,0 +1,75 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# only the owner can read or write the session file
+FILE_MODE = 0o600
+
+
+class SessionStore:
+    """Persists the user auth token and the working app secret between runs,
+    so the client doesn't have to log in and probe every secret each time.
+
+    The session is only reused with the same email, password and app ID it
+    was created with. The file holds a token equivalent to the password, so
+    it's written with owner-only permissions.
+
+    :param str path: JSON file, usually next to config.ini
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _owner(email, pwd, app_id):
+        return hashlib.sha256(f"{email}:{pwd}:{app_id}".encode("utf-8")).hexdigest()
+
+    def load(self, email, pwd, app_id):
+        "Return the stored session for these credentials, or None"
+        try:
+            with open(self.path, "r") as f:
+                session = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.debug(f"Ignoring unreadable session file {self.path}: {e}")
+            return None
+
+        if not isinstance(session, dict) or session.get("owner") != self._owner(
+            email, pwd, app_id
+        ):
+            return None
+        if not session.get("user_auth_token") or not session.get("secret"):
+            return None
+        return session
+
+    def save(self, email, pwd, app_id, user_auth_token, secret, label=None):
+        session = {
+            "owner": self._owner(email, pwd, app_id),
+            "user_auth_token": user_auth_token,
+            "secret": secret,
+            "label": label,
+        }
+        tmp = f"{self.path}.new"
+        with self._lock:
+            try:
+                fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, FILE_MODE)
+                with os.fdopen(fd, "w") as f:
+                    json.dump(session, f)
+                # O_CREAT doesn't change the mode of an existing file
+                os.chmod(tmp, FILE_MODE)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                logger.debug(f"Couldn't save the session to {self.path}: {e}")
+
+    def clear(self):
+        with self._lock:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
@@ -1,10 +1,241 @@
+import hashlib
 import logging
+import math
 import sqlite3
+import threading
+import time
 
 from qobuz_dl.color import YELLOW, RED
 
 logger = logging.getLogger(__name__)
 
+# IDs are written in one transaction once this many are pending...
+BATCH_SIZE = 64
+# ...or once the oldest pending one is this many seconds old
+FLUSH_INTERVAL = 2
+# seconds between checks for IDs added by other processes
+REFRESH_INTERVAL = 5
+# above this many IDs, a Bloom filter is kept in memory instead of a set
+BLOOM_THRESHOLD = 1_000_000
+BLOOM_FALSE_POSITIVES = 0.001
+# milliseconds to wait for another process's write lock
+BUSY_TIMEOUT = 30_000
+
+
+class BloomFilter:
+    """Set membership in a fixed amount of memory, with some false positives
+    (but no false negatives).
+
+    :param int capacity: expected number of items
+    :param float error_rate: false positive rate at `capacity` items
+    """
+
+    def __init__(self, capacity, error_rate=BLOOM_FALSE_POSITIVES):
+        # optimal size and number of hashes for `capacity` and `error_rate`
+        ln2 = math.log(2)
+        self.size = max(8, int(-capacity * math.log(error_rate) / ln2**2))
+        self.hashes = max(1, round(self.size / capacity * ln2))
+        self.bits = bytearray(-(-self.size // 8))
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+
+class DownloadsDB:
+    """IDs of the downloaded releases, and a ledger of their tracks, in a
+    SQLite file.
+
+    All the IDs are loaded in memory when the file is opened (in a set, or
+    in a Bloom filter for very large files), so checking an ID needs no
+    query. New IDs are written in batches over one long-lived connection.
+
+    Several processes can share the file: it's in WAL mode, writes wait
+    for each other, and IDs added by other processes are loaded every
+    REFRESH_INTERVAL seconds.
+
+    The ledger records every downloaded track with its format, quality,
+    path and size. A track is looked up by its ID, so it's found wherever
+    it was saved, and a release ID is only added once all of its tracks
+    are in the ledger.
+
+    :param str path: SQLite file
+    """
+
+    def __init__(self, path, bloom_threshold=BLOOM_THRESHOLD):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT}")
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            created = self._conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name='downloads'"
+            ).fetchone()
+            if not created:
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS downloads (id TEXT UNIQUE NOT NULL)"
+                )
+                logger.info(f"{YELLOW}Download-IDs database created")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS tracks (track_id TEXT NOT NULL, "
+                "release_id TEXT, format_id INTEGER NOT NULL, bit_depth INTEGER, "
+                "sampling_rate REAL, path TEXT NOT NULL, size INTEGER, "
+                "completed REAL NOT NULL, PRIMARY KEY (track_id, format_id))"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS tracks_release ON tracks (release_id)"
+            )
+
+        count = self._conn.execute("SELECT COUNT(*) FROM downloads").fetchone()[0]
+        if count > bloom_threshold:
+            # room to grow before the false positive rate goes up
+            self._known = BloomFilter(count * 2)
+            self._exact = False
+        else:
+            self._known = set()
+            self._exact = True
+        self._last_rowid = 0
+        self._load()
+        self._pending = []
+        # ledger rows not written yet, by (track ID, format ID)
+        self._pending_tracks = {}
+        self._first_pending = None
+
+    def _load(self):
+        "Load the IDs added since the last load"
+        self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        rows = self._conn.execute(
+            "SELECT rowid, id FROM downloads WHERE rowid > ? ORDER BY rowid",
+            (self._last_rowid,),
+        )
+        for rowid, item_id in rows:
+            self._known.add(item_id)
+            self._last_rowid = rowid
+        self._next_refresh = time.monotonic() + REFRESH_INTERVAL
+
+    def _refresh(self):
+        if time.monotonic() < self._next_refresh:
+            return
+        # data_version only changes when another connection commits
+        version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._data_version:
+            self._load()
+        else:
+            self._next_refresh = time.monotonic() + REFRESH_INTERVAL
+
+    def __contains__(self, item_id):
+        item_id = str(item_id)
+        with self._lock:
+            try:
+                self._refresh()
+            except sqlite3.Error as e:
+                logger.debug(f"Couldn't refresh the downloads database: {e}")
+            if item_id not in self._known:
+                return False
+            if self._exact:
+                return True
+            # a Bloom filter hit may be a false positive
+            return item_id in self._pending or bool(
+                self._conn.execute(
+                    "SELECT 1 FROM downloads WHERE id=?", (item_id,)
+                ).fetchone()
+            )
+
+    def add(self, item_id):
+        item_id = str(item_id)
+        with self._lock:
+            self._known.add(item_id)
+            self._pending.append(item_id)
+            self._pending_added()
+
+    def _pending_added(self):
+        if self._first_pending is None:
+            self._first_pending = time.monotonic()
+        if (
+            len(self._pending) + len(self._pending_tracks) >= BATCH_SIZE
+            or time.monotonic() - self._first_pending >= FLUSH_INTERVAL
+        ):
+            self._flush()
+
+    def has_track(self, track_id, format_id):
+        """Whether the track is in the ledger in this format or a better one
+        (format IDs grow with the quality)"""
+        track_id, format_id = str(track_id), int(format_id)
+        with self._lock:
+            if any(
+                pending_id == track_id and pending_format >= format_id
+                for pending_id, pending_format in self._pending_tracks
+            ):
+                return True
+            return bool(
+                self._conn.execute(
+                    "SELECT 1 FROM tracks WHERE track_id=? AND format_id>=? LIMIT 1",
+                    (track_id, format_id),
+                ).fetchone()
+            )
+
+    def add_track(
+        self, track_id, release_id, format_id, bit_depth, sampling_rate, path, size
+    ):
+        track_id, format_id = str(track_id), int(format_id)
+        with self._lock:
+            self._pending_tracks[(track_id, format_id)] = (
+                track_id,
+                None if release_id is None else str(release_id),
+                format_id,
+                bit_depth,
+                sampling_rate,
+                path,
+                size,
+                time.time(),
+            )
+            self._pending_added()
+
+    def flush(self):
+        "Write the pending IDs"
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending and not self._pending_tracks:
+            return
+        try:
+            with self._conn:
+                # tracks first: a release is never recorded without them
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    self._pending_tracks.values(),
+                )
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO downloads (id) VALUES (?)",
+                    ((item_id,) for item_id in self._pending),
+                )
+        except sqlite3.Error as e:
+            # kept pending for the next flush
+            logger.error(f"{RED}Unexpected DB error: {e}")
+            return
+        self._pending = []
+        self._pending_tracks = {}
+        self._first_pending = None
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._conn.close()
+
 
 def create_db(db_path):
     with sqlite3.connect(db_path) as conn:
@@ -1,14 +1,26 @@
+import json
 import logging
 import os
+import threading
+import time
+from concurrent.futures import (
+    FIRST_EXCEPTION,
+    CancelledError,
+    ThreadPoolExecutor,
+    wait,
+)
 from typing import Tuple
 
 import requests
+import urllib3
 from pathvalidate import sanitize_filename, sanitize_filepath
 from tqdm import tqdm
 
 import qobuz_dl.metadata as metadata
+from qobuz_dl import sessions
 from qobuz_dl.color import OFF, GREEN, RED, YELLOW, CYAN
-from qobuz_dl.exceptions import NonStreamable
+from qobuz_dl.exceptions import Cancelled, NonStreamable
+from qobuz_dl.records import Album, Track
 
 QL_DOWNGRADE = "FormatRestrictedByFormatAvailability"
 # used in case of error
@@ -23,9 +35,24 @@ DEFAULT_FORMATS = {
     ],
 }
 
+# maximum (bit depth, sampling rate) of the FLAC format IDs
+QUALITY_LIMITS = {6: (16, 44.1), 7: (24, 96), 27: (24, 192)}
+
 DEFAULT_FOLDER = "{artist} - {album} ({year}) [{bit_depth}B-{sampling_rate}kHz]"
 DEFAULT_TRACK = "{tracknumber}. {tracktitle}"
 
+# partial downloads are kept next to a sidecar with this suffix
+RESUME_SUFFIX = ".resume"
+# bytes written between sidecar updates
+RESUME_CHECKPOINT = 4 * 1024 * 1024
+# files of at least this size can be downloaded in segments
+SEGMENT_THRESHOLD = 64 * 1024 * 1024
+# files are read in chunks growing between these sizes
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+# seconds between progress bar updates
+PROGRESS_INTERVAL = 0.25
+
 logger = logging.getLogger(__name__)
 
 
@@ -43,6 +70,15 @@ class Download:
         no_cover: bool = False,
         folder_format=None,
         track_format=None,
+        track_workers: int = 1,
+        track_pool=None,
+        segments: int = 1,
+        segment_threshold: int = SEGMENT_THRESHOLD,
+        prefetch_urls: int = 0,
+        downloads_db=None,
+        library_index=None,
+        registry=None,
+        cancelled=None,
     ):
         self.client = client
         self.item_id = item_id
@@ -55,30 +91,76 @@ class Download:
         self.no_cover = no_cover
         self.folder_format = folder_format or DEFAULT_FOLDER
         self.track_format = track_format or DEFAULT_TRACK
+        self.track_workers = max(1, int(track_workers or 1))
+        self.track_pool = track_pool
+        self.segments = max(1, int(segments or 1))
+        self.segment_threshold = segment_threshold
+        self.prefetch_urls = prefetch_urls
+        # optional db.DownloadsDB whose ledger records the downloaded tracks
+        self.downloads_db = downloads_db
+        # optional library.LibraryIndex of the files already in the library
+        self.library_index = library_index
+        # optional scheduler.Registry of the run, told where tracks are saved
+        self.registry = registry
+        # threading.Event: once set, no new track is started and the ones in
+        # flight stop, keeping their partial files for resuming
+        self.cancelled = cancelled if cancelled is not None else threading.Event()
+        self._prefetcher = None
+        # tracks of the release found by _plan, and their format
+        self._present = {}
+        self._present_format = {}
 
     def download_id_by_type(self, track=True):
+        """Download the release (or track).
+
+        :returns: False if a track couldn't be downloaded
+        """
         if not track:
-            self.download_release()
+            return self.download_release()
         else:
-            self.download_track()
+            return self.download_track()
 
     def download_release(self):
-        count = 0
-        meta = self.client.get_album_meta(self.item_id)
+        meta = Album.from_json(self.client.get_album_meta(self.item_id))
 
-        if not meta.get("streamable"):
+        if not meta.streamable:
             raise NonStreamable("This release is not streamable")
 
         if self.albums_only and (
-            meta.get("release_type") != "album"
-            or meta.get("artist").get("name") == "Various Artists"
+            meta.release_type != "album" or meta.artist.name == "Various Artists"
         ):
-            logger.info(f'{OFF}Ignoring Single/EP/VA: {meta.get("title", "n/a")}')
+            logger.info(f"{OFF}Ignoring Single/EP/VA: {meta.title or 'n/a'}")
             return
 
         album_title = _get_title(meta)
+        tracks = meta.tracks
+        media_numbers = [track.media_number for track in tracks]
+        is_multiple = True if len([*{*media_numbers}]) > 1 else False
 
-        format_info = self._get_format(meta)
+        # plan with the format expected from the album metadata, so nothing
+        # is signed or downloaded for releases that are already complete
+        expected_format = self._expected_format(meta)
+        dirn = (
+            self._release_dir(meta, album_title, *expected_format)
+            if expected_format[0] != "Unknown"
+            else None
+        )
+        self._plan(dirn, tracks, meta, expected_format, is_multiple)
+        if tracks and len(self._present) == len(tracks):
+            logger.info(
+                f"{OFF}{album_title} was already downloaded ({len(tracks)} tracks)"
+            )
+            for track in tracks:
+                self._record_present(track, log=False)
+            return True
+
+        # the format is checked with a track that isn't present
+        missing = [track for track in tracks if track.id not in self._present]
+        format_info = (
+            self._get_format(missing[0], is_track_id=True)
+            if missing
+            else self._get_format(meta)
+        )
         file_format, quality_met, bit_depth, sampling_rate = format_info
 
         if not self.downgrade_quality and not quality_met:
@@ -91,54 +173,224 @@ class Download:
             f"\n{YELLOW}Downloading: {album_title}\nQuality: {file_format}"
             f" ({bit_depth}/{sampling_rate})\n"
         )
-        album_attr = self._get_album_attr(
-            meta, album_title, file_format, bit_depth, sampling_rate
-        )
-        folder_format, track_format = _clean_format_str(
-            self.folder_format, self.track_format, file_format
-        )
-        sanitized_title = sanitize_filepath(folder_format.format(**album_attr))
-        dirn = os.path.join(self.path, sanitized_title)
+        # without an expected format nothing was planned in a folder yet
+        if dirn is None or (file_format, bit_depth, sampling_rate) != expected_format:
+            dirn = self._release_dir(
+                meta, album_title, file_format, bit_depth, sampling_rate
+            )
+            self._plan(
+                dirn, tracks, meta, (file_format, bit_depth, sampling_rate), is_multiple
+            )
         os.makedirs(dirn, exist_ok=True)
 
         if self.no_cover:
             logger.info(f"{OFF}Skipping cover")
         else:
-            _get_extra(meta["image"]["large"], dirn, og_quality=self.cover_og_quality)
+            _get_extra(meta.image, dirn, og_quality=self.cover_og_quality)
 
-        if "goodies" in meta:
+        if meta.booklet:
             try:
-                _get_extra(meta["goodies"][0]["url"], dirn, "booklet.pdf")
+                _get_extra(meta.booklet, dirn, "booklet.pdf")
             except:  # noqa
                 pass
-        media_numbers = [track["media_number"] for track in meta["tracks"]["items"]]
-        is_multiple = True if len([*{*media_numbers}]) > 1 else False
-        for i in meta["tracks"]["items"]:
-            parse = self.client.get_track_url(i["id"], fmt_id=self.quality)
-            if "sample" not in parse and parse["sampling_rate"]:
-                is_mp3 = True if int(self.quality) == 5 else False
-                self._download_and_tag(
-                    dirn,
-                    count,
-                    parse,
-                    i,
-                    meta,
-                    False,
-                    is_mp3,
-                    i["media_number"] if is_multiple else None,
+        if self._present:
+            logger.info(
+                f"{YELLOW}{len(self._present)} of {len(tracks)} tracks were "
+                "already downloaded, getting the rest"
+            )
+        if self.prefetch_urls > 0:
+            skip = set(self._present)
+            if file_format == "FLAC":
+                # its URL was signed by _get_format
+                skip.update(track.id for track in missing[:1])
+            self._prefetcher = _UrlPrefetcher(
+                self.client, tracks, self.quality, self.prefetch_urls, skip
+            )
+        try:
+            if self.track_pool is not None or self.track_workers > 1:
+                results = self._download_tracks_concurrently(
+                    dirn, tracks, meta, is_multiple
                 )
             else:
-                logger.info(f"{OFF}Demo. Skipping")
-            count = count + 1
+                results = [
+                    self._download_album_track(dirn, count, i, meta, is_multiple)
+                    for count, i in enumerate(tracks)
+                ]
+        finally:
+            if self._prefetcher is not None:
+                self._prefetcher.close()
+                self._prefetcher = None
+        if False in results:
+            logger.info(f"{RED}Completed with errors")
+            return False
         logger.info(f"{GREEN}Completed")
+        return True
+
+    def _expected_format(self, meta):
+        """The (file format, bit depth, sampling rate) that _get_format should
+        return, from the album metadata alone"""
+        if int(self.quality) == 5:
+            return ("MP3", None, None)
+        if not (meta.tracks and meta.maximum_bit_depth and meta.maximum_sampling_rate):
+            return ("Unknown", None, None)
+        bit_depth, sampling_rate = QUALITY_LIMITS[int(self.quality)]
+        return (
+            "FLAC",
+            min(meta.maximum_bit_depth, bit_depth),
+            min(meta.maximum_sampling_rate, sampling_rate),
+        )
+
+    def _release_dir(self, meta, album_title, file_format, bit_depth, sampling_rate):
+        album_attr = self._get_album_attr(
+            meta, album_title, file_format, bit_depth, sampling_rate
+        )
+        folder_format, _ = _clean_format_str(
+            self.folder_format, self.track_format, file_format
+        )
+        return os.path.join(
+            self.path, sanitize_filepath(folder_format.format(**album_attr))
+        )
+
+    def _plan(self, dirn, tracks, meta, format_info, is_multiple):
+        """Find the tracks of a release that are already present: in the
+        downloads ledger, in the library index, or at their final path in
+        `dirn` (if any). Sets `self._present` to {track ID: (message, path)},
+        where path is None for the tracks found in a database."""
+        file_format, bit_depth, sampling_rate = format_info
+        self._present_format = {"bit_depth": bit_depth, "sampling_rate": sampling_rate}
+        self._present = {}
+        extension = ".mp3" if file_format == "MP3" else ".flac"
+        for track in tracks:
+            message = self._known_track(track.id, track.isrc, meta.title)
+            if message:
+                self._present[track.id] = (message, None)
+                continue
+            if dirn is None:
+                continue
+            root_dir = (
+                os.path.join(dirn, f"Disc {track.media_number}")
+                if is_multiple
+                else dirn
+            )
+            final_file = self._final_file(root_dir, track, extension)
+            if os.path.isfile(final_file):
+                self._present[track.id] = ("was already downloaded", final_file)
+
+    def _record_present(self, track, log=True):
+        message, final_file = self._present[track.id]
+        if log:
+            logger.info(f"{OFF}{track.title} {message}")
+        if final_file is not None:
+            self._record_track(track, self._present_format, final_file)
+
+    def _known_track(self, track_id, isrc=None, album_title=None):
+        "Why the track is skipped if it's in the downloads ledger or the library"
+        if self.downloads_db is not None and self.downloads_db.has_track(
+            track_id, self.quality
+        ):
+            return "was already downloaded"
+        if self.library_index is not None and self.library_index.has_track(
+            track_id, int(self.quality) != 5, isrc, album_title
+        ):
+            return "is already in the library"
+
+    def _in_ledger(self, track_id, track_title):
+        message = self._known_track(track_id)
+        if message:
+            logger.info(f"{OFF}{track_title} {message}")
+        return bool(message)
+
+    def _check_cancelled(self):
+        if self.cancelled.is_set():
+            raise Cancelled(f"download of {self.item_id} cancelled")
+
+    def _download_album_track(self, dirn, count, track, meta, is_multiple):
+        """:returns: True if the track is downloaded, False if it failed and
+        None if it isn't available"""
+        self._check_cancelled()
+        if self._prefetcher is not None:
+            self._prefetcher.advance(count)
+        if track.id in self._present:
+            self._record_present(track)
+            return True
+        parse = self.client.get_track_url(track.id, fmt_id=self.quality)
+        if "sample" not in parse and parse["sampling_rate"]:
+            is_mp3 = True if int(self.quality) == 5 else False
+            return self._download_and_tag(
+                dirn,
+                parse,
+                track,
+                meta,
+                False,
+                is_mp3,
+                track.media_number if is_multiple else None,
+            )
+        else:
+            logger.info(f"{OFF}Demo. Skipping")
+
+    def _download_tracks_concurrently(self, dirn, tracks, meta, is_multiple):
+        """Download the tracks of a release with a bounded pool of workers
+        (the shared `track_pool` if any, otherwise `track_workers` threads).
+
+        Disc folders are created up front and temporary names come from the
+        track ID, so the result on disk is the same as with a sequential
+        download. Results are collected in track order; a failing track is
+        logged and doesn't cancel the others.
+        """
+        if is_multiple:
+            for media_number in sorted({track.media_number for track in tracks}):
+                os.makedirs(os.path.join(dirn, f"Disc {media_number}"), exist_ok=True)
+
+        executor = self.track_pool or ThreadPoolExecutor(max_workers=self.track_workers)
+        futures = []
+        results = []
+        try:
+            for count, track in enumerate(tracks):
+                futures.append(
+                    executor.submit(
+                        self._download_album_track,
+                        dirn,
+                        count,
+                        track,
+                        meta,
+                        is_multiple,
+                    )
+                )
+            for track, future in zip(tracks, futures):
+                try:
+                    results.append(future.result())
+                except (Cancelled, CancelledError):
+                    raise Cancelled(f"download of {self.item_id} cancelled")
+                except Exception as e:
+                    logger.error(
+                        f"{RED}Error downloading track {track.title or track.id}: {e}"
+                    )
+                    results.append(False)
+        except BaseException as e:
+            # e.g. KeyboardInterrupt: don't start the pending tracks, and stop
+            # the running ones (the workers aren't interrupted themselves)
+            if isinstance(e, KeyboardInterrupt):
+                self.cancelled.set()
+            for future in futures:
+                future.cancel()
+            if executor is not self.track_pool:
+                executor.shutdown(wait=False)
+            raise
+        if executor is not self.track_pool:
+            executor.shutdown()
+        return results
 
     def download_track(self):
+        self._check_cancelled()
+        if self._in_ledger(self.item_id, f"Track {self.item_id}"):
+            return True
         parse = self.client.get_track_url(self.item_id, self.quality)
+        result = None
 
         if "sample" not in parse and parse["sampling_rate"]:
-            meta = self.client.get_track_meta(self.item_id)
+            meta = Track.from_json(self.client.get_track_meta(self.item_id))
             track_title = _get_title(meta)
-            artist = _safe_get(meta, "performer", "name")
+            artist = meta.performer
             logger.info(f"\n{YELLOW}Downloading: {artist} - {track_title}")
             format_info = self._get_format(meta, is_track_id=True, track_url_dict=parse)
             file_format, quality_met, bit_depth, sampling_rate = format_info
@@ -163,15 +415,10 @@ class Download:
             if self.no_cover:
                 logger.info(f"{OFF}Skipping cover")
             else:
-                _get_extra(
-                    meta["album"]["image"]["large"],
-                    dirn,
-                    og_quality=self.cover_og_quality,
-                )
+                _get_extra(meta.album.image, dirn, og_quality=self.cover_og_quality)
             is_mp3 = True if int(self.quality) == 5 else False
-            self._download_and_tag(
+            result = self._download_and_tag(
                 dirn,
-                1,
                 parse,
                 meta,
                 meta,
@@ -182,11 +429,11 @@ class Download:
         else:
             logger.info(f"{OFF}Demo. Skipping")
         logger.info(f"{GREEN}Completed")
+        return result
 
     def _download_and_tag(
         self,
         root_dir,
-        tmp_count,
         track_url_dict,
         track_metadata,
         album_or_track_metadata,
@@ -206,23 +453,29 @@ class Download:
             root_dir = os.path.join(root_dir, f"Disc {multiple}")
             os.makedirs(root_dir, exist_ok=True)
 
-        filename = os.path.join(root_dir, f".{tmp_count:02}.tmp")
-
-        # Determine the filename
-        track_title = track_metadata.get("title")
-        artist = _safe_get(track_metadata, "performer", "name")
-        filename_attr = self._get_filename_attr(artist, track_metadata, track_title)
-
-        # track_format is a format string
-        # e.g. '{tracknumber}. {artist} - {tracktitle}'
-        formatted_path = sanitize_filename(self.track_format.format(**filename_attr))
-        final_file = os.path.join(root_dir, formatted_path)[:250] + extension
+        # unique per track: tracks of a release (or playlist tracks of the
+        # same album) can be downloaded into one folder at the same time
+        filename = os.path.join(root_dir, f".{track_metadata.id}.tmp")
+        track_title = track_metadata.title
+        final_file = self._final_file(root_dir, track_metadata, extension)
 
         if os.path.isfile(final_file):
             logger.info(f"{OFF}{track_title} was already downloaded")
-            return
+            self._record_track(track_metadata, track_url_dict, final_file)
+            return True
 
-        tqdm_download(url, filename, filename)
+        tqdm_download(
+            url,
+            filename,
+            filename,
+            identity="track:{}:{}".format(
+                track_url_dict.get("track_id", track_metadata.id),
+                track_url_dict.get("format_id", self.quality),
+            ),
+            segments=self.segments,
+            segment_threshold=self.segment_threshold,
+            cancelled=self.cancelled,
+        )
         tag_function = metadata.tag_mp3 if is_mp3 else metadata.tag_flac
         try:
             tag_function(
@@ -236,28 +489,54 @@ class Download:
             )
         except Exception as e:
             logger.error(f"{RED}Error tagging the file: {e}", exc_info=True)
+            return False
+        self._record_track(track_metadata, track_url_dict, final_file)
+        return True
+
+    def _record_track(self, track_metadata, track_url_dict, final_file):
+        if self.registry is not None:
+            self.registry.add_path(track_metadata.id, os.path.abspath(final_file))
+        if self.downloads_db is None:
+            return
+        self.downloads_db.add_track(
+            track_metadata.id,
+            track_metadata.album.id if track_metadata.album else None,
+            self.quality,
+            track_url_dict.get("bit_depth"),
+            track_url_dict.get("sampling_rate"),
+            os.path.abspath(final_file),
+            os.path.getsize(final_file),
+        )
+
+    def _final_file(self, root_dir, track_metadata, extension):
+        filename_attr = self._get_filename_attr(
+            track_metadata.performer, track_metadata, track_metadata.title
+        )
+        # track_format is a format string
+        # e.g. '{tracknumber}. {artist} - {tracktitle}'
+        formatted_path = sanitize_filename(self.track_format.format(**filename_attr))
+        return os.path.join(root_dir, formatted_path)[:250] + extension
 
     @staticmethod
     def _get_filename_attr(artist, track_metadata, track_title):
+        album = track_metadata.album
         return {
             "artist": artist,
-            "albumartist": _safe_get(
-                track_metadata, "album", "artist", "name", default=artist
-            ),
-            "bit_depth": track_metadata["maximum_bit_depth"],
-            "sampling_rate": track_metadata["maximum_sampling_rate"],
+            "albumartist": (album and album.artist.name) or artist,
+            "bit_depth": track_metadata.maximum_bit_depth,
+            "sampling_rate": track_metadata.maximum_sampling_rate,
             "tracktitle": track_title,
-            "version": track_metadata.get("version"),
-            "tracknumber": f"{track_metadata['track_number']:02}",
+            "version": track_metadata.version,
+            "tracknumber": f"{track_metadata.track_number:02}",
         }
 
     @staticmethod
     def _get_track_attr(meta, track_title, bit_depth, sampling_rate):
         return {
-            "album": sanitize_filename(meta["album"]["title"]),
-            "artist": sanitize_filename(meta["album"]["artist"]["name"]),
+            "album": sanitize_filename(meta.album.title),
+            "artist": sanitize_filename(meta.album.artist.name),
             "tracktitle": track_title,
-            "year": meta["album"]["release_date_original"].split("-")[0],
+            "year": meta.album.release_date_original.split("-")[0],
             "bit_depth": bit_depth,
             "sampling_rate": sampling_rate,
         }
@@ -265,28 +544,38 @@ class Download:
     @staticmethod
     def _get_album_attr(meta, album_title, file_format, bit_depth, sampling_rate):
         return {
-            "artist": sanitize_filename(meta["artist"]["name"]),
+            "artist": sanitize_filename(meta.artist.name),
             "album": sanitize_filename(album_title),
-            "year": meta["release_date_original"].split("-")[0],
+            "year": meta.release_date_original.split("-")[0],
             "format": file_format,
             "bit_depth": bit_depth,
             "sampling_rate": sampling_rate,
         }
 
-    def _get_format(self, item_dict, is_track_id=False, track_url_dict=None):
+    @property
+    def _max_connections(self):
+        workers = self.track_pool.max_workers if self.track_pool else self.track_workers
+        return workers * self.segments
+
+    def _get_format(self, item, is_track_id=False, track_url_dict=None):
         quality_met = True
         if int(self.quality) == 5:
             return ("MP3", quality_met, None, None)
-        track_dict = item_dict
+        track = item
         if not is_track_id:
-            track_dict = item_dict["tracks"]["items"][0]
+            if not item.tracks:
+                return ("Unknown", quality_met, None, None)
+            track = item.tracks[0]
 
         try:
             new_track_dict = (
-                self.client.get_track_url(track_dict["id"], fmt_id=self.quality)
+                self.client.get_track_url(track.id, fmt_id=self.quality)
                 if not track_url_dict
                 else track_url_dict
             )
+            if not track_url_dict and new_track_dict.get("url"):
+                # connect to the CDN while the cover and booklet are downloaded
+                sessions.warm_up(new_track_dict["url"], self._max_connections)
             restrictions = new_track_dict.get("restrictions")
             if isinstance(restrictions, list):
                 if any(
@@ -305,27 +594,454 @@ class Download:
             return ("Unknown", quality_met, None, None)
 
 
-def tqdm_download(url, fname, desc):
-    r = requests.get(url, allow_redirects=True, stream=True)
-    total = int(r.headers.get("content-length", 0))
-    download_size = 0
-    with open(fname, "wb") as file, tqdm(
+class _UrlPrefetcher:
+    """Signs the URLs of the next `lookahead` tracks of a release in the
+    background while the current one is downloading.
+
+    The responses land in the memo of `qopy.Client`, so the track loop gets
+    them without waiting; URLs that get too close to their expiry before
+    they are used are dropped from the memo and signed again.
+    """
+
+    def __init__(self, client, tracks, fmt_id, lookahead, skip=()):
+        self.client = client
+        self.tracks = tracks
+        self.fmt_id = fmt_id
+        self.lookahead = lookahead
+        # IDs of the tracks that are present or signed already
+        self.skip = set(skip)
+        self._next = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=min(lookahead, 4), thread_name_prefix="qobuz-dl-prefetch"
+        )
+
+    def advance(self, position):
+        "Track `position` is starting: sign the URLs up to `lookahead` after it"
+        with self._lock:
+            last = min(position + self.lookahead, len(self.tracks) - 1)
+            while self._next <= last:
+                if (
+                    self._next > position
+                    and self.tracks[self._next].id not in self.skip
+                ):
+                    self._executor.submit(self._sign, self.tracks[self._next].id)
+                self._next += 1
+
+    def _sign(self, track_id):
+        try:
+            self.client.get_track_url(track_id, fmt_id=self.fmt_id)
+        except Exception as e:
+            # the track loop will try again and report the error
+            logger.debug(f"Couldn't prefetch the URL of track {track_id}: {e}")
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+def tqdm_download(
+    url,
+    fname,
+    desc,
+    identity=None,
+    segments=1,
+    segment_threshold=SEGMENT_THRESHOLD,
+    cancelled=None,
+):
+    """Download `url` into `fname`. A sidecar file (`fname` + RESUME_SUFFIX)
+    records what is being downloaded while the transfer is running, so an
+    interrupted download is resumed with a Range request on the next call
+    instead of starting from scratch.
+
+    :param str identity: stable name of the content. Signed URLs change on
+    every request, so callers should pass e.g. the track and format IDs
+    :param int segments: ranged connections used for files of at least
+    `segment_threshold` bytes, if the server advertises `Accept-Ranges`
+    :param threading.Event cancelled: once set, the download stops with
+    Cancelled and the partial file is kept for resuming
+    """
+    _raise_if_cancelled(cancelled, fname)
+    identity = identity or url
+    offset, total = 0, 0
+    headers = {}
+    state = _load_resume_state(fname, identity)
+    if state and state.get("segments"):
+        if not _valid_segments(state["segments"], state["total"]):
+            logger.debug(f"Invalid segments in the resume state of {fname}")
+            _remove_resume_state(fname)
+            state = None
+    if state and state.get("segments"):
+        try:
+            return _segmented_download(
+                url,
+                fname,
+                desc,
+                identity,
+                state["total"],
+                state["segments"],
+                cancelled,
+            )
+        except _RangeIgnored:
+            logger.debug(f"Can't resume the segments of {fname}")
+            state = None
+    elif state:
+        offset = min(state["written"], os.path.getsize(fname))
+        if offset == state["total"]:
+            # the transfer ended before its sidecar was removed
+            _remove_resume_state(fname)
+            return
+        headers["Range"] = f"bytes={offset}-"
+
+    session = sessions.file_session()
+    r = session.get(url, allow_redirects=True, stream=True, headers=headers)
+    if (
+        offset
+        and r.status_code == 206
+        and _range_total(r) == state["total"]
+        and r.headers.get("content-range", "").startswith(f"bytes {offset}-")
+    ):
+        total = state["total"]
+        logger.debug(f"Resuming {fname} from byte {offset}")
+    else:
+        if offset and r.status_code != 200:
+            # a partial response that doesn't continue the file (e.g. the
+            # content changed): its length isn't the file's, so start over
+            logger.debug(f"Can't resume {fname}: downloading it again")
+            r.close()
+            _remove_resume_state(fname)
+            r = session.get(url, allow_redirects=True, stream=True)
+        r.raise_for_status()
+        if r.status_code != 200:
+            r.close()
+            raise ConnectionError(f"Unexpected response for {fname}: {r.status_code}")
+        offset = 0
+        total = int(r.headers.get("content-length", 0))
+        if (
+            segments > 1
+            and total >= segment_threshold
+            and r.headers.get("accept-ranges", "").lower() == "bytes"
+        ):
+            r.close()
+            try:
+                return _segmented_download(
+                    url,
+                    fname,
+                    desc,
+                    identity,
+                    total,
+                    _split(total, segments),
+                    cancelled,
+                )
+            except _RangeIgnored:
+                logger.debug(f"Range requests ignored, using one stream for {fname}")
+                r = session.get(url, allow_redirects=True, stream=True)
+                r.raise_for_status()
+
+    download_size = offset
+    _save_resume_state(fname, identity, total, download_size)
+    try:
+        with open(fname, "r+b" if offset else "wb") as file, _progress_bar(
+            total, desc, offset
+        ) as bar:
+            if total:
+                _preallocate(file, total)
+            else:
+                file.truncate(offset)
+            file.seek(offset)
+            progress = _Progress(bar)
+            checkpoint = download_size + RESUME_CHECKPOINT
+            for data in _read_chunks(r):
+                _raise_if_cancelled(cancelled, fname)
+                size = file.write(data)
+                progress.update(size)
+                download_size += size
+                if download_size >= checkpoint:
+                    file.flush()
+                    _save_resume_state(fname, identity, total, download_size)
+                    checkpoint = download_size + RESUME_CHECKPOINT
+            progress.flush()
+    finally:
+        # the file is closed (and flushed) here
+        _save_resume_state(fname, identity, total, download_size)
+
+    if total != download_size:
+        # https://stackoverflow.com/questions/69919912/requests-iter-content-thinks-file-is-complete-but-its-not
+        raise ConnectionError("File download was interrupted for " + fname)
+
+    _remove_resume_state(fname)
+
+
+class _RangeIgnored(Exception):
+    pass
+
+
+def _raise_if_cancelled(cancelled, fname):
+    if cancelled is not None and cancelled.is_set():
+        raise Cancelled(f"download of {fname} cancelled")
+
+
+def _read_chunks(r):
+    """Yield the body of the streamed response `r` as memoryviews over one
+    reusable buffer. Chunks grow from MIN_CHUNK_SIZE up to MAX_CHUNK_SIZE
+    while the connection keeps filling them. A view is only valid until the
+    next one is requested."""
+    if r.headers.get("content-encoding", "identity").lower() != "identity":
+        # compressed bodies have to be decoded by requests
+        for data in r.iter_content(chunk_size=MAX_CHUNK_SIZE):
+            yield memoryview(data)
+        return
+
+    buffer = memoryview(bytearray(MAX_CHUNK_SIZE))
+    chunk_size = MIN_CHUNK_SIZE
+    while True:
+        try:
+            size = r.raw.readinto(buffer[:chunk_size])
+        except urllib3.exceptions.HTTPError as e:
+            raise requests.exceptions.ConnectionError(e)
+        if not size:
+            return
+        yield buffer[:size]
+        if size == chunk_size and chunk_size < MAX_CHUNK_SIZE:
+            chunk_size *= 2
+
+
+def _preallocate(file, size):
+    try:
+        os.posix_fallocate(file.fileno(), 0, size)
+    except (AttributeError, OSError):
+        # not available on this platform or file system
+        file.truncate(size)
+
+
+class _Progress:
+    """Forwards byte counts to a progress bar at most every PROGRESS_INTERVAL
+    seconds, instead of redrawing it for every chunk."""
+
+    def __init__(self, bar, lock=None):
+        self.bar = bar
+        self.lock = lock or threading.Lock()
+        self._pending = 0
+        self._next_update = time.monotonic() + PROGRESS_INTERVAL
+
+    def update(self, size):
+        self._pending += size
+        if time.monotonic() >= self._next_update:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            self.bar.update(self._pending)
+        self._pending = 0
+        self._next_update = time.monotonic() + PROGRESS_INTERVAL
+
+
+def _progress_bar(total, desc, initial=0):
+    return tqdm(
         total=total,
+        initial=initial,
         unit="iB",
         unit_scale=True,
         unit_divisor=1024,
         desc=desc,
         bar_format=CYAN + "{n_fmt}/{total_fmt} /// {desc}",
-    ) as bar:
-        for data in r.iter_content(chunk_size=1024):
-            size = file.write(data)
-            bar.update(size)
-            download_size += size
+    )
 
-    if total != download_size:
-        # https://stackoverflow.com/questions/69919912/requests-iter-content-thinks-file-is-complete-but-its-not
+
+def _split(total, count):
+    "Split `total` bytes in `count` [start, end, written] segments"
+    size = -(-total // count)
+    return [[start, min(start + size, total) - 1, 0] for start in range(0, total, size)]
+
+
+def _segmented_download(url, fname, desc, identity, total, segments, cancelled=None):
+    """Download `url` over one ranged connection per segment. Every segment
+    is written at its offset in a file preallocated to `total` bytes.
+
+    :raises _RangeIgnored: if the server doesn't honour the ranges
+    """
+    lock = threading.Lock()
+    offset = sum(segment[2] for segment in segments)
+    if not offset or os.path.getsize(fname) != total:
+        with open(fname, "wb") as file:
+            _preallocate(file, total)
+        for segment in segments:
+            segment[2] = 0
+        offset = 0
+
+    def save_state():
+        with lock:
+            written = sum(segment[2] for segment in segments)
+            _save_resume_state(fname, identity, total, written, segments)
+
+    # set when a segment fails or the download is interrupted: the other
+    # segments stop at their next chunk and save what they wrote
+    stop = threading.Event()
+
+    def stopped():
+        return stop.is_set() or (cancelled is not None and cancelled.is_set())
+
+    save_state()
+    executor = ThreadPoolExecutor(max_workers=len(segments))
+    with _progress_bar(total, desc, offset) as bar:
+        futures = [
+            executor.submit(
+                _download_segment,
+                url,
+                fname,
+                total,
+                segment,
+                bar,
+                lock,
+                save_state,
+                stopped,
+            )
+            for segment in segments
+        ]
+        try:
+            wait(futures, return_when=FIRST_EXCEPTION)
+            for future in futures:
+                if future.done() and future.exception() is not None:
+                    raise future.exception()
+        except (KeyboardInterrupt, Cancelled):
+            # don't wait for the segments in flight
+            stop.set()
+            executor.shutdown(wait=False)
+            raise
+        except BaseException:
+            # e.g. _RangeIgnored: the caller may write the file again, so
+            # the segments have to be stopped first
+            stop.set()
+            executor.shutdown()
+            raise
+        finally:
+            save_state()
+    executor.shutdown()
+
+    if sum(end - start + 1 for start, end, _ in segments) != total or any(
+        written != end - start + 1 for start, end, written in segments
+    ):
         raise ConnectionError("File download was interrupted for " + fname)
 
+    _remove_resume_state(fname)
+
+
+def _download_segment(url, fname, total, segment, bar, lock, save_state, stopped):
+    """Download the missing part of a [start, end, written] segment. `written`
+    only counts flushed bytes, so it can always be trusted for resuming.
+
+    :param stopped: callable, True once the segment has to stop (with
+    Cancelled)
+    """
+    start, end, written = segment
+    first = start + written
+    if first > end:
+        return
+
+    r = sessions.file_session().get(
+        url,
+        allow_redirects=True,
+        stream=True,
+        headers={"Range": f"bytes={first}-{end}"},
+    )
+    if (
+        r.status_code != 206
+        or not r.headers.get("content-range", "").startswith(f"bytes {first}-")
+        or _range_total(r) != total
+    ):
+        r.close()
+        raise _RangeIgnored(f"Unexpected response to a range request: {r.status_code}")
+
+    remaining = end - first + 1
+    unsaved = 0
+    # a few checkpoints per segment, however small the segments are
+    checkpoint = min(RESUME_CHECKPOINT, max(MIN_CHUNK_SIZE, (end - start + 1) // 4))
+    progress = _Progress(bar, lock)
+    with open(fname, "r+b") as file:
+        file.seek(first)
+        try:
+            for data in _read_chunks(r):
+                if stopped():
+                    raise Cancelled(f"download of {fname} cancelled")
+                size = file.write(data[:remaining])
+                remaining -= size
+                unsaved += size
+                progress.update(size)
+                if unsaved >= checkpoint and remaining:
+                    file.flush()
+                    with lock:
+                        segment[2] += unsaved
+                    unsaved = 0
+                    save_state()
+                if not remaining:
+                    break
+        finally:
+            # also when the segment is stopped or fails: the bytes written
+            # so far are kept for resuming
+            file.flush()
+            with lock:
+                segment[2] += unsaved
+            save_state()
+            progress.flush()
+
+
+def _valid_segments(segments, total):
+    "Whether [start, end, written] segments tile `total` bytes in order"
+    expected = 0
+    try:
+        for start, end, written in segments:
+            if start != expected or end < start or not 0 <= written <= end - start + 1:
+                return False
+            expected = end + 1
+    except (TypeError, ValueError):
+        return False
+    return expected == total
+
+
+def _range_total(response):
+    "Total length from a `Content-Range: bytes a-b/total` header (0 if unknown)"
+    try:
+        return int(response.headers["content-range"].rsplit("/", 1)[1])
+    except (KeyError, IndexError, ValueError):
+        return 0
+
+
+def _load_resume_state(fname, identity):
+    """Return the resume state of a partial download of `identity` into
+    `fname`, or None if there's nothing (valid) to resume."""
+    try:
+        with open(fname + RESUME_SUFFIX, "r") as f:
+            state = json.load(f)
+        if (
+            state["identity"] == identity
+            and state["total"] > 0
+            and 0 < state["written"] <= state["total"]
+            and os.path.isfile(fname)
+        ):
+            return state
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def _save_resume_state(fname, identity, total, written, segments=None):
+    state = {"identity": identity, "total": total, "written": written}
+    if segments:
+        state["segments"] = segments
+    state_file = fname + RESUME_SUFFIX
+    try:
+        with open(state_file + ".new", "w") as f:
+            json.dump(state, f)
+        os.replace(state_file + ".new", state_file)
+    except OSError as e:
+        logger.debug(f"Couldn't save resume state of {fname}: {e}")
+
+
+def _remove_resume_state(fname):
+    try:
+        os.remove(fname + RESUME_SUFFIX)
+    except FileNotFoundError:
+        pass
+
 
 def _get_description(item: dict, track_title, multiple=None):
     downloading_title = f"{track_title} "
@@ -335,9 +1051,9 @@ def _get_description(item: dict, track_title, multiple=None):
     return downloading_title
 
 
-def _get_title(item_dict):
-    album_title = item_dict["title"]
-    version = item_dict.get("version")
+def _get_title(item):
+    album_title = item.title
+    version = item.version
     if version:
         album_title = (
             f"{album_title} ({version})"
@@ -349,7 +1065,8 @@ def _get_title(item_dict):
 
 def _get_extra(item, dirn, extra="cover.jpg", og_quality=False):
     extra_file = os.path.join(dirn, extra)
-    if os.path.isfile(extra_file):
+    # a resume sidecar means the file is incomplete
+    if os.path.isfile(extra_file) and not os.path.isfile(extra_file + RESUME_SUFFIX):
         logger.info(f"{OFF}{extra} was already downloaded")
         return
     tqdm_download(
@@ -384,22 +1101,3 @@ def _clean_format_str(folder: str, track: str, file_format: str) -> Tuple[str, s
         final.append(fs)
 
     return tuple(final)
-
-
-def _safe_get(d: dict, *keys, default=None):
-    """A replacement for chained `get()` statements on dicts:
-    >>> d = {'foo': {'bar': 'baz'}}
-    >>> _safe_get(d, 'baz')
-    None
-    >>> _safe_get(d, 'foo', 'bar')
-    'baz'
-    """
-    curr = d
-    res = default
-    for key in keys:
-        res = curr.get(key, default)
-        if res == default or not hasattr(res, "__getitem__"):
-            return res
-        else:
-            curr = res
-    return res
@@ -0,0 +1,124 @@
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+IN_PROGRESS = "in-progress"
+DONE = "done"
+FAILED = "failed"
+UNFINISHED = (PENDING, IN_PROGRESS)
+
+
+class JobQueue:
+    """Persistent record of a `dl` run, so an interrupted run can be resumed
+    without resolving its URLs again.
+
+    Every URL of the run is a job. Its items, the albums and tracks it
+    expands to, are child jobs recorded as the URL is expanded. A URL job
+    is done once it's fully expanded, and an item job once it's downloaded
+    (or skipped). Items left pending or in progress by a crash are picked
+    up by `qobuz-dl dl --resume`; the ones that failed by `--retry-failed`.
+
+    :param str path: SQLite file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, "
+                "parent INTEGER, kind TEXT NOT NULL, source TEXT NOT NULL, "
+                "path TEXT, m3u INTEGER NOT NULL DEFAULT 0, state TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, error TEXT, "
+                "updated REAL NOT NULL, UNIQUE (parent, kind, source))"
+            )
+
+    def _execute(self, sql, args=()):
+        with self._lock, self._conn:
+            return self._conn.execute(sql, args)
+
+    def clear(self):
+        "Forget the previous run"
+        self._execute("DELETE FROM jobs")
+
+    def add_url(self, url):
+        "Record a URL of the run and return its job ID"
+        return self._execute(
+            "INSERT INTO jobs (kind, source, state, updated) VALUES ('url', ?, ?, ?)",
+            (url, PENDING, time.time()),
+        ).lastrowid
+
+    def expanding(self, job_id, path, m3u=False):
+        """The URL of `job_id` is being expanded into `path`; with `m3u`, a
+        playlist file is written there once its items are downloaded"""
+        self._execute(
+            "UPDATE jobs SET state=?, path=?, m3u=?, attempts=attempts + 1, "
+            "updated=? WHERE id=?",
+            (IN_PROGRESS, path, int(m3u), time.time(), job_id),
+        )
+
+    def add_item(self, parent, item_id, album, path):
+        """Record an album (or track) of the URL job `parent`, unless it was
+        already recorded by a previous attempt, and return its row"""
+        kind = "album" if album else "track"
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO jobs (parent, kind, source, path, state, "
+                "updated) VALUES (?, ?, ?, ?, ?, ?)",
+                (parent, kind, str(item_id), path, PENDING, time.time()),
+            )
+            return self._conn.execute(
+                "SELECT * FROM jobs WHERE parent=? AND kind=? AND source=?",
+                (parent, kind, str(item_id)),
+            ).fetchone()
+
+    def start(self, job_id):
+        self._execute(
+            "UPDATE jobs SET state=?, attempts=attempts + 1, updated=? WHERE id=?",
+            (IN_PROGRESS, time.time(), job_id),
+        )
+
+    def finish(self, job_id):
+        self._execute(
+            "UPDATE jobs SET state=?, error=NULL, updated=? WHERE id=?",
+            (DONE, time.time(), job_id),
+        )
+
+    def fail(self, job_id, error):
+        self._execute(
+            "UPDATE jobs SET state=?, error=?, updated=? WHERE id=?",
+            (FAILED, str(error), time.time(), job_id),
+        )
+
+    def urls(self):
+        "URL jobs, in the order of the run"
+        return self._execute(
+            "SELECT * FROM jobs WHERE kind='url' ORDER BY id"
+        ).fetchall()
+
+    def items(self, parent, states):
+        "Item jobs of `parent` in one of `states`, in the order of expansion"
+        return self._execute(
+            f"SELECT * FROM jobs WHERE parent=? AND state IN "
+            f"({', '.join('?' * len(states))}) ORDER BY id",
+            (parent, *states),
+        ).fetchall()
+
+    def counts(self):
+        "Number of album and track jobs per state"
+        return dict(
+            self._execute(
+                "SELECT state, COUNT(*) FROM jobs WHERE kind!='url' GROUP BY state"
+            ).fetchall()
+        )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
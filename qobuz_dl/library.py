@@ -0,0 +1,303 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from mutagen import MutagenError
+from mutagen.flac import FLAC
+from mutagen.mp3 import MP3
+
+from qobuz_dl.color import GREEN, OFF, YELLOW
+from qobuz_dl.db import BUSY_TIMEOUT
+from qobuz_dl.metadata import ALBUM_ID_TAG, TRACK_ID_TAG
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = (".flac", ".mp3")
+# files tagged before their rows are written in one transaction
+BATCH_SIZE = 256
+# seconds between progress lines of a scan
+PROGRESS_INTERVAL = 5
+
+
+def _first(value):
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+    if value is None:
+        return None
+    return str(value).strip() or None
+
+
+def _number(value):
+    "The number of '3' or '3/12'"
+    value = _first(value)
+    try:
+        return int(value.split("/")[0]) if value else None
+    except ValueError:
+        return None
+
+
+def _read_flac(path):
+    audio = FLAC(path)
+    tags = audio.tags or {}
+
+    def tag(name):
+        return _first(tags.get(name))
+
+    return {
+        "track_id": tag(TRACK_ID_TAG),
+        "album_id": tag(ALBUM_ID_TAG),
+        "isrc": tag("ISRC"),
+        "title": tag("TITLE"),
+        "album": tag("ALBUM"),
+        "track_number": _number(tags.get("TRACKNUMBER")),
+        "track_total": _number(tags.get("TRACKTOTAL")),
+        "lossless": True,
+        "bit_depth": audio.info.bits_per_sample,
+        "sampling_rate": audio.info.sample_rate,
+    }
+
+
+def _read_mp3(path):
+    audio = MP3(path)
+    tags = audio.tags
+
+    def tag(name):
+        frame = tags.get(name) if tags is not None else None
+        return _first(frame.text) if frame is not None else None
+
+    track = tag("TRCK")
+    return {
+        "track_id": tag(f"TXXX:{TRACK_ID_TAG}"),
+        "album_id": tag(f"TXXX:{ALBUM_ID_TAG}"),
+        "isrc": tag("TSRC"),
+        "title": tag("TIT2"),
+        "album": tag("TALB"),
+        "track_number": _number(track),
+        "track_total": _number(track.split("/")[1]) if track and "/" in track else None,
+        "lossless": False,
+        "bit_depth": None,
+        "sampling_rate": audio.info.sample_rate,
+    }
+
+
+def read_tags(path):
+    """Read the tags the index needs from a FLAC or MP3 file.
+
+    :returns: a dict, or None if the file can't be read
+    """
+    try:
+        if path.lower().endswith(".flac"):
+            return _read_flac(path)
+        return _read_mp3(path)
+    except (MutagenError, OSError) as e:
+        logger.debug(f"Couldn't read the tags of {path}: {e}")
+
+
+def _walk(directory):
+    "Yield (path, mtime, size) of the audio files under `directory`"
+    stack = [directory]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError as e:
+            logger.debug(f"Couldn't list {e.filename}: {e}")
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.lower().endswith(EXTENSIONS) and (
+                        not entry.name.startswith(".")
+                    ):
+                        stat = entry.stat()
+                        yield entry.path, stat.st_mtime, stat.st_size
+                except OSError:
+                    continue
+
+
+class LibraryIndex:
+    """Tags of the audio files of an existing library, in a SQLite file.
+
+    `scan` fills it from a directory (re-reading only the files whose mtime
+    or size changed since the last scan), and downloads look tracks and
+    releases up in it before calling the API: by Qobuz ID for files tagged
+    by qobuz-dl, and by ISRC and album title for the others.
+
+    The index only tells lossy files from lossless ones: any file satisfies
+    an MP3 download, and only FLAC files satisfy the others.
+
+    :param str path: SQLite file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT}")
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, "
+                "mtime REAL NOT NULL, size INTEGER NOT NULL, track_id TEXT, "
+                "album_id TEXT, isrc TEXT, title TEXT, album TEXT, "
+                "track_number INTEGER, track_total INTEGER, "
+                "lossless INTEGER NOT NULL, bit_depth INTEGER, sampling_rate INTEGER)"
+            )
+            for column in ("track_id", "album_id", "isrc"):
+                self._conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS files_{column} ON files ({column})"
+                )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def scan(self, directory, workers=None):
+        """Index the audio files under `directory` and forget the indexed
+        files under it that are gone.
+
+        :param int workers: files read at the same time (default: CPU count)
+        :returns: dict with the number of files seen, read, unreadable and
+        removed
+        """
+        directory = os.path.abspath(directory)
+        prefix = os.path.join(directory, "")
+        with self._lock:
+            known = {
+                path: (mtime, size)
+                for path, mtime, size in self._conn.execute(
+                    "SELECT path, mtime, size FROM files WHERE substr(path, 1, ?) = ?",
+                    (len(prefix), prefix),
+                )
+            }
+        stats = {"files": 0, "read": 0, "unreadable": 0, "removed": 0}
+        seen = set()
+
+        def changed():
+            for path, mtime, size in _walk(directory):
+                stats["files"] += 1
+                seen.add(path)
+                if known.get(path) != (mtime, size):
+                    yield path, mtime, size
+
+        def read(file):
+            return file, read_tags(file[0])
+
+        batch = []
+        next_progress = time.monotonic() + PROGRESS_INTERVAL
+        with ThreadPoolExecutor(
+            max_workers=workers or os.cpu_count(), thread_name_prefix="qobuz-dl-index"
+        ) as executor:
+            # map() keeps every file in flight: feed it in slices so memory
+            # stays flat on large libraries
+            files = changed()
+            while True:
+                chunk = [file for _, file in zip(range(BATCH_SIZE), files)]
+                if not chunk:
+                    break
+                for (path, mtime, size), tags in executor.map(read, chunk):
+                    if tags is None:
+                        stats["unreadable"] += 1
+                        continue
+                    stats["read"] += 1
+                    batch.append((path, mtime, size, tags))
+                self._write(batch)
+                batch = []
+                if time.monotonic() >= next_progress:
+                    logger.info(f"{OFF}{stats['files']} files, {stats['read']} indexed")
+                    next_progress = time.monotonic() + PROGRESS_INTERVAL
+
+        gone = [(path,) for path in known if path not in seen]
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM files WHERE path=?", gone)
+        stats["removed"] = len(gone)
+        return stats
+
+    def _write(self, batch):
+        if not batch:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO files VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (
+                        path,
+                        mtime,
+                        size,
+                        tags["track_id"],
+                        tags["album_id"],
+                        tags["isrc"],
+                        tags["title"],
+                        tags["album"],
+                        tags["track_number"],
+                        tags["track_total"],
+                        tags["lossless"],
+                        tags["bit_depth"],
+                        tags["sampling_rate"],
+                    )
+                    for path, mtime, size, tags in batch
+                ),
+            )
+
+    @staticmethod
+    def _quality_clause(lossless):
+        return " AND lossless=1" if lossless else ""
+
+    def has_track(self, track_id, lossless=True, isrc=None, album=None):
+        """Whether the library has the track: a file tagged with its Qobuz
+        ID or, if `isrc` and `album` are given, an untagged file with the
+        same ISRC on an album with the same title.
+
+        :param bool lossless: only count FLAC files
+        """
+        quality = self._quality_clause(lossless)
+        with self._lock:
+            if self._conn.execute(
+                f"SELECT 1 FROM files WHERE track_id=?{quality} LIMIT 1",
+                (str(track_id),),
+            ).fetchone():
+                return True
+            if not isrc or not album:
+                return False
+            # the same recording is on many releases: only match this one
+            return bool(
+                self._conn.execute(
+                    "SELECT 1 FROM files WHERE isrc=? AND track_id IS NULL "
+                    f"AND album=? COLLATE NOCASE{quality} LIMIT 1",
+                    (isrc, album),
+                ).fetchone()
+            )
+
+    def has_release(self, album_id, lossless=True):
+        """Whether the library has every track of a release, going by the
+        files tagged with its Qobuz ID and their track total"""
+        with self._lock:
+            count, total = self._conn.execute(
+                "SELECT COUNT(DISTINCT track_id), MAX(track_total) FROM files "
+                f"WHERE album_id=? AND track_id IS NOT NULL"
+                f"{self._quality_clause(lossless)}",
+                (str(album_id),),
+            ).fetchone()
+        return bool(total) and count >= total
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def index_library(index, directory, workers=None):
+    "Scan `directory` into `index`, logging the progress and the result"
+    logger.info(f"{YELLOW}Indexing {directory}...")
+    start = time.monotonic()
+    stats = index.scan(directory, workers)
+    logger.info(
+        f"{GREEN}{stats['files']} files in {time.monotonic() - start:.1f}s: "
+        f"{stats['read']} (re)indexed, {stats['unreadable']} unreadable, "
+        f"{stats['removed']} removed. {len(index)} files in the index."
+    )
+    return stats
@@ -6,6 +6,8 @@ from mutagen.flac import FLAC, Picture
 import mutagen.id3 as id3
 from mutagen.id3 import ID3NoHeaderError
 
+from qobuz_dl.records import Album, Track
+
 logger = logging.getLogger(__name__)
 
 
@@ -14,6 +16,10 @@ COPYRIGHT, PHON_COPYRIGHT = "\u2117", "\u00a9"
 # if a metadata block exceeds this, mutagen will raise error
 # and the file won't be tagged
 FLAC_MAX_BLOCKSIZE = 16777215
+# Qobuz IDs, so library.LibraryIndex can match files to releases and tracks
+# (Vorbis comments in FLAC files, TXXX frames in MP3 files)
+TRACK_ID_TAG = "QOBUZ_TRACK_ID"
+ALBUM_ID_TAG = "QOBUZ_ALBUM_ID"
 
 ID3_LEGEND = {
     "album": id3.TALB,
@@ -32,14 +38,13 @@ ID3_LEGEND = {
 }
 
 
-def _get_title(track_dict):
-    title = track_dict["title"]
-    version = track_dict.get("version")
-    if version:
-        title = f"{title} ({version})"
+def _get_title(track):
+    title = track.title
+    if track.version:
+        title = f"{title} ({track.version})"
     # for classical works
-    if track_dict.get("work"):
-        title = f"{track_dict['work']}: {title}"
+    if track.work:
+        title = f"{track.work}: {title}"
 
     return title
 
@@ -107,9 +112,8 @@ def _embed_id3_img(root_dir, audio: id3.ID3):
         audio.add(id3.APIC(3, "image/jpeg", 3, "", cover.read()))
 
 
-# Use KeyError catching instead of dict.get to avoid empty tags
 def tag_flac(
-    filename, root_dir, final_name, d: dict, album, istrack=True, em_image=False
+    filename, root_dir, final_name, d: Track, album: Album, istrack=True, em_image=False
 ):
     """
     Tag a FLAC file
@@ -117,47 +121,38 @@ def tag_flac(
     :param str filename: FLAC file path
     :param str root_dir: Root dir used to get the cover art
     :param str final_name: Final name of the FLAC file (complete path)
-    :param dict d: Track dictionary from Qobuz_client
-    :param dict album: Album dictionary from Qobuz_client
+    :param Track d: Track record
+    :param Album album: Album record (unused for single tracks, whose
+    album is `d.album`)
     :param bool istrack
     :param bool em_image: Embed cover art into file
     """
     audio = FLAC(filename)
+    release = d.album if istrack else album
 
     audio["TITLE"] = _get_title(d)
 
-    audio["TRACKNUMBER"] = str(d["track_number"])  # TRACK NUMBER
+    audio["TRACKNUMBER"] = str(d.track_number)  # TRACK NUMBER
 
     if "Disc " in final_name:
-        audio["DISCNUMBER"] = str(d["media_number"])
-
-    try:
-        audio["COMPOSER"] = d["composer"]["name"]  # COMPOSER
-    except KeyError:
-        pass
-
-    artist_ = d.get("performer", {}).get("name")  # TRACK ARTIST
-    if istrack:
-        audio["ARTIST"] = artist_ or d["album"]["artist"]["name"]  # TRACK ARTIST
-    else:
-        audio["ARTIST"] = artist_ or album["artist"]["name"]
-
-    audio["LABEL"] = album.get("label", {}).get("name", "n/a")
-
-    if istrack:
-        audio["GENRE"] = _format_genres(d["album"]["genres_list"])
-        audio["ALBUMARTIST"] = d["album"]["artist"]["name"]
-        audio["TRACKTOTAL"] = str(d["album"]["tracks_count"])
-        audio["ALBUM"] = d["album"]["title"]
-        audio["DATE"] = d["album"]["release_date_original"]
-        audio["COPYRIGHT"] = _format_copyright(d.get("copyright") or "n/a")
-    else:
-        audio["GENRE"] = _format_genres(album["genres_list"])
-        audio["ALBUMARTIST"] = album["artist"]["name"]
-        audio["TRACKTOTAL"] = str(album["tracks_count"])
-        audio["ALBUM"] = album["title"]
-        audio["DATE"] = album["release_date_original"]
-        audio["COPYRIGHT"] = _format_copyright(album.get("copyright") or "n/a")
+        audio["DISCNUMBER"] = str(d.media_number)
+
+    if d.composer:
+        audio["COMPOSER"] = d.composer  # COMPOSER
+
+    audio["ARTIST"] = d.performer or release.artist.name  # TRACK ARTIST
+    audio["LABEL"] = release.label or "n/a"
+    audio["GENRE"] = _format_genres(release.genres_list)
+    audio["ALBUMARTIST"] = release.artist.name
+    audio["TRACKTOTAL"] = str(release.tracks_count)
+    audio["ALBUM"] = release.title
+    audio["DATE"] = release.release_date_original
+    copyright_ = d.copyright if istrack else release.copyright
+    audio["COPYRIGHT"] = _format_copyright(copyright_ or "n/a")
+    if d.isrc:
+        audio["ISRC"] = d.isrc
+    audio[TRACK_ID_TAG] = str(d.id)
+    audio[ALBUM_ID_TAG] = str(release.id)
 
     if em_image:
         _embed_flac_img(root_dir, audio)
@@ -166,14 +161,17 @@ def tag_flac(
     os.rename(filename, final_name)
 
 
-def tag_mp3(filename, root_dir, final_name, d, album, istrack=True, em_image=False):
+def tag_mp3(
+    filename, root_dir, final_name, d: Track, album: Album, istrack=True, em_image=False
+):
     """
     Tag an mp3 file
 
     :param str filename: mp3 temporary file path
     :param str root_dir: Root dir used to get the cover art
     :param str final_name: Final name of the mp3 file (complete path)
-    :param dict d: Track dictionary from Qobuz_client
+    :param Track d: Track record
+    :param Album album: Album record (unused for single tracks)
     :param bool istrack
     :param bool em_image: Embed cover art into file
     """
@@ -182,45 +180,36 @@ def tag_mp3(filename, root_dir, final_name, d, album, istrack=True, em_image=Fal
         audio = id3.ID3(filename)
     except ID3NoHeaderError:
         audio = id3.ID3()
+    release = d.album if istrack else album
 
     # temporarily holds metadata
     tags = dict()
     tags["title"] = _get_title(d)
-    try:
-        tags["label"] = album["label"]["name"]
-    except KeyError:
-        pass
-
-    artist_ = d.get("performer", {}).get("name")  # TRACK ARTIST
-    if istrack:
-        tags["artist"] = artist_ or d["album"]["artist"]["name"]  # TRACK ARTIST
-    else:
-        tags["artist"] = artist_ or album["artist"]["name"]
-
-    if istrack:
-        tags["genre"] = _format_genres(d["album"]["genres_list"])
-        tags["albumartist"] = d["album"]["artist"]["name"]
-        tags["album"] = d["album"]["title"]
-        tags["date"] = d["album"]["release_date_original"]
-        tags["copyright"] = _format_copyright(d["copyright"])
-        tracktotal = str(d["album"]["tracks_count"])
-    else:
-        tags["genre"] = _format_genres(album["genres_list"])
-        tags["albumartist"] = album["artist"]["name"]
-        tags["album"] = album["title"]
-        tags["date"] = album["release_date_original"]
-        tags["copyright"] = _format_copyright(album["copyright"])
-        tracktotal = str(album["tracks_count"])
+    if release.label:
+        tags["label"] = release.label
+
+    tags["artist"] = d.performer or release.artist.name  # TRACK ARTIST
+    tags["genre"] = _format_genres(release.genres_list)
+    tags["albumartist"] = release.artist.name
+    tags["album"] = release.title
+    tags["date"] = release.release_date_original
+    copyright_ = d.copyright if istrack else release.copyright
+    tags["copyright"] = _format_copyright(copyright_ or "n/a")
+    if d.isrc:
+        tags["isrc"] = d.isrc
+    tracktotal = str(release.tracks_count)
 
     tags["year"] = tags["date"][:4]
 
-    audio["TRCK"] = id3.TRCK(encoding=3, text=f'{d["track_number"]}/{tracktotal}')
-    audio["TPOS"] = id3.TPOS(encoding=3, text=str(d["media_number"]))
+    audio["TRCK"] = id3.TRCK(encoding=3, text=f"{d.track_number}/{tracktotal}")
+    audio["TPOS"] = id3.TPOS(encoding=3, text=str(d.media_number))
 
     # write metadata in `tags` to file
     for k, v in tags.items():
         id3tag = ID3_LEGEND[k]
         audio[id3tag.__name__] = id3tag(encoding=3, text=v)
+    for desc, value in ((TRACK_ID_TAG, d.id), (ALBUM_ID_TAG, release.id)):
+        audio.add(id3.TXXX(encoding=3, desc=desc, text=str(value)))
 
     if em_image:
         _embed_id3_img(root_dir, audio)
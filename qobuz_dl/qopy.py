@@ -4,10 +4,16 @@
 
 import hashlib
 import logging
+import threading
 import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+from urllib.parse import parse_qs, urlsplit
 
 import requests
 
+from qobuz_dl.bundle import Bundle
 from qobuz_dl.exceptions import (
     AuthenticationError,
     IneligibleError,
@@ -16,111 +22,209 @@ from qobuz_dl.exceptions import (
     InvalidQuality,
 )
 from qobuz_dl.color import GREEN, YELLOW
+from qobuz_dl.ratelimit import RateLimiter
+from qobuz_dl.records import loads
+from qobuz_dl.sessions import DEFAULT_POOL_SIZE, new_session
 
 RESET = "Reset your credentials with 'qobuz-dl -r'"
 
+API_URL = "https://www.qobuz.com/api.json/0.2/"
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:83.0) Gecko/20100101 Firefox/83.0"
+
+# seconds a response is shared by identical calls within a run. Pages of
+# artists, labels and playlists are streamed, so they are only shared while
+# in flight instead of being held in memory
+MEMO_TTLS = {
+    "album/get": 600,
+    "track/get": 600,
+    "artist/get": 0,
+    "label/get": 0,
+    "playlist/get": 0,
+    "track/getFileUrl": 300,
+}
+# items per page of artist/get, label/get and playlist/get
+PAGE_SIZE = 500
+# pages fetched at the same time after the first one
+PAGE_WORKERS = 4
+# attempts for a page that fails with a network error (throttled calls are
+# retried by the rate limiter)
+PAGE_RETRIES = 3
+# signed URLs are dropped from the memo this many seconds before they expire
+URL_EXPIRY_MARGIN = 30
+
 logger = logging.getLogger(__name__)
 
 
+class _RequestMemo:
+    """Single-flight memo: identical calls that are in flight at the same time
+    share one request, and recent responses are reused until they expire.
+    Responses are shared, so callers must not modify them."""
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._in_flight = {}
+
+    def call(self, key, func, get_ttl):
+        """Return the response for `key`, calling `func` only if there isn't
+        a valid one. `get_ttl(response)` returns how long it stays valid."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry[1]
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            response = func()
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        ttl = get_ttl(response)
+        with self._lock:
+            del self._in_flight[key]
+            if ttl > 0:
+                self._entries[key] = (time.monotonic() + ttl, response)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        future.set_result(response)
+        return response
+
+
 class Client:
-    def __init__(self, email, pwd, app_id, secrets):
+    def __init__(
+        self,
+        email,
+        pwd,
+        app_id,
+        secrets,
+        pool_size=DEFAULT_POOL_SIZE,
+        cache=None,
+        session_store=None,
+        bundle_cache=None,
+        api_url=API_URL,
+        player_url=None,
+    ):
         logger.info(f"{YELLOW}Logging...")
         self.secrets = secrets
         self.id = str(app_id)
-        self.session = requests.Session()
+        # API calls get their own pool, separate from the CDN downloads
+        self.session = new_session(pool_size)
         self.session.headers.update(
             {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:83.0) Gecko/20100101 Firefox/83.0",
+                "User-Agent": USER_AGENT,
                 "X-App-Id": self.id,
                 "Content-Type": "application/json;charset=UTF-8"
 
             }
         )
-        self.base = "https://www.qobuz.com/api.json/0.2/"
+        self.base = api_url
+        self.uat = None
         self.sec = None
-        self.auth(email, pwd)
-        self.cfg_setup()
+        # optional credentials.SessionStore to skip login and secret probing
+        self.session_store = session_store
+        self._email = email
+        self._pwd = pwd
+        self._renew_lock = threading.Lock()
+        # JSON file used by bundle.Bundle when the tokens have to be refreshed
+        self.bundle_cache = bundle_cache
+        # web player the tokens are refreshed from, None for play.qobuz.com
+        self.player_url = player_url
+        # optional cache.MetadataCache
+        self.cache = cache
+        self.memo_ttls = dict(MEMO_TTLS)
+        self.url_expiry_margin = URL_EXPIRY_MARGIN
+        self.page_workers = PAGE_WORKERS
+        self._memo = _RequestMemo()
+        # adapts the calls in flight to the server's throttling
+        self.limiter = RateLimiter()
+        if not self._restore_session():
+            try:
+                self.auth(email, pwd)
+            except InvalidAppIdError:
+                if not self._refresh_tokens():
+                    raise
+            self._find_secret()
+            self._save_session()
 
     def api_call(self, epoint, **kwargs):
-        if epoint == "user/login":
-            params = {
-                "email": kwargs["email"],
-                "password": kwargs["pwd"],
-                "app_id": self.id,
-            }
-        elif epoint == "track/get":
-            params = {"track_id": kwargs["id"]}
-        elif epoint == "album/get":
-            params = {"album_id": kwargs["id"]}
-        elif epoint == "playlist/get":
-            params = {
-                "extra": "tracks",
-                "playlist_id": kwargs["id"],
-                "limit": 500,
-                "offset": kwargs["offset"],
-            }
-        elif epoint == "artist/get":
-            params = {
-                "app_id": self.id,
-                "artist_id": kwargs["id"],
-                "limit": 500,
-                "offset": kwargs["offset"],
-                "extra": "albums",
-            }
-        elif epoint == "label/get":
-            params = {
-                "label_id": kwargs["id"],
-                "limit": 500,
-                "offset": kwargs["offset"],
-                "extra": "albums",
-            }
-        elif epoint == "favorite/getUserFavorites":
-            unix = time.time()
-            # r_sig = "userLibrarygetAlbumsList" + str(unix) + kwargs["sec"]
-            r_sig = "favoritegetUserFavorites" + str(unix) + kwargs["sec"]
-            r_sig_hashed = hashlib.md5(r_sig.encode("utf-8")).hexdigest()
-            params = {
-                "app_id": self.id,
-                "user_auth_token": self.uat,
-                "type": "albums",
-                "request_ts": unix,
-                "request_sig": r_sig_hashed,
-            }
-        elif epoint == "track/getFileUrl":
-            unix = time.time()
-            track_id = kwargs["id"]
-            fmt_id = kwargs["fmt_id"]
-            if int(fmt_id) not in (5, 6, 7, 27):
-                raise InvalidQuality("Invalid quality id: choose between 5, 6, 7 or 27")
-            r_sig = "trackgetFileUrlformat_id{}intentstreamtrack_id{}{}{}".format(
-                fmt_id, track_id, unix, kwargs.get("sec", self.sec)
-            )
-            r_sig_hashed = hashlib.md5(r_sig.encode("utf-8")).hexdigest()
-            params = {
-                "request_ts": unix,
-                "request_sig": r_sig_hashed,
-                "track_id": track_id,
-                "format_id": fmt_id,
-                "intent": "stream",
-            }
-        else:
-            params = kwargs
-        r = self.session.get(self.base + epoint, params=params)
-        if epoint == "user/login":
-            if r.status_code == 401:
-                raise AuthenticationError("Invalid credentials.\n" + RESET)
-            elif r.status_code == 400:
-                raise InvalidAppIdError("Invalid app id.\n" + RESET)
-            else:
-                logger.info(f"{GREEN}Logged: OK")
-        elif (
-            epoint in ["track/getFileUrl", "favorite/getUserFavorites"]
-            and r.status_code == 400
-        ):
-            raise InvalidAppSecretError(f"Invalid app secret: {r.json()}.\n" + RESET)
+        # secrets being tested are never shared
+        if epoint not in self.memo_ttls or "sec" in kwargs:
+            return self._api_call(epoint, **kwargs)
+
+        key = (epoint,) + tuple(sorted((k, str(v)) for k, v in kwargs.items()))
+        return self._memo.call(
+            key,
+            lambda: self._api_call(epoint, **kwargs),
+            lambda response: self._memo_ttl(epoint, response),
+        )
+
+    def _memo_ttl(self, epoint, response):
+        ttl = self.memo_ttls[epoint]
+        if epoint == "track/getFileUrl":
+            expiry = url_expiry(response.get("url"))
+            if expiry is not None:
+                ttl = min(ttl, expiry - time.time() - self.url_expiry_margin)
+        return ttl
+
+    def _api_call(self, epoint, **kwargs):
+        # logins and secret probes are never retried
+        if epoint == "user/login" or "sec" in kwargs:
+            return self._request(epoint, **kwargs)
+
+        # an expired token and a rejected secret are renewed once each
+        renewed = set()
+        while True:
+            uat, sec = self.uat, self.sec
+            try:
+                return self._request(epoint, **kwargs)
+            except requests.exceptions.HTTPError as e:
+                status = getattr(e.response, "status_code", None)
+                if status != 401 or "login" in renewed:
+                    raise
+                renewed.add("login")
+                self._renew_login(uat)
+            except InvalidAppSecretError:
+                if sec is None or "secret" in renewed:
+                    raise
+                renewed.add("secret")
+                self._renew_secret(sec)
+
+    def _request(self, epoint, **kwargs):
+        params = request_params(epoint, self.id, self.uat, self.sec, **kwargs)
+        if self.cache is not None:
+            cached = self.cache.get(epoint, params)
+            if cached is not None:
+                return cached
+        for attempt in range(self.limiter.retries + 1):
+            with self.limiter.slot(epoint) as slot:
+                r = self.session.get(self.base + epoint, params=params)
+                slot.record(r)
+            if not slot.retry or attempt == self.limiter.retries:
+                break
+            delay = self.limiter.backoff(attempt, slot.retry_after)
+            logger.debug(f"{epoint} returned {r.status_code}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+            # signatures are timestamped
+            params = request_params(epoint, self.id, self.uat, self.sec, **kwargs)
+        check_status(epoint, r.status_code, lambda: loads(r.content))
 
         r.raise_for_status()
-        return r.json()
+        response = loads(r.content)
+        if self.cache is not None:
+            self.cache.set(epoint, params, response)
+        return response
 
     def auth(self, email, pwd):
         usr_info = self.api_call("user/login", email=email, pwd=pwd)
@@ -131,21 +235,94 @@ class Client:
         self.label = usr_info["user"]["credential"]["parameters"]["short_label"]
         logger.info(f"{GREEN}Membership: {self.label}")
 
+    def _restore_session(self):
+        if self.session_store is None:
+            return False
+        session = self.session_store.load(self._email, self._pwd, self.id)
+        if session is None:
+            return False
+        self.uat = session["user_auth_token"]
+        self.session.headers.update({"X-User-Auth-Token": self.uat})
+        self.sec = session["secret"]
+        self.label = session.get("label")
+        logger.info(f"{GREEN}Logged: OK (saved session)")
+        if self.label:
+            logger.info(f"{GREEN}Membership: {self.label}")
+        return True
+
+    def _save_session(self):
+        if self.session_store is not None:
+            self.session_store.save(
+                self._email, self._pwd, self.id, self.uat, self.sec, self.label
+            )
+
+    def _renew_login(self, stale_uat):
+        with self._renew_lock:
+            # another thread may have logged in already
+            if self.uat != stale_uat:
+                return
+            logger.info(f"{YELLOW}Session expired, logging in again...")
+            self.auth(self._email, self._pwd)
+            self._save_session()
+
+    def _renew_secret(self, stale_sec):
+        with self._renew_lock:
+            if self.sec != stale_sec:
+                return
+            logger.info(f"{YELLOW}App secret rejected, probing secrets again...")
+            try:
+                self._find_secret()
+            except InvalidAppSecretError:
+                if self.session_store is not None:
+                    self.session_store.clear()
+                raise
+            self._save_session()
+
     def multi_meta(self, epoint, key, id, type):
-        total = 1
-        offset = 0
-        while total > 0:
-            if type in ["tracks", "albums"]:
-                j = self.api_call(epoint, id=id, offset=offset, type=type)[type]
-            else:
+        """Yield every page of a paginated endpoint, in offset order.
+
+        The first page tells how many items there are (`key`); the remaining
+        pages are fetched `page_workers` at a time, and only that many are
+        held before they are yielded.
+        """
+        first = self._get_page(epoint, id, 0, type)
+        yield first
+        offsets = iter(range(PAGE_SIZE, first[key], PAGE_SIZE))
+        if self.page_workers <= 1:
+            for offset in offsets:
+                yield self._get_page(epoint, id, offset, type)
+            return
+
+        with ThreadPoolExecutor(
+            max_workers=self.page_workers, thread_name_prefix="qobuz-dl-page"
+        ) as executor:
+            window = deque(
+                executor.submit(self._get_page, epoint, id, offset, type)
+                for offset in islice(offsets, self.page_workers)
+            )
+            while window:
+                page = window.popleft().result()
+                offset = next(offsets, None)
+                if offset is not None:
+                    window.append(
+                        executor.submit(self._get_page, epoint, id, offset, type)
+                    )
+                yield page
+
+    def _get_page(self, epoint, id, offset, type):
+        "Get one page, retrying it on its own if it fails"
+        for attempt in range(PAGE_RETRIES + 1):
+            try:
                 j = self.api_call(epoint, id=id, offset=offset, type=type)
-            if offset == 0:
-                yield j
-                total = j[key] - 500
-            else:
-                yield j
-                total -= 500
-            offset += 500
+                return j[type] if type in ["tracks", "albums"] else j
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ) as e:
+                if attempt == PAGE_RETRIES:
+                    raise
+                logger.debug(f"Retrying {epoint} at offset {offset}: {e}")
+                time.sleep(2**attempt)
 
     def get_album_meta(self, id):
         return self.api_call("album/get", id=id)
@@ -202,15 +379,138 @@ class Client:
         except InvalidAppSecretError:
             return False
 
-    def cfg_setup(self):
-        for secret in self.secrets:
-            # Falsy secrets
-            if not secret:
-                continue
+    def _refresh_tokens(self):
+        """Get the app ID and secrets of the current web player, logging in
+        again if the app ID changed.
 
-            if self.test_secret(secret):
-                self.sec = secret
-                break
+        :returns: False if they are the ones already in use
+        """
+        logger.info(f"{YELLOW}Refreshing app tokens...")
+        bundle = Bundle(self.bundle_cache, self.player_url)
+        app_id = str(bundle.get_app_id())
+        secrets = [secret for secret in bundle.get_secrets().values() if secret]
+        if app_id == self.id and secrets == [s for s in self.secrets if s]:
+            return False
+
+        self.secrets = secrets
+        if app_id != self.id:
+            self.id = app_id
+            self.session.headers.update({"X-App-Id": self.id})
+            self.auth(self._email, self._pwd)
+        return True
+
+    def _find_secret(self):
+        "Probe the secrets, refreshing them once if none of them is valid"
+        try:
+            self.cfg_setup()
+        except InvalidAppSecretError:
+            if not self._refresh_tokens():
+                raise
+            self.cfg_setup()
+
+    def cfg_setup(self):
+        # Falsy secrets
+        secrets = [secret for secret in self.secrets if secret]
+        # probed at the same time; the first valid one, in order, wins
+        with ThreadPoolExecutor(max_workers=max(1, len(secrets))) as executor:
+            valid = list(executor.map(self.test_secret, secrets))
+        self.sec = next(
+            (secret for secret, ok in zip(secrets, valid) if ok), None
+        )
 
         if self.sec is None:
             raise InvalidAppSecretError("Can't find any valid app secret.\n" + RESET)
+
+
+def request_params(epoint, app_id, uat, secret, **kwargs):
+    """Query parameters of an API call, signed with `secret` (or the secret
+    being tested, `kwargs["sec"]`) for the endpoints that need it. Shared by
+    Client and async_qopy.AsyncClient."""
+    if epoint == "user/login":
+        params = {
+            "email": kwargs["email"],
+            "password": kwargs["pwd"],
+            "app_id": app_id,
+        }
+    elif epoint == "track/get":
+        params = {"track_id": kwargs["id"]}
+    elif epoint == "album/get":
+        params = {"album_id": kwargs["id"]}
+    elif epoint == "playlist/get":
+        params = {
+            "extra": "tracks",
+            "playlist_id": kwargs["id"],
+            "limit": PAGE_SIZE,
+            "offset": kwargs["offset"],
+        }
+    elif epoint == "artist/get":
+        params = {
+            "app_id": app_id,
+            "artist_id": kwargs["id"],
+            "limit": PAGE_SIZE,
+            "offset": kwargs["offset"],
+            "extra": "albums",
+        }
+    elif epoint == "label/get":
+        params = {
+            "label_id": kwargs["id"],
+            "limit": PAGE_SIZE,
+            "offset": kwargs["offset"],
+            "extra": "albums",
+        }
+    elif epoint == "favorite/getUserFavorites":
+        unix = time.time()
+        # r_sig = "userLibrarygetAlbumsList" + str(unix) + kwargs["sec"]
+        r_sig = "favoritegetUserFavorites" + str(unix) + kwargs.get("sec", secret)
+        r_sig_hashed = hashlib.md5(r_sig.encode("utf-8")).hexdigest()
+        params = {
+            "app_id": app_id,
+            "user_auth_token": uat,
+            "type": "albums",
+            "request_ts": unix,
+            "request_sig": r_sig_hashed,
+        }
+    elif epoint == "track/getFileUrl":
+        unix = time.time()
+        track_id = kwargs["id"]
+        fmt_id = kwargs["fmt_id"]
+        if int(fmt_id) not in (5, 6, 7, 27):
+            raise InvalidQuality("Invalid quality id: choose between 5, 6, 7 or 27")
+        r_sig = "trackgetFileUrlformat_id{}intentstreamtrack_id{}{}{}".format(
+            fmt_id, track_id, unix, kwargs.get("sec", secret)
+        )
+        r_sig_hashed = hashlib.md5(r_sig.encode("utf-8")).hexdigest()
+        params = {
+            "request_ts": unix,
+            "request_sig": r_sig_hashed,
+            "track_id": track_id,
+            "format_id": fmt_id,
+            "intent": "stream",
+        }
+    else:
+        params = kwargs
+    return params
+
+
+def check_status(epoint, status, get_json):
+    """Raise the error of a failed login or a rejected app secret.
+
+    :param get_json: callable returning the body of the response
+    """
+    if epoint == "user/login":
+        if status == 401:
+            raise AuthenticationError("Invalid credentials.\n" + RESET)
+        elif status == 400:
+            raise InvalidAppIdError("Invalid app id.\n" + RESET)
+        else:
+            logger.info(f"{GREEN}Logged: OK")
+    elif epoint in ["track/getFileUrl", "favorite/getUserFavorites"] and status == 400:
+        raise InvalidAppSecretError(f"Invalid app secret: {get_json()}.\n" + RESET)
+
+
+def url_expiry(url):
+    "Unix time at which a signed file URL expires (its `etsp` parameter)"
+    try:
+        return int(parse_qs(urlsplit(url).query)["etsp"][0])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
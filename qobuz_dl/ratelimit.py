@@ -0,0 +1,200 @@
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+logger = logging.getLogger(__name__)
+
+# statuses that are retried; the throttling ones also lower the concurrency
+RETRIED_STATUSES = (429, 500, 502, 503, 504)
+THROTTLING_STATUSES = (429, 503)
+RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30
+MAX_CONCURRENCY = 64
+MIN_CONCURRENCY = 1
+# starting limit, doubled every round trip until the server first throttles
+INITIAL_CONCURRENCY = 4
+# share of the limit kept when the server throttles
+DECREASE_FACTOR = 0.7
+# growth is this many times slower near the limit that was last throttled,
+# so the limit settles just below it instead of bouncing off it
+CEILING_SLOWDOWN = 10
+# the limit only grows while calls are at most this many times slower than
+# the fastest one seen, so it settles before the server starts queueing
+LATENCY_TOLERANCE = 3
+# weight of a new latency sample in the moving average
+LATENCY_SMOOTHING = 0.2
+
+
+class _Window:
+    "AIMD concurrency window of one endpoint"
+
+    def __init__(self, limit):
+        self.limit = float(limit)
+        self.in_flight = 0
+        self.latency = None
+        self.min_latency = None
+        self.last_decrease = 0.0
+        # limit at the last throttling, None until the server throttles
+        self.ceiling = None
+        self.calls = 0
+        self.throttled = 0
+
+
+class RateLimiter:
+    """Adaptive concurrency limit for API calls, shared by every thread of a
+    client.
+
+    Each endpoint has its own limit. It starts small and doubles every round
+    trip until the server first throttles (like TCP's slow start), so a
+    burst of calls doesn't collide with the server's limit all at once.
+    Then it grows by one per round of successful
+    calls (additive increase) while latency stays close to the best seen,
+    and more slowly near the limit at which the server last throttled. It
+    shrinks by DECREASE_FACTOR when the server throttles (multiplicative
+    decrease), at most once per round trip. A `Retry-After` pauses every
+    endpoint.
+
+    :param int maximum: the limit never goes above this
+    :param int minimum: the limit never goes below this
+    :param int initial: starting limit of each endpoint
+    """
+
+    def __init__(
+        self,
+        maximum=MAX_CONCURRENCY,
+        minimum=MIN_CONCURRENCY,
+        initial=INITIAL_CONCURRENCY,
+    ):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.initial = min(maximum, max(minimum, initial))
+        self.retries = RETRIES
+        self._cond = threading.Condition()
+        self._windows = {}
+        self._paused_until = 0.0
+
+    def slot(self, endpoint):
+        "Context manager holding a call slot of `endpoint`; see `_Slot`"
+        return _Slot(self, endpoint)
+
+    def _window(self, endpoint):
+        window = self._windows.get(endpoint)
+        if window is None:
+            window = self._windows[endpoint] = _Window(self.initial)
+        return window
+
+    def _acquire(self, endpoint):
+        with self._cond:
+            window = self._window(endpoint)
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    self._cond.wait(pause)
+                elif window.in_flight >= int(window.limit):
+                    self._cond.wait()
+                else:
+                    break
+            window.in_flight += 1
+            window.calls += 1
+
+    def _release(self, endpoint, latency, status, retry_after):
+        now = time.monotonic()
+        with self._cond:
+            window = self._window(endpoint)
+            window.in_flight -= 1
+            if status in THROTTLING_STATUSES:
+                window.throttled += 1
+                # the calls in flight were sent at the old limit: react once
+                if now - window.last_decrease > max(window.latency or 0, latency):
+                    window.ceiling = window.limit
+                    window.limit = max(self.minimum, window.limit * DECREASE_FACTOR)
+                    window.last_decrease = now
+                    logger.debug(
+                        f"{endpoint} throttled ({status}): "
+                        f"concurrency limit {int(window.limit)}"
+                    )
+                if retry_after:
+                    self._paused_until = max(self._paused_until, now + retry_after)
+            elif status is not None and status < 500:
+                if window.min_latency is None or latency < window.min_latency:
+                    window.min_latency = latency
+                if window.latency is None:
+                    window.latency = latency
+                else:
+                    window.latency += LATENCY_SMOOTHING * (latency - window.latency)
+                if latency <= window.min_latency * LATENCY_TOLERANCE:
+                    if window.ceiling is None:
+                        step = 1
+                    elif window.limit + 1 >= window.ceiling:
+                        step = 1 / window.limit / CEILING_SLOWDOWN
+                    else:
+                        step = 1 / window.limit
+                    window.limit = min(self.maximum, window.limit + step)
+            self._cond.notify_all()
+
+    def backoff(self, attempt, retry_after=None):
+        "Seconds to wait before retrying: full jitter, at least `Retry-After`"
+        delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+        return max(delay, retry_after or 0)
+
+    def stats(self):
+        with self._cond:
+            return {
+                endpoint: {
+                    "limit": int(window.limit),
+                    "in_flight": window.in_flight,
+                    "latency": window.latency,
+                    "calls": window.calls,
+                    "throttled": window.throttled,
+                }
+                for endpoint, window in self._windows.items()
+            }
+
+
+class _Slot:
+    """A call slot. Set `status` and `retry_after` from the response before
+    leaving the block; they are fed back to the limiter."""
+
+    def __init__(self, limiter, endpoint):
+        self._limiter = limiter
+        self._endpoint = endpoint
+        self.status = None
+        self.retry_after = None
+
+    def __enter__(self):
+        self._limiter._acquire(self._endpoint)
+        self._started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._limiter._release(
+            self._endpoint,
+            time.monotonic() - self._started,
+            self.status,
+            self.retry_after,
+        )
+
+    def record(self, response):
+        self.status = response.status_code
+        self.retry_after = parse_retry_after(response.headers.get("Retry-After"))
+
+    @property
+    def retry(self):
+        return self.status in RETRIED_STATUSES
+
+
+def parse_retry_after(value):
+    "Seconds to wait from a Retry-After header (seconds or an HTTP date)"
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,121 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data):
+    "Decode a JSON document (str or bytes), with orjson when it's installed"
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _name(d):
+    return d.get("name") if d else None
+
+
+class Artist:
+    __slots__ = ("id", "name")
+
+    def __init__(self, id=None, name=None):
+        self.id = id
+        self.name = name
+
+    @classmethod
+    def from_json(cls, d):
+        return cls(d.get("id"), d.get("name")) if d else cls()
+
+
+class Album:
+    """The fields of an album used to download and tag it. Parsed once from
+    an `album/get` response (or an item of an artist, label or search page),
+    so that the rest of the JSON can be freed."""
+
+    __slots__ = (
+        "id",
+        "title",
+        "version",
+        "artist",
+        "label",
+        "release_date_original",
+        "release_type",
+        "maximum_bit_depth",
+        "maximum_sampling_rate",
+        "streamable",
+        "tracks_count",
+        "genres_list",
+        "copyright",
+        "image",
+        "booklet",
+        "tracks",
+    )
+
+    @classmethod
+    def from_json(cls, d):
+        album = cls()
+        album.id = d.get("id")
+        album.title = d.get("title")
+        album.version = d.get("version")
+        album.artist = Artist.from_json(d.get("artist"))
+        album.label = _name(d.get("label"))
+        album.release_date_original = d.get("release_date_original")
+        album.release_type = d.get("release_type")
+        album.maximum_bit_depth = d.get("maximum_bit_depth")
+        album.maximum_sampling_rate = d.get("maximum_sampling_rate")
+        album.streamable = d.get("streamable")
+        album.tracks_count = d.get("tracks_count")
+        album.genres_list = tuple(d.get("genres_list") or ())
+        album.copyright = d.get("copyright")
+        album.image = (d.get("image") or {}).get("large")
+        goodies = d.get("goodies")
+        album.booklet = goodies[0].get("url") if goodies else None
+        album.tracks = [
+            Track.from_json(track, album)
+            for track in (d.get("tracks") or {}).get("items", ())
+        ]
+        return album
+
+
+class Track:
+    """The fields of a track used to download and tag it. `album` is the
+    release it belongs to: the parent record for the tracks of an album, or
+    the summary embedded in a `track/get` response."""
+
+    __slots__ = (
+        "id",
+        "title",
+        "version",
+        "work",
+        "track_number",
+        "media_number",
+        "maximum_bit_depth",
+        "maximum_sampling_rate",
+        "performer",
+        "composer",
+        "copyright",
+        "isrc",
+        "album",
+    )
+
+    @classmethod
+    def from_json(cls, d, album=None):
+        track = cls()
+        track.id = d.get("id")
+        track.title = d.get("title")
+        track.version = d.get("version")
+        track.work = d.get("work")
+        track.track_number = d.get("track_number")
+        track.media_number = d.get("media_number")
+        track.maximum_bit_depth = d.get("maximum_bit_depth")
+        track.maximum_sampling_rate = d.get("maximum_sampling_rate")
+        track.performer = _name(d.get("performer"))
+        track.composer = _name(d.get("composer"))
+        track.copyright = d.get("copyright")
+        track.isrc = d.get("isrc")
+        if album is None and d.get("album"):
+            album = Album.from_json(d["album"])
+        track.album = album
+        return track
@@ -0,0 +1,244 @@
+import contextvars
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+from qobuz_dl.color import OFF, RED, YELLOW
+from qobuz_dl.exceptions import Cancelled
+
+logger = logging.getLogger(__name__)
+
+# duplicates removed by the run of the current context, see Registry.run
+_current_run = contextvars.ContextVar("current_run", default=None)
+
+
+class BoundedPool:
+    """A thread pool whose `submit` blocks while `max_workers` jobs are in
+    flight. This keeps the queue (and with it memory and open sockets) flat
+    no matter how many jobs the producer has."""
+
+    def __init__(self, max_workers, name="qobuz-dl"):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=name
+        )
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._closed = False
+
+    def submit(self, func, *args, **kwargs) -> Future:
+        self._slots.acquire()
+        with self._lock:
+            if self._closed:
+                self._slots.release()
+                raise Cancelled("the queue was cancelled")
+            # jobs see the context variables of the thread that submitted them
+            context = contextvars.copy_context()
+            future = self._executor.submit(context.run, func, *args, **kwargs)
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+        self._slots.release()
+
+    @property
+    def in_flight(self):
+        with self._lock:
+            return len(self._pending)
+
+    def join(self):
+        while True:
+            with self._lock:
+                pending = list(self._pending)
+            if not pending:
+                return
+            wait(pending)
+
+    def cancel(self):
+        "Cancel the jobs that haven't started and refuse new ones."
+        with self._lock:
+            self._closed = True
+            pending = list(self._pending)
+        for future in pending:
+            future.cancel()
+        self._executor.shutdown(wait=False)
+
+
+class Scheduler:
+    """Global scheduler for a download queue.
+
+    Releases (albums, or single tracks from playlists) run on one bounded
+    pool and the tracks of every release share a second bounded pool, so
+    the number of in-flight downloads is the same for a single album or a
+    400-album label.
+
+    :param int max_releases: releases downloaded at the same time. With 1,
+    releases are downloaded inline, one after another
+    :param int max_tracks: tracks downloaded at the same time across all
+    releases. With None, each release uses its own `track_workers`
+    """
+
+    def __init__(self, max_releases=1, max_tracks=None):
+        self.max_releases = max(1, int(max_releases or 1))
+        self.release_pool = (
+            BoundedPool(self.max_releases, "qobuz-dl-release")
+            if self.max_releases > 1
+            else None
+        )
+        self.track_pool = (
+            BoundedPool(int(max_tracks), "qobuz-dl-track") if max_tracks else None
+        )
+        # set by `cancel`: downloads in flight stop before their next track
+        self.cancelled = threading.Event()
+
+    def submit(self, func, *args, **kwargs) -> Future:
+        if self.release_pool is None:
+            future = Future()
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+                raise
+            return future
+
+        future = self.release_pool.submit(func, *args, **kwargs)
+        future.add_done_callback(_log_unexpected_error)
+        return future
+
+    def join(self):
+        "Wait until every scheduled release is done."
+        if self.release_pool is not None:
+            self.release_pool.join()
+
+    def cancel(self):
+        self.cancelled.set()
+        for pool in (self.release_pool, self.track_pool):
+            if pool is not None:
+                pool.cancel()
+
+
+class Registry:
+    """Releases and tracks scheduled during a run, so overlapping URLs (an
+    artist, a label and playlists sharing albums, say) download each of
+    them once.
+
+    IDs are claimed before their download is scheduled, so identical IDs
+    in flight at the same time are collapsed too. Outside a run nothing is
+    deduplicated. Runs can be nested, and overlap (e.g. jobs of the
+    server): the registry is cleared when the last one ends.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._runs = 0
+        # (is album, ID) -> Future done when that download is
+        self._claimed = {}
+        # track ID -> path of its file, for the m3u of playlists
+        self._paths = {}
+
+    @contextmanager
+    def run(self):
+        "Scope of a run; the outermost one of a context reports the duplicates"
+        if _current_run.get() is not None:
+            yield
+            return
+        removed = [0]
+        token = _current_run.set(removed)
+        with self._lock:
+            self._runs += 1
+        try:
+            yield
+        finally:
+            _current_run.reset(token)
+            with self._lock:
+                self._runs -= 1
+                if not self._runs:
+                    self._claimed.clear()
+                    self._paths.clear()
+            if removed[0]:
+                logger.info(f"{YELLOW}{removed[0]} duplicate downloads removed")
+
+    def claim(self, item_id, album):
+        """Claim the download of a release (or track) for the current run.
+
+        :returns: None if the download should be scheduled, otherwise the
+        Future of the download that makes it a duplicate
+        """
+        removed = _current_run.get()
+        if removed is None:
+            return None
+        key = (album, str(item_id))
+        with self._lock:
+            duplicate = self._claimed.get(key)
+            if duplicate is None:
+                self._claimed[key] = Future()
+                return None
+        removed[0] += 1
+        logger.info(
+            f"{OFF}This {'release' if album else 'track'} ID ({item_id}) "
+            "is already queued in this run"
+        )
+        return duplicate
+
+    def release(self, release_id):
+        """Future done when the download of an album claimed in the current
+        run is, or None if it wasn't claimed"""
+        if release_id is None or _current_run.get() is None:
+            return None
+        with self._lock:
+            return self._claimed.get((True, str(release_id)))
+
+    def downloaded_with(self, track_id):
+        "Whether the download of its album (see `release`) saved the track"
+        with self._lock:
+            downloaded = str(track_id) in self._paths
+        if downloaded:
+            removed = _current_run.get()
+            if removed is not None:
+                removed[0] += 1
+            logger.info(
+                f"{OFF}This track ID ({track_id}) was downloaded with its album"
+            )
+        return downloaded
+
+    def scheduled(self, item_id, album, future):
+        """Link a claimed ID to its download (None if it was skipped), so
+        its duplicates wait for it"""
+        with self._lock:
+            claimed = self._claimed.get((album, str(item_id)))
+        if claimed is None or claimed.done():
+            return
+        if future is None:
+            claimed.set_result(None)
+        else:
+            future.add_done_callback(lambda _: claimed.set_result(None))
+
+    def add_path(self, track_id, path):
+        with self._lock:
+            if self._runs:
+                self._paths[str(track_id)] = path
+
+    def paths(self, track_ids, outside=None):
+        "Paths of the tracks downloaded in the run that aren't under `outside`"
+        prefix = os.path.join(os.path.abspath(outside), "") if outside else None
+        with self._lock:
+            paths = [self._paths.get(str(track_id)) for track_id in track_ids]
+        return [
+            path
+            for path in paths
+            if path and not (prefix and os.path.abspath(path).startswith(prefix))
+        ]
+
+
+def _log_unexpected_error(future):
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None and not isinstance(error, Cancelled):
+        logger.error(f"{RED}Unexpected error: {error}", exc_info=error)
@@ -0,0 +1,326 @@
+import contextvars
+import itertools
+import json
+import logging
+import queue
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+from qobuz_dl.color import GREEN, RED, YELLOW
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_WORKERS = 2
+# log lines kept per job for clients streaming its progress
+LOG_LINES = 1000
+# finished jobs kept for `status`
+FINISHED_JOBS = 500
+# seconds between progress polls of the submit command
+POLL_INTERVAL = 0.5
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+logger = logging.getLogger(__name__)
+
+# the job whose download is running in the current context
+_current_job = contextvars.ContextVar("current_job", default=None)
+
+
+class _Job:
+    def __init__(self, id, urls):
+        self.id = id
+        self.urls = urls
+        self.state = QUEUED
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        # (sequence number, message); numbers keep counting after old lines
+        # are dropped, so a client can ask for the lines after the last one
+        self.log = deque(maxlen=LOG_LINES)
+        self._lines = itertools.count()
+
+    def append_log(self, message):
+        self.log.append((next(self._lines), message))
+
+    def to_json(self, since=None):
+        job = {
+            "id": self.id,
+            "urls": self.urls,
+            "state": self.state,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+        if since is not None:
+            job["log"] = [[n, line] for n, line in list(self.log) if n >= since]
+        return job
+
+
+class _JobLogHandler(logging.Handler):
+    "Copies the log records emitted while a job runs to that job's log"
+
+    def emit(self, record):
+        job = _current_job.get()
+        if job is not None:
+            try:
+                job.append_log(self.format(record))
+            except Exception:
+                self.handleError(record)
+
+
+class DownloadServer:
+    """Keeps one logged-in QobuzDL alive and runs the jobs it's sent over a
+    local HTTP API, so every download doesn't pay for the startup, login
+    and secret probing of a new process.
+
+    Jobs (lists of URLs) run on `workers` threads that share the QobuzDL
+    (and with it the connection pools, the scheduler and the rate limiter):
+
+        POST   /jobs        {"urls": [...]} -> the job
+        GET    /jobs        every job
+        GET    /jobs/<id>   the job; with ?since=<n>, its log from line n
+        DELETE /jobs/<id>   cancel a queued job
+        GET    /stats       job counts and API concurrency per endpoint
+
+    The API has no authentication: keep it bound to localhost.
+
+    :param qobuz: a QobuzDL with an initialized client
+    """
+
+    def __init__(
+        self, qobuz, host=DEFAULT_HOST, port=DEFAULT_PORT, workers=DEFAULT_WORKERS
+    ):
+        self.qobuz = qobuz
+        self.workers = max(1, workers)
+        self.started = time.time()
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._threads = []
+        self._log_handler = _JobLogHandler()
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.download_server = self
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def serve_forever(self):
+        logging.getLogger().addHandler(self._log_handler)
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, name=f"qobuz-dl-job-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"{GREEN}Serving on {self.url} with {self.workers} workers")
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        "Stop accepting jobs, cancel the queued ones and stop the workers"
+        logging.getLogger().removeHandler(self._log_handler)
+        with self._lock:
+            for job in self._jobs.values():
+                if job.state == QUEUED:
+                    job.state = CANCELLED
+                    job.finished = time.time()
+        for _ in self._threads:
+            self._queue.put(None)
+        self._httpd.server_close()
+
+    def submit(self, urls):
+        with self._lock:
+            job = _Job(next(self._ids), urls)
+            self._jobs[job.id] = job
+            self._forget_finished()
+        self._queue.put(job)
+        logger.info(f"{YELLOW}Job {job.id} queued: {len(urls)} URLs")
+        return job
+
+    def _forget_finished(self):
+        finished = [job for job in self._jobs.values() if job.state in FINISHED]
+        for job in finished[: max(0, len(finished) - FINISHED_JOBS)]:
+            del self._jobs[job.id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id):
+        """Cancel a queued job. Running jobs can't be stopped halfway:
+        returns False for them (and for finished ones)."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.state != QUEUED:
+                return False
+            job.state = CANCELLED
+            job.finished = time.time()
+        return True
+
+    def stats(self):
+        with self._lock:
+            states = [job.state for job in self._jobs.values()]
+        return {
+            "uptime": time.time() - self.started,
+            "workers": self.workers,
+            "jobs": {state: states.count(state) for state in set(states)},
+            "api": self.qobuz.client.limiter.stats(),
+        }
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            with self._lock:
+                if job.state != QUEUED:
+                    continue
+                job.state = RUNNING
+                job.started = time.time()
+            token = _current_job.set(job)
+            try:
+                self.qobuz.download_list_of_urls(job.urls)
+                state, error = DONE, None
+            except Exception as e:
+                logger.error(f"{RED}Job {job.id} failed: {e}", exc_info=True)
+                state, error = FAILED, str(e)
+            finally:
+                _current_job.reset(token)
+            with self._lock:
+                job.state, job.error, job.finished = state, error, time.time()
+            logger.info(f"{GREEN}Job {job.id} {state}")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are separate writes: without TCP_NODELAY each
+    # keep-alive response waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    @property
+    def download_server(self):
+        return self.server.download_server
+
+    def _route(self):
+        parts = urlsplit(self.path)
+        match = re.fullmatch(r"/jobs/(\d+)", parts.path)
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        return parts.path, int(match.group(1)) if match else None, query
+
+    def do_GET(self):
+        path, job_id, query = self._route()
+        if path == "/jobs":
+            return self._send(
+                200, [job.to_json() for job in self.download_server.jobs()]
+            )
+        if path == "/stats":
+            return self._send(200, self.download_server.stats())
+        job = self.download_server.get(job_id) if job_id else None
+        if job is None:
+            return self._send(404, {"error": "no such job"})
+        try:
+            since = int(query["since"]) if "since" in query else None
+        except ValueError:
+            return self._send(400, {"error": "since must be an integer"})
+        self._send(200, job.to_json(since))
+
+    def do_POST(self):
+        path, _, _ = self._route()
+        if path != "/jobs":
+            return self._send(404, {"error": "not found"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            urls = json.loads(self.rfile.read(length))["urls"]
+            if not urls or not all(isinstance(url, str) for url in urls):
+                raise ValueError
+        except (KeyError, TypeError, ValueError):
+            return self._send(400, {"error": 'expected {"urls": ["...", ...]}'})
+        self._send(201, self.download_server.submit(urls).to_json())
+
+    def do_DELETE(self):
+        _, job_id, _ = self._route()
+        job = self.download_server.get(job_id) if job_id else None
+        if job is None:
+            return self._send(404, {"error": "no such job"})
+        if not self.download_server.cancel(job_id):
+            return self._send(409, {"error": f"job is {job.state}"})
+        self._send(200, job.to_json())
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class ServerClient:
+    "Client of a DownloadServer's HTTP API"
+
+    def __init__(self, url=f"http://{DEFAULT_HOST}:{DEFAULT_PORT}"):
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+
+    def _call(self, method, path, **kwargs):
+        r = self.session.request(method, self.url + path, timeout=30, **kwargs)
+        if r.status_code >= 400:
+            try:
+                error = r.json()["error"]
+            except (ValueError, KeyError):
+                error = r.reason
+            raise requests.exceptions.HTTPError(f"{r.status_code}: {error}", response=r)
+        return r.json()
+
+    def enqueue(self, urls):
+        return self._call("POST", "/jobs", json={"urls": urls})
+
+    def status(self, job_id=None, since=None):
+        if job_id is None:
+            return self._call("GET", "/jobs")
+        params = {"since": since} if since is not None else None
+        return self._call("GET", f"/jobs/{job_id}", params=params)
+
+    def cancel(self, job_id):
+        return self._call("DELETE", f"/jobs/{job_id}")
+
+    def stats(self):
+        return self._call("GET", "/stats")
+
+    def follow(self, job_id, echo=print):
+        "Pass the log lines of a job to `echo` until it's finished; return it"
+        since = 0
+        while True:
+            job = self.status(job_id, since)
+            for n, line in job["log"]:
+                since = n + 1
+                echo(line)
+            if job["state"] in FINISHED:
+                return job
+            time.sleep(POLL_INTERVAL)
@@ -0,0 +1,89 @@
+import logging
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# connections kept alive per host
+DEFAULT_POOL_SIZE = 10
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_file_session = None
+_pool_size = DEFAULT_POOL_SIZE
+_host_pool_sizes = {}
+_warmed_up = set()
+
+
+def new_session(pool_size=DEFAULT_POOL_SIZE, host_pool_sizes=None):
+    """Return a requests Session that keeps up to `pool_size` connections
+    alive per host.
+
+    :param dict host_pool_sizes: pool sizes of specific hosts, e.g.
+    {"streaming-qobuz-std.akamaized.net": 32}
+    """
+    session = requests.Session()
+    for scheme in ("https://", "http://"):
+        session.mount(scheme, HTTPAdapter(pool_maxsize=pool_size))
+        for host, size in (host_pool_sizes or {}).items():
+            session.mount(f"{scheme}{host}/", HTTPAdapter(pool_maxsize=size))
+    return session
+
+
+def configure(pool_size=None, host_pool_sizes=None):
+    """Set the pool sizes of the file session (tracks, covers and booklets).
+    API calls go through the session of `qopy.Client`, with its own pool."""
+    global _file_session, _pool_size, _host_pool_sizes
+    with _lock:
+        _pool_size = pool_size or DEFAULT_POOL_SIZE
+        _host_pool_sizes = dict(host_pool_sizes or {})
+        if _file_session is not None:
+            _file_session.close()
+        _file_session = None
+        _warmed_up.clear()
+
+
+def file_session():
+    "The shared session used to download files from the CDN"
+    global _file_session
+    with _lock:
+        if _file_session is None:
+            _file_session = new_session(_pool_size, _host_pool_sizes)
+        return _file_session
+
+
+def warm_up(url, connections=1, session=None, wait=False):
+    """Open `connections` kept-alive connections to the host of `url`, so
+    the first downloads don't pay for the TCP and TLS handshakes. Hosts of
+    the file session are only warmed up once.
+
+    :param bool wait: block until the connections are open
+    """
+    parts = urlsplit(url)
+    root = f"{parts.scheme}://{parts.netloc}/"
+    if session is None:
+        session = file_session()
+        with _lock:
+            if parts.netloc in _warmed_up:
+                return
+            _warmed_up.add(parts.netloc)
+            connections = min(
+                connections, _host_pool_sizes.get(parts.netloc, _pool_size)
+            )
+
+    def connect():
+        try:
+            session.head(root, timeout=10).close()
+        except requests.exceptions.RequestException as e:
+            logger.debug(f"Couldn't warm up {root}: {e}")
+
+    threads = [
+        threading.Thread(target=connect, daemon=True) for _ in range(connections)
+    ]
+    for thread in threads:
+        thread.start()
+    if wait:
+        for thread in threads:
+            thread.join()
@@ -3,10 +3,13 @@ import string
 import os
 import logging
 import time
+from typing import Iterable
 
 from mutagen.mp3 import EasyMP3
 from mutagen.flac import FLAC
 
+from qobuz_dl.records import Album
+
 logger = logging.getLogger(__name__)
 
 EXTENSIONS = (".mp3", ".flac")
@@ -34,7 +37,23 @@ class PartialFormatter(string.Formatter):
             raise
 
 
-def make_m3u(pl_directory):
+def _m3u_entry(audio_file, audio_rel_file):
+    try:
+        pl_item = EasyMP3(audio_file) if ".mp3" in audio_file else FLAC(audio_file)
+        title = pl_item["TITLE"][0]
+        artist = pl_item["ARTIST"][0]
+        length = int(pl_item.info.length)
+        return "#EXTINF:{}, {} - {}\n{}".format(length, artist, title, audio_rel_file)
+    except:  # noqa
+        return None
+
+
+def make_m3u(pl_directory, extra_files=()):
+    """Write an m3u with the audio files of a playlist directory.
+
+    :param extra_files: tracks of the playlist saved elsewhere (e.g. with
+    their album), listed after the others
+    """
     track_list = ["#EXTM3U"]
     rel_folder = os.path.basename(os.path.normpath(pl_directory))
     pl_name = rel_folder + ".m3u"
@@ -54,18 +73,13 @@ def make_m3u(pl_directory):
             continue
 
         for audio_rel_file, audio_file in zip(audio_rel_files, audio_files):
-            try:
-                pl_item = (
-                    EasyMP3(audio_file) if ".mp3" in audio_file else FLAC(audio_file)
-                )
-                title = pl_item["TITLE"][0]
-                artist = pl_item["ARTIST"][0]
-                length = int(pl_item.info.length)
-                index = "#EXTINF:{}, {} - {}\n{}".format(
-                    length, artist, title, audio_rel_file
-                )
-            except:  # noqa
-                continue
+            index = _m3u_entry(audio_file, audio_rel_file)
+            if index:
+                track_list.append(index)
+
+    for audio_file in extra_files:
+        index = _m3u_entry(audio_file, os.path.relpath(audio_file, pl_directory))
+        if index:
             track_list.append(index)
 
     if len(track_list) > 1:
@@ -74,7 +88,7 @@ def make_m3u(pl_directory):
 
 
 def smart_discography_filter(
-    contents: list, save_space: bool = False, skip_extras: bool = False
+    contents: Iterable[dict], save_space: bool = False, skip_extras: bool = False
 ) -> list:
     """When downloading some artists' discography, many random and spam-like
     albums can get downloaded. This helps filter those out to just get the good stuff.
@@ -84,18 +98,19 @@ def smart_discography_filter(
         * duplicate albums in different qualities
         * (optionally) removes collector's, deluxe, live albums
 
-    :param list contents: contents returned by qobuz API
+    :param contents: pages returned by qobuz API (any iterable; it is consumed
+    page by page, and each album is kept as a compact `records.Album`)
     :param bool save_space: choose highest bit depth, lowest sampling rate
     :param bool remove_extras: remove albums with extra material (i.e. live, deluxe,...)
-    :returns: filtered items list
+    :returns: filtered list of `records.Album`
     """
 
     # for debugging
-    def print_album(album: dict) -> None:
+    def print_album(album: Album) -> None:
         logger.debug(
-            f"{album['title']} - {album.get('version', '~~')} "
-            "({album['maximum_bit_depth']}/{album['maximum_sampling_rate']}"
-            " by {album['artist']['name']}) {album['id']}"
+            f"{album.title} - {album.version or '~~'} "
+            f"({album.maximum_bit_depth}/{album.maximum_sampling_rate}"
+            f" by {album.artist.name}) {album.id}"
         )
 
     TYPE_REGEXES = {
@@ -103,10 +118,10 @@ def smart_discography_filter(
         "extra": r"(?i)(anniversary|deluxe|live|collector|demo|expanded)",
     }
 
-    def is_type(album_t: str, album: dict) -> bool:
+    def is_type(album_t: str, album: Album) -> bool:
         """Check if album is of type `album_t`"""
-        version = album.get("version", "")
-        title = album.get("title", "")
+        version = album.version or ""
+        title = album.title or ""
         regex = TYPE_REGEXES[album_t]
         return re.search(regex, f"{title} {version}") is not None
 
@@ -118,34 +133,35 @@ def smart_discography_filter(
         r = re.match(r"([^\(]+)(?:\s*[\(\[][^\)][\)\]])*", album)
         return r.group(1).strip().lower()
 
-    requested_artist = contents[0]["name"]
-    items = [item["albums"]["items"] for item in contents][0]
-
+    requested_artist = None
     # use dicts to group duplicate albums together by title
     title_grouped = dict()
-    for item in items:
-        title_ = essence(item["title"])
-        if title_ not in title_grouped:  # ?
-            #            if (t := essence(item["title"])) not in title_grouped:
-            title_grouped[title_] = []
-        title_grouped[title_].append(item)
+    for page in contents:
+        if requested_artist is None:
+            requested_artist = page["name"]
+        for item in page["albums"]["items"]:
+            title_ = essence(item["title"])
+            if title_ not in title_grouped:  # ?
+                #            if (t := essence(item["title"])) not in title_grouped:
+                title_grouped[title_] = []
+            title_grouped[title_].append(Album.from_json(item))
 
     items = []
     for albums in title_grouped.values():
-        best_bit_depth = max(a["maximum_bit_depth"] for a in albums)
+        best_bit_depth = max(a.maximum_bit_depth for a in albums)
         get_best = min if save_space else max
         best_sampling_rate = get_best(
-            a["maximum_sampling_rate"]
+            a.maximum_sampling_rate
             for a in albums
-            if a["maximum_bit_depth"] == best_bit_depth
+            if a.maximum_bit_depth == best_bit_depth
         )
         remaster_exists = any(is_type("remaster", a) for a in albums)
 
-        def is_valid(album: dict) -> bool:
+        def is_valid(album: Album) -> bool:
             return (
-                album["maximum_bit_depth"] == best_bit_depth
-                and album["maximum_sampling_rate"] == best_sampling_rate
-                and album["artist"]["name"] == requested_artist
+                album.maximum_bit_depth == best_bit_depth
+                and album.maximum_sampling_rate == best_sampling_rate
+                and album.artist.name == requested_artist
                 and not (  # states that are not allowed
                     (remaster_exists and not is_type("remaster", album))
                     or (skip_extras and is_type("extra", album))
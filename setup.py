@@ -28,6 +28,7 @@ setup(
     long_description_content_type="text/markdown",
     url="https://github.com/vitiko98/Qobuz-DL",
     install_requires=requirements,
+    extras_require={"async": ["aiohttp"], "speedups": ["orjson"]},
     entry_points={
         "console_scripts": [
             "qobuz-dl = qobuz_dl:main",